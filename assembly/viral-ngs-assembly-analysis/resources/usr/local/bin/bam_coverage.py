@@ -0,0 +1 @@
+../../../../../../common/bam_coverage.py
\ No newline at end of file
@@ -3,12 +3,17 @@
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-assembly-analysis job_input.json; then
+        exit 0
+    fi
+
     if [ -z "$name" ]; then
         name="${assembly_prefix%.refined.refined}"
     fi
 
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
     dx download "$assembly" -o assembly.fasta & pids+=($!)
     dx download "$reads" -o reads.bam & pids+=($!)
     mkdir gatk/
@@ -35,14 +40,14 @@ main() {
 
     # collect some statistics
     assembly_length=$(tail -n +1 assembly.fasta | tr -d '\n' | wc -c)
-    alignment_read_count=$(samtools view -c mapped.bam)
-    reads_paired_count=$(samtools flagstat all.bam | grep properly | awk '{print $1}')
-    alignment_base_count=$(samtools view mapped.bam | cut -f10 | tr -d '\n' | wc -c)
-    mean_coverage_depth=$(( alignment_base_count / assembly_length ))
-    samtools flagstat  all.bam > stats.txt
-
-    # Continue gathering statistics
-    genomecov=$(bedtools genomecov -ibam mapped.bam | dx upload -o "${name}.genomecov.txt" --brief -)
+    bam_coverage.py mapped.bam --stats mapped.stats.json --genomecov genomecov.txt \
+        --track coverage_track.bedgraph > coverage.json
+    alignment_read_count=$(jq .read_count mapped.stats.json)
+    alignment_base_count=$(jq .base_count mapped.stats.json)
+    bam_stats.py all.bam --flagstat stats.txt > all.stats.json
+    reads_paired_count=$(jq .properly_paired_count all.stats.json)
+    mean_depth=$(jq .mean_depth coverage.json)
+    mean_coverage_depth=$(printf "%.0f" "$mean_depth")
 
     # upload outputs
     dx-jobutil-add-output assembly_length $assembly_length
@@ -50,6 +55,11 @@ main() {
     dx-jobutil-add-output alignment_read_count $alignment_read_count
     dx-jobutil-add-output alignment_base_count $alignment_base_count
     dx-jobutil-add-output mean_coverage_depth $mean_coverage_depth
+    dx-jobutil-add-output mean_depth $mean_depth
+    dx-jobutil-add-output median_depth $(jq .median_depth coverage.json)
+    dx-jobutil-add-output breadth_1x $(jq .breadth_1x coverage.json)
+    dx-jobutil-add-output breadth_5x $(jq .breadth_5x coverage.json)
+    dx-jobutil-add-output breadth_20x $(jq .breadth_20x coverage.json)
     dxid="$(dx upload all.bam --destination "${name}.all.bam" --brief)"
     dx-jobutil-add-output all_reads --class=file "$dxid"
     dxd="$(dx upload stats.txt --destination "${name}.flagstat.txt" --brief)"
@@ -58,9 +68,18 @@ main() {
     dx-jobutil-add-output assembly_read_alignments --class=file "$dxid"
     dxid="$(dx upload mapped.bam.bai --destination "${name}.mapped.bam.bai" --brief)" 
     dx-jobutil-add-output assembly_read_index --class=file "$dxid"
-    dx-jobutil-add-output alignment_genomecov "$genomecov"
+    dxid="$(dx upload genomecov.txt --destination "${name}.genomecov.txt" --brief)"
+    dx-jobutil-add-output alignment_genomecov --class=file "$dxid"
+    dxid="$(dx upload coverage.json --destination "${name}.coverage.json" --brief)"
+    dx-jobutil-add-output coverage_stats --class=file "$dxid"
+    dxid="$(dx upload coverage_track.bedgraph --destination "${name}.coverage_track.bedgraph" --brief)"
+    dx-jobutil-add-output coverage_track --class=file "$dxid"
     dxid="$(dx upload assembly.fasta --destination "${name}.fasta" --brief)"
     dx-jobutil-add-output final_assembly --class=file "$dxid"
     dxid="$(dx upload coverage_plot.pdf --destination "${name}.coverage_plot.pdf" --brief)"
     dx-jobutil-add-output coverage_plot --class=file "$dxid"
+
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-assembly-analysis job_input.json job_output.json
+    fi
 }
@@ -0,0 +1 @@
+../../../../../../common/stage_cache.py
\ No newline at end of file
@@ -3,12 +3,35 @@
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-assembly-refinement job_input.json; then
+        exit 0
+    fi
+
     if [ -z "$name" ]; then
         name="${assembly_prefix%.scaffold}"
     fi
 
+    # One refinement round with min_coverage and novoalign_options, or one
+    # round per element of round_min_coverage (with the novoalign_options of
+    # the same element of round_novoalign_options, if given), each refining
+    # the assembly of the round before
+    rounds_min_coverage=("$min_coverage")
+    rounds_novoalign_options=("$novoalign_options")
+    if [ "${#round_min_coverage[@]}" -gt 0 ]; then
+        if [ "${#round_novoalign_options[@]}" -gt 0 ] && [ "${#round_novoalign_options[@]}" -ne "${#round_min_coverage[@]}" ]; then
+            dx-jobutil-report-error "round_novoalign_options must have as many elements as round_min_coverage" AppError
+            exit 1
+        fi
+        rounds_min_coverage=("${round_min_coverage[@]}")
+        rounds_novoalign_options=()
+        for i in "${!round_min_coverage[@]}"; do
+            rounds_novoalign_options+=("${round_novoalign_options[$i]:-$novoalign_options}")
+        done
+    fi
+
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
     dx download "$assembly" -o assembly.fasta & pids+=($!)
     dx download "$reads" -o reads.bam & pids+=($!)
     mkdir gatk/
@@ -19,15 +42,50 @@ main() {
         dx cat "$novocraft_license" > novoalign.lic
     fi
 
-    viral-ngs novoindex /user-data/assembly.nix /user-data/assembly.fasta
+    # The rounds all run here on the reads, resources and GATK staged above;
+    # each round's outputs upload while the next round runs
+    round_input=assembly
+    upload_pids=()
+    for i in "${!rounds_min_coverage[@]}"; do
+        round=$(( i + 1 ))
+
+        viral-ngs novoindex "/user-data/${round_input}.nix" "/user-data/${round_input}.fasta"
+
+        viral-ngs assembly.py refine_assembly "/user-data/${round_input}.fasta" /user-data/reads.bam "/user-data/refined_${round}.fasta" \
+            --outVcf "/user-data/sites_${round}.vcf.gz" --min_coverage "${rounds_min_coverage[$i]}" --major_cutoff "$major_cutoff" \
+            --threads $(nproc) --GATK_PATH /user-data/gatk \
+            --novo_params "${rounds_novoalign_options[$i]}" --NOVOALIGN_LICENSE_PATH /user-data/novoalign.lic
 
-    viral-ngs assembly.py refine_assembly /user-data/assembly.fasta /user-data/reads.bam /user-data/refined_assembly.fasta \
-        --outVcf /user-data/sites.vcf.gz --min_coverage "$min_coverage" --major_cutoff "$major_cutoff" \
-        --threads $(nproc) --GATK_PATH /user-data/gatk \
-        --novo_params "$novoalign_options" --NOVOALIGN_LICENSE_PATH /user-data/novoalign.lic
+        out_prefix="$name"
+        if [ "${#round_min_coverage[@]}" -gt 0 ]; then
+            out_prefix="${name}.round${round}"
+        fi
+        upload_round "$round" "$out_prefix" & upload_pids+=($!)
+        round_input="refined_${round}"
+    done
+    for pid in "${upload_pids[@]}"; do wait $pid || exit $?; done
+
+    # The last round's assembly and VCF are the refined_assembly and
+    # assembly_sites_vcf outputs in either case
+    dx-jobutil-add-output assembly_sites_vcf --class=file "$(cat "sites_${round}.id")"
+    dx-jobutil-add-output refined_assembly --class=file "$(cat "refined_${round}.id")"
+    if [ "${#round_min_coverage[@]}" -gt 0 ]; then
+        for round in $(seq 1 ${#round_min_coverage[@]}); do
+            dx-jobutil-add-output round_vcfs --array --class=file "$(cat "sites_${round}.id")"
+            dx-jobutil-add-output round_assemblies --array --class=file "$(cat "refined_${round}.id")"
+        done
+    fi
+
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-assembly-refinement job_input.json job_output.json
+    fi
+}
 
-    dxid="$(pigz -dc sites.vcf.gz | dx upload --destination "${name}.refinement.vcf" --brief -)"
-    dx-jobutil-add-output assembly_sites_vcf --class=file "$dxid"
-    dxid="$(dx upload refined_assembly.fasta --destination "${name}.refined.fasta" --brief)"
-    dx-jobutil-add-output refined_assembly --class=file "$dxid"
+# Upload a round's VCF and assembly, noting their IDs in sites_N.id and
+# refined_N.id
+upload_round() {
+    round=$1
+    out_prefix=$2
+    pigz -dc "sites_${round}.vcf.gz" | dx upload --destination "${out_prefix}.refinement.vcf" --brief - > "sites_${round}.id"
+    dx upload "refined_${round}.fasta" --destination "${out_prefix}.refined.fasta" --brief > "refined_${round}.id"
 }
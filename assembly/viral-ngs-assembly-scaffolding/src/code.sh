@@ -3,8 +3,13 @@
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-assembly-scaffolding job_input.json; then
+        exit 0
+    fi
+
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
     dx download "$trinity_contigs" -o trinity_contigs.fasta & pids+=($!)
     dx download "$reference_genome" -o reference_genome.fasta & pids+=($!)
     dx download "$trinity_reads" -o reads.bam
@@ -47,6 +52,10 @@ main() {
     dx-jobutil-add-output modified_scaffold --class=file "$dxid"
     dxid=$(dx upload intermediate_scaffold.fasta --destination "${name}.mummer.fasta" --brief)
     dx-jobutil-add-output intermediate_scaffold --class=file "$dxid"
+
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-assembly-scaffolding job_input.json job_output.json
+    fi
 }
 
 first_fasta_header() {
@@ -0,0 +1 @@
+../../../../../../common/bam_stats.py
\ No newline at end of file
@@ -3,27 +3,50 @@
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-filter job_input.json; then
+        exit 0
+    fi
+
+    if [ -z "$targets" ] && [ -z "$targets_db" ]; then
+        dx-jobutil-report-error "Missing the filter targets. Provide either targets or targets_db." AppError
+        exit 1
+    fi
+
     # stage the inputs
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
-    dx download "$targets" -o targets.fasta & pids+=($!)
-    dx download "$reads" -o reads.bam
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
+    dx download "$reads" -o reads.bam & pids+=($!)
+    if [ -z "$targets_db" ]; then
+        # look for a lastal database prebuilt from the same targets
+        dx download "$targets" -o targets.fasta
+        targets_sha256=$(sha256sum targets.fasta | cut -d " " -f 1)
+        if [ -n "$lastal_db_cache" ]; then
+            targets_db=$(find_lastal_db "$lastal_db_cache" "$targets_sha256")
+        fi
+    fi
+    if [ -n "$targets_db" ]; then
+        dx cat "$targets_db" | tar xzv
+    fi
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
-    # build Lastal target database to working dir with prefix targets.db
-    # taxon_filter.py lastal_build_db [input_fasta] [output_dir] [output_prefix]
-    viral-ngs taxon_filter.py lastal_build_db /user-data/targets.fasta /user-data --outputFilePrefix targets.db
-    ls
-    sha256sum targets.*
+    if [ ! -f targets.db.prj ]; then
+        # build Lastal target database to working dir with prefix targets.db
+        # taxon_filter.py lastal_build_db [input_fasta] [output_dir] [output_prefix]
+        viral-ngs taxon_filter.py lastal_build_db /user-data/targets.fasta /user-data --outputFilePrefix targets.db
+    fi
+    ls -l targets.*
 
     # filter the reads
     viral-ngs taxon_filter.py filter_lastal_bam /user-data/reads.bam /user-data/targets.db /user-data/filtered_reads.bam
 
-    prefiltration_read_count=$(samtools view -c reads.bam)
-    prefiltration_base_count=$(bam_base_count reads.bam)
+    bam_stats.py reads.bam > reads.stats.json
+    prefiltration_read_count=$(jq .read_count reads.stats.json)
+    prefiltration_base_count=$(jq .base_count reads.stats.json)
 
-    filtered_read_count=$(samtools view -c filtered_reads.bam)
-    filtered_base_count=$(bam_base_count filtered_reads.bam)
+    bam_stats.py filtered_reads.bam > filtered_reads.stats.json
+    filtered_read_count=$(jq .read_count filtered_reads.stats.json)
+    filtered_base_count=$(jq .base_count filtered_reads.stats.json)
 
     dx-jobutil-add-output prefiltration_read_count $prefiltration_read_count
     dx-jobutil-add-output prefiltration_base_count $prefiltration_base_count
@@ -31,8 +54,22 @@ main() {
     dx-jobutil-add-output filtered_base_count $filtered_base_count
     dxid=$(dx upload --brief --destination "${reads_prefix}.filtered.bam" filtered_reads.bam)
     dx-jobutil-add-output filtered_reads --class=file "$dxid"
+
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-filter job_input.json job_output.json
+    fi
 }
 
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
+# Print the ID of a lastal database (as published by
+# viral-ngs-lastal-db-builder) in [PROJECT:]FOLDER built from targets with the
+# given sha256, if there is one
+find_lastal_db() {
+    project="$DX_PROJECT_CONTEXT_ID"
+    folder="$1"
+    if [[ "$1" == *:* ]]; then
+        project="${1%%:*}"
+        folder="${1#*:}"
+    fi
+    dx find data --class file --project "$project" --folder "$folder" --property "targets_sha256=$2" --brief \
+        | head -n 1 || true
 }
@@ -0,0 +1 @@
+../../../../../../common/fastq_to_ubam.py
\ No newline at end of file
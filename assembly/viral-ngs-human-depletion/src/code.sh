@@ -1,8 +1,16 @@
 #!/bin/bash
 
+# stage_dbs, deplete_reads and output_subfolder
+source human_depletion.sh
+
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-human-depletion job_input.json; then
+        exit 0
+    fi
+
     # Receive the input reads as either a BAM file or a pair of FASTQs
     filename=$(dx describe "$file" --name)
     if [[ "$filename" == *.bam ]]; then
@@ -17,7 +25,7 @@ main() {
         fi
 
         pids=()
-        dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+        chunked_tarball.py stage "$resources" -C / & pids+=($!)
         dx download "$file" -o input.bam
         for pid in "${pids[@]}"; do wait $pid || exit $?; done
         # TODO: verify BAM is actually unmapped, contains properly paired reads, etc.
@@ -37,19 +45,21 @@ main() {
             exit 1
         fi
 
-        pids=()
-        dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
-        # hack SRA FASTQ read names to make them acceptable to Picard FastqToSam
-        maybe_dxzcat "$file" | sed -r 's/(@SRR[0-9]+\.[0-9]+)\.1/\1/' | pigz -c > reads.fastq.gz & pids+=($!)
-        maybe_dxzcat "$paired_fastq" | sed -r 's/(@SRR[0-9]+\.[0-9]+)\.2/\1/' | pigz -c > reads2.fastq.gz
-        for pid in "${pids[@]}"; do wait $pid || exit $?; done
-
         if [ -z "$sample_name" ]; then
             sample_name="${file_prefix%_1}"
             sample_name="${sample_name%.1}"
         fi
 
-        viral-ngs read_utils.py fastq_to_bam /user-data/reads.fastq.gz /user-data/reads2.fastq.gz /user-data/input.bam --sampleName "$sample_name"
+        # convert the mates to an unmapped BAM as they download, counting
+        # reads and bases on the way (through FIFOs, so that a failed download
+        # fails the job)
+        mkfifo reads1.fifo reads2.fifo
+        pids=()
+        chunked_tarball.py stage "$resources" -C / & pids+=($!)
+        maybe_dxzcat "$file" > reads1.fifo & pids+=($!)
+        maybe_dxzcat "$paired_fastq" > reads2.fifo & pids+=($!)
+        fastq_to_ubam.py reads1.fifo reads2.fifo input.bam --sample-name "$sample_name" > input.stats.json
+        for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
         if [ "$skip_depletion" == "true" ]; then
             dxid=$(dx upload --brief --destination "${sample_name}.unmapped.bam" input.bam)
@@ -61,9 +71,12 @@ main() {
         exit 1
     fi
 
-    # count reads and bases in the input
-    predepletion_read_count=$(samtools view -c input.bam)
-    predepletion_base_count=$(bam_base_count input.bam)
+    # count reads and bases in the input, unless already counted
+    if [ ! -f input.stats.json ]; then
+        bam_stats.py input.bam > input.stats.json
+    fi
+    predepletion_read_count=$(jq .read_count input.stats.json)
+    predepletion_base_count=$(jq .base_count input.stats.json)
 
     dx-jobutil-add-output predepletion_read_count --class=int "$predepletion_read_count"
     dx-jobutil-add-output predepletion_base_count --class=int "$predepletion_base_count"
@@ -76,69 +89,20 @@ main() {
     fi
 
 
-    # stage the databases for BMTagger and BLAST
-    # assumptions: each database is stored in a tarball. If the database name
-    # is X then the tarball is named X.bmtagger_db.tar.gz or X.blastndb.tar.gz.
-    # The tarball contains the database files in the root (NOT in subdirectory
-    # X/). The individual database files have X as their base name, e.g.
-    # X.srprism.amp, X.nin
-    pids=()
-    mkdir bmtagger_db
-    local_bmtagger_dbs=""
-    for tarball in "${bmtagger_dbs[@]}"; do
-        dbname=$(dx describe "$tarball" --name)
-        dbname=${dbname%.bmtagger_db.tar.gz}
-        mkdir "bmtagger_db/${dbname}"
-        local_bmtagger_dbs="${local_bmtagger_dbs} /user-data/bmtagger_db/${dbname}/${dbname}"
-        dx cat "$tarball" | pigz -dc | tar x -C "bmtagger_db/${dbname}" & pids+=($!)
-    done
-
-    mkdir blast_db
-    local_blast_dbs=""
-    for tarball in "${blast_dbs[@]}"; do
-        dbname=$(dx describe "$tarball" --name)
-        dbname=${dbname%.blastndb.tar.gz}
-        mkdir "blast_db/${dbname}"
-        local_blast_dbs="${local_blast_dbs} /user-data/blast_db/${dbname}/${dbname}"
-        dx cat "$tarball" | pigz -dc | tar x -C "blast_db/${dbname}" & pids+=($!)
-    done
-
-    for pid in "${pids[@]}"; do wait $pid || exit $?; done
-    find bmtagger_db -type f
-    find blast_db -type f
-
-    # find 90% memory, for java
-    mem_in_mb=`head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}'`
-
-    # run deplete_human
-    viral-ngs taxon_filter.py deplete_human \
-        --JVMmemory ${mem_in_mb}m --threads `nproc` \
-        /user-data/input.bam /user-data/raw.bam /user-data/bmtagger_depleted.bam \
-        /user-data/rmdup.bam /user-data/cleaned.bam \
-        --bmtaggerDbs $local_bmtagger_dbs --blastDbs $local_blast_dbs
-
-    depleted_read_count=$(samtools view -c cleaned.bam)
-    depleted_base_count=$(bam_base_count cleaned.bam)
+    stage_dbs
+    deplete_reads input.bam .
+
+    bam_stats.py cleaned.bam > cleaned.stats.json
+    depleted_read_count=$(jq .read_count cleaned.stats.json)
+    depleted_base_count=$(jq .base_count cleaned.stats.json)
 
     # upload outputs
     dx-jobutil-add-output depleted_read_count --class=int $depleted_read_count
     dx-jobutil-add-output depleted_base_count --class=int $depleted_base_count
 
-    cleaned_reads_out_folder="out/cleaned_reads"
-    intermediates_out_folder="out/intermediates"
-
-    if [ "$per_sample_output" == "true" ]; then
-        # folder structure for multi-lane outputs uses lane metadata recorded
-        # in BAM property at the end of demux
-        lane=$(dx describe --json "$file" | jq -r .properties.lane)
-        if [ "$lane" == "null" ]; then
-            cleaned_reads_out_folder="out/cleaned_reads/${sample_name}"
-            intermediates_out_folder="out/intermediates/${sample_name}"
-        else
-            cleaned_reads_out_folder="out/cleaned_reads/lane_$lane/${sample_name}"
-            intermediates_out_folder="out/intermediates/lane_$lane/${sample_name}"
-        fi
-    fi
+    sample_folder=$(output_subfolder "$file" "$sample_name")
+    cleaned_reads_out_folder="out/cleaned_reads${sample_folder}"
+    intermediates_out_folder="out/intermediates${sample_folder}"
 
     mkdir -p $cleaned_reads_out_folder
     mkdir -p $intermediates_out_folder
@@ -150,6 +114,10 @@ main() {
     mv cleaned.bam "${cleaned_reads_out_folder}/${sample_name}.cleaned.bam"
 
     dx-upload-all-outputs
+
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-human-depletion job_input.json job_output.json
+    fi
 }
 
 maybe_dxzcat() {
@@ -160,7 +128,3 @@ maybe_dxzcat() {
         dx cat "$1"
     fi
 }
-
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
-}
@@ -0,0 +1 @@
+../../../../../../common/bam_subsample.py
\ No newline at end of file
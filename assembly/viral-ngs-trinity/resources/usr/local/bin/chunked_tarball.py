@@ -0,0 +1 @@
+../../../../../../common/chunked_tarball.py
\ No newline at end of file
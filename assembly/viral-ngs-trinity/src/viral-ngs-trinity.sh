@@ -3,13 +3,34 @@
 main() {
     set -e -x -o pipefail
 
+    # Reuse the outputs of an earlier job on the same inputs, if cached
+    if [ -n "$stage_cache" ] && stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-trinity job_input.json; then
+        exit 0
+    fi
+
     # stage the inputs
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
-    dx download "$reads" -o reads.bam & pids+=($!)
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
+    if [ "$streaming_subsample_factor" -gt 0 ]; then
+        # keep only a reservoir of read pairs from the download stream, leaving
+        # assemble_trinity headroom for the pairs trimming and deduplication drop
+        dx cat "$reads" | bam_subsample.py - reads.bam --pairs $(( subsample * streaming_subsample_factor )) \
+            > reads.subsample.json & pids+=($!)
+    else
+        dx download "$reads" -o reads.bam & pids+=($!)
+    fi
     dx download "$contaminants" -o contaminants.fasta
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
+    if [ -f reads.subsample.json ]; then
+        input_pair_count=$(jq .input_pair_count reads.subsample.json)
+        pair_count=$(jq .pair_count reads.subsample.json)
+        echo "Streamed ${pair_count} of ${input_pair_count} read pairs to disk"
+        if [ "$input_pair_count" -gt "$pair_count" ] && [ "$streaming_subsample_factor" -lt 2 ]; then
+            echo "Warning: with streaming_subsample_factor ${streaming_subsample_factor}, trimming and deduplication may leave Trinity fewer than ${subsample} read pairs" >&2
+        fi
+    fi
+
     ulimit -s unlimited
     exit_code=0
 
@@ -19,9 +40,10 @@ main() {
         --outReads /user-data/subsamp.bam 2> >(tee trinity.stderr.log >&2) || exit_code=$?
 
     # collect figures of merit
-    subsampled_read_count=$(samtools view -c subsamp.bam)
+    bam_stats.py subsamp.bam > subsamp.stats.json
+    subsampled_read_count=$(jq .read_count subsamp.stats.json)
     subsampled_read_pair_count=$(( subsampled_read_count / 2))
-    subsampled_base_count=$(samtools view subsamp.bam | cut -f10 | tr -d '\n' | wc -c)
+    subsampled_base_count=$(jq .base_count subsamp.stats.json)
 
     # Check for DenovoAssemblyError raised by assemble_trinity
     if [ "$exit_code" -ne "0" ]; then
@@ -40,8 +62,8 @@ main() {
     dx-jobutil-add-output subsampled_base_count --class=int $subsampled_base_count
     dxid=$(dx upload --brief --destination "${reads_prefix}.trinity.fasta" assembly.fasta)
     dx-jobutil-add-output contigs --class=file "$dxid"
-}
 
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
+    if [ -n "$stage_cache" ]; then
+        stage_cache.py store --folder "$stage_cache" --applet viral-ngs-trinity job_input.json job_output.json
+    fi
 }
@@ -0,0 +1,551 @@
+"""
+An in-process stand-in for the parts of dxpy used by build_workflows.py,
+build_resources_tarball.py and validation/assembly_validation.py, so they can
+be run, timed and profiled offline.
+
+install() registers this module as dxpy (with dxpy.api, dxpy.exceptions and
+dxpy.search), backed by a fresh in-memory Platform, and returns the platform;
+import the scripts after that:
+
+    platform = mock_dxpy.install(latency=0.05)
+    import build_workflows
+    platform.patch_dx_build(build_workflows)
+    build_workflows.main(["--project", platform.add_project("bench")])
+    print(platform.api_calls, platform.calls.most_common(5))
+
+Every call that would be an API round trip is counted by route (e.g.
+"applet/run") and sleeps for the platform's latency, which can be set per
+route. Lazily described handler attributes (applet.id, analysis.name, ...)
+cost one describe each, as they do with dxpy. Executions are done as soon as
+they're launched; their outputs follow the executables' outputSpecs, with
+new empty files for file outputs, unless the platform's output_factory
+supplies a value.
+"""
+from __future__ import print_function
+import collections
+import fnmatch
+import io
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+_platform = None
+
+class Platform(object):
+    """The objects, executions and call counts of the mock platform.
+
+    latency is the seconds each API call takes: a number, or a dict of route
+    => seconds with "*" as the default. output_factory(execution, spec, stage)
+    may return the value of an execution's output (stage is the workflow
+    stage describe, for analyses), or None for the default.
+    """
+    def __init__(self, latency=0.0, output_factory=None):
+        self.latency = latency if isinstance(latency, dict) else {"*": latency}
+        self.output_factory = output_factory
+        self.objects = {}
+        self.projects = {}
+        self.calls = collections.Counter()
+        self.nonces = {}
+        self._lock = threading.RLock()
+        self._serial = 0
+        self._clock = 1500000000000
+
+    @property
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def call(self, route):
+        with self._lock:
+            self.calls[route] += 1
+        delay = self.latency.get(route, self.latency.get("*", 0.0))
+        if delay:
+            time.sleep(delay)
+
+    def new_id(self, cls):
+        with self._lock:
+            self._serial += 1
+            return "{}-{:024X}".format(cls, self._serial)
+
+    def _now(self):
+        with self._lock:
+            self._clock += 1000
+            return self._clock
+
+    # setting up and querying the platform's contents directly, uncounted
+
+    def add_project(self, name, project_id=None):
+        project_id = project_id or self.new_id("project")
+        self.projects[project_id] = {"id": project_id, "class": "project", "name": name, "folders": set(["/"])}
+        return project_id
+
+    def add_folder(self, project, folder):
+        folders = self.projects[project]["folders"]
+        while folder not in folders:
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+
+    def add_object(self, cls, project, folder="/", name=None, properties=None, object_id=None, **fields):
+        object_id = object_id or self.new_id(cls)
+        if project not in self.projects:
+            self.add_project(project, project)
+        self.add_folder(project, folder)
+        now = self._now()
+        desc = {"id": object_id, "class": cls, "project": project, "folder": folder, "name": name or object_id,
+                "state": "closed", "properties": dict(properties or {}), "tags": [], "types": [], "hidden": False,
+                "created": now, "modified": now}
+        desc.update(fields)
+        with self._lock:
+            self.objects[object_id] = desc
+        return object_id
+
+    def add_file(self, project, folder, name, content=b"", properties=None, object_id=None):
+        return self.add_object("file", project, folder, name, properties, object_id, size=len(content), content=content)
+
+    def add_applet(self, project, folder, dxapp, properties=None, object_id=None):
+        spec = dict((k, v) for k, v in dxapp.items() if k not in ("name", "project", "folder", "properties"))
+        return self.add_object("applet", project, folder, dxapp["name"], properties, object_id, **spec)
+
+    def dx_build(self, applet_dir, destination, overwrite=False, archive=False):
+        """Stand-in for `dx build --destination PROJECT:FOLDER/ applet_dir`;
+        returns the new applet's ID. Like dx build, fails if FOLDER already
+        holds an applet of the same name, unless overwrite (-f) removes it or
+        archive (-a) moves it to /.Applet_archive"""
+        project, folder = destination.split(":", 1)
+        folder = folder.rstrip("/") or "/"
+        with open(os.path.join(applet_dir, "dxapp.json")) as infile:
+            dxapp = json.load(infile)
+        self.call("system/findDataObjects")
+        with self._lock:
+            existing = self.find("applet", dxapp["name"], project=project, folder=folder, recurse=False)
+            if existing and not (overwrite or archive):
+                raise exceptions.DXError(
+                    "An applet already exists at {}:{}/{} (id {}) and neither --overwrite (-f) nor --archive (-a) "
+                    "were given".format(project, folder.rstrip("/"), dxapp["name"], existing[0]["id"]))
+            for desc in existing:
+                if overwrite:
+                    del self.objects[desc["id"]]
+                else:
+                    self.add_folder(project, "/.Applet_archive")
+                    desc["folder"] = "/.Applet_archive"
+        if existing:
+            self.call("project/removeObjects" if overwrite else "project/move")
+        self.call("applet/new")
+        return self.add_applet(project, folder, dxapp)
+
+    def run_dx_build(self, argv):
+        """dx_build() given the argv of a `dx build` command"""
+        kwargs = {}
+        applet_dir = destination = None
+        argv = list(argv[2:] if argv[:2] == ["dx", "build"] else argv)
+        while argv:
+            arg = argv.pop(0)
+            if arg in ("-f", "--overwrite"):
+                kwargs["overwrite"] = True
+            elif arg in ("-a", "--archive"):
+                kwargs["archive"] = True
+            elif arg in ("-d", "--destination"):
+                destination = argv.pop(0)
+            elif arg.startswith("-"):
+                raise ValueError("dx build option {} not supported".format(arg))
+            else:
+                applet_dir = arg
+        return self.dx_build(applet_dir, destination, **kwargs)
+
+    def patch_dx_build(self, build_workflows):
+        """Have build_workflows' dx builds run against this platform"""
+        build_workflows.dx_build = lambda applet, destination: self.run_dx_build(
+            build_workflows.dx_build_command(applet, destination))
+
+    def describe(self, object_id):
+        try:
+            return self.objects[object_id]
+        except KeyError:
+            raise exceptions.ResourceNotFound("{} not found".format(object_id))
+
+    def find(self, cls=None, name=None, name_mode="exact", properties=None, project=None, folder=None,
+             recurse=True, state=None, ids=None):
+        matches = []
+        for desc in sorted(self.objects.values(), key=lambda desc: desc["id"]):
+            if cls is not None and desc["class"] != cls:
+                continue
+            if ids is not None and desc["id"] not in ids:
+                continue
+            if project is not None and desc["project"] != project:
+                continue
+            if folder is not None:
+                if recurse and not (desc["folder"] == folder or desc["folder"].startswith(folder.rstrip("/") + "/")):
+                    continue
+                if not recurse and desc["folder"] != folder:
+                    continue
+            if name is not None:
+                if name_mode == "glob" and not fnmatch.fnmatchcase(desc["name"], name):
+                    continue
+                if name_mode != "glob" and desc["name"] != name:
+                    continue
+            if state is not None and desc["state"] != state:
+                continue
+            if properties and any(desc["properties"].get(k) != v for k, v in properties.items()):
+                continue
+            matches.append(desc)
+        return matches
+
+    # executions
+
+    def _output_value(self, execution, spec, stage=None):
+        value = self.output_factory(execution, spec, stage) if self.output_factory else None
+        if value is not None:
+            return value
+        cls = spec["class"]
+        if cls.startswith("array:"):
+            return [self._output_value(execution, dict(spec, **{"class": cls[len("array:"):]}), stage)]
+        if cls == "file":
+            return dxlink(self.add_file(execution["project"], execution["folder"], spec["name"]))
+        return {"int": 0, "float": 0.0, "boolean": False, "string": "", "hash": {}}.get(cls)
+
+    def run_executable(self, cls, executable, executable_input, project, folder, name, stages=None):
+        execution = {"id": self.new_id(cls), "class": cls, "name": name or executable["name"],
+                     "executable": executable["id"], "executableName": executable["name"],
+                     "project": project, "folder": folder or "/", "input": executable_input,
+                     "state": "done", "totalPrice": 0, "created": self._now(), "output": {}}
+        if cls == "analysis":
+            execution["workflow"] = executable["id"]
+            for stage in stages:
+                stage_executable = self.describe(get_dxlink_ids(stage["executable"])[0])
+                for spec in stage_executable.get("outputSpec", []):
+                    execution["output"][stage["id"] + "." + spec["name"]] = self._output_value(execution, spec, stage)
+        else:
+            for spec in executable.get("outputSpec", []):
+                execution["output"][spec["name"]] = self._output_value(execution, spec)
+        with self._lock:
+            self.objects[execution["id"]] = execution
+        return execution["id"]
+
+def install(latency=0.0, output_factory=None):
+    """Register this module as dxpy, backed by a new Platform; returns it"""
+    global _platform
+    _platform = Platform(latency, output_factory)
+    module = sys.modules[__name__]
+    sys.modules["dxpy"] = module
+    sys.modules["dxpy.api"] = api
+    sys.modules["dxpy.exceptions"] = exceptions
+    sys.modules["dxpy.search"] = search
+    return _platform
+
+###############################################################################
+# dxpy.exceptions
+###############################################################################
+
+exceptions = types.ModuleType("dxpy.exceptions")
+
+class DXError(Exception):
+    pass
+
+class DXAPIError(DXError):
+    def __init__(self, name, message, code=400):
+        DXError.__init__(self, "{}: {}".format(name, message))
+        self.name = name
+        self.msg = message
+        self.code = code
+
+class ResourceNotFound(DXAPIError):
+    def __init__(self, message):
+        DXAPIError.__init__(self, "ResourceNotFound", message, 404)
+
+class DXSearchError(DXError):
+    pass
+
+class DXJobFailureError(DXError):
+    pass
+
+for _cls in (DXError, DXAPIError, ResourceNotFound, DXSearchError, DXJobFailureError):
+    setattr(exceptions, _cls.__name__, _cls)
+
+###############################################################################
+# links and handlers
+###############################################################################
+
+def is_dxlink(value):
+    return isinstance(value, dict) and "$dnanexus_link" in value
+
+def dxlink(object_id, project_id=None, field=None):
+    if is_dxlink(object_id):
+        return object_id
+    if isinstance(object_id, DXObject):
+        object_id = object_id.get_id()
+    if field is not None:
+        return {"$dnanexus_link": {"job": object_id, "field": field}}
+    if project_id is not None:
+        return {"$dnanexus_link": {"project": project_id, "id": object_id}}
+    return {"$dnanexus_link": object_id}
+
+def get_dxlink_ids(link):
+    value = link["$dnanexus_link"]
+    if isinstance(value, dict):
+        return value["id"], value.get("project")
+    return value, None
+
+class DXObject(object):
+    """A handler; unknown attributes come from its (cached) describe"""
+    _route = None
+
+    def __init__(self, dxid=None, project=None):
+        if is_dxlink(dxid):
+            dxid, project = get_dxlink_ids(dxid)
+        self._dxid = dxid
+        self._proj = project
+        self._desc = None
+
+    def get_id(self):
+        return self._dxid
+
+    def get_proj_id(self):
+        return self._proj
+
+    def describe(self, **kwargs):
+        _platform.call(self._route + "/describe")
+        self._desc = dict((k, v) for k, v in _platform.describe(self._dxid).items() if k != "content")
+        return self._desc
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        if self._desc is None:
+            self.describe()
+        try:
+            return self._desc[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+class DXProject(DXObject):
+    _route = "project"
+
+    def describe(self, **kwargs):
+        _platform.call("project/describe")
+        project = _platform.projects[self._dxid]
+        self._desc = dict((k, v) for k, v in project.items() if k != "folders")
+        return self._desc
+
+    def new_folder(self, folder, parents=False):
+        _platform.call("project/newFolder")
+        _platform.add_folder(self._dxid, folder)
+
+class DXDataObject(DXObject):
+    def get_properties(self):
+        return self.describe()["properties"]
+
+    def set_properties(self, properties):
+        _platform.call(self._route + "/setProperties")
+        desc = _platform.describe(self._dxid)
+        for key, value in properties.items():
+            if value is None:
+                desc["properties"].pop(key, None)
+            else:
+                desc["properties"][key] = value
+        self._desc = None
+
+    def close(self):
+        _platform.call(self._route + "/close")
+        _platform.describe(self._dxid)["state"] = "closed"
+
+class DXFile(DXDataObject):
+    _route = "file"
+
+class DXRecord(DXDataObject):
+    _route = "record"
+
+    def get_details(self):
+        _platform.call("record/getDetails")
+        return json.loads(json.dumps(_platform.describe(self._dxid).get("details", {})))
+
+    def set_details(self, details):
+        _platform.call("record/setDetails")
+        _platform.describe(self._dxid)["details"] = json.loads(json.dumps(details))
+
+class DXExecution(DXObject):
+    def get_output_ref(self, field, index=None):
+        link = {self._route: self._dxid, "field": field}
+        if index is not None:
+            link["index"] = index
+        return {"$dnanexus_link": link}
+
+class DXJob(DXExecution):
+    _route = "job"
+
+class DXAnalysis(DXExecution):
+    _route = "analysis"
+
+class DXApplet(DXDataObject):
+    _route = "applet"
+
+    def run(self, applet_input, project=None, folder=None, name=None, extra_args=None, **kwargs):
+        _platform.call("applet/run")
+        # like the API, return the job already run with the same nonce
+        nonce = (extra_args or {}).get("nonce")
+        with _platform._lock:
+            if nonce in _platform.nonces:
+                return DXJob(_platform.nonces[nonce])
+            desc = _platform.describe(self._dxid)
+            job_id = _platform.run_executable("job", desc, applet_input, project or desc["project"], folder, name)
+            if nonce is not None:
+                _platform.nonces[nonce] = job_id
+        return DXJob(job_id)
+
+class DXWorkflow(DXDataObject):
+    _route = "workflow"
+
+    def add_stage(self, executable, stage_id=None, name=None, folder=None, stage_input=None, instance_type=None, **kwargs):
+        _platform.call("workflow/addStage")
+        stage = {"id": stage_id or _platform.new_id("stage"), "name": name, "folder": folder,
+                 "executable": dxlink(executable), "input": stage_input or {}}
+        desc = _platform.describe(self._dxid)
+        desc["stages"].append(stage)
+        desc["editVersion"] += 1
+        return stage["id"]
+
+    def get_stage(self, stage):
+        for desc in self.describe()["stages"]:
+            if stage in (desc["id"], desc["name"]):
+                return desc
+        raise DXError("stage {} not found".format(stage))
+
+    def run(self, workflow_input, project=None, folder=None, name=None, **kwargs):
+        _platform.call("workflow/run")
+        desc = _platform.describe(self._dxid)
+        return DXAnalysis(_platform.run_executable("analysis", desc, workflow_input, project or desc["project"],
+                                                   folder, name, desc["stages"]))
+
+def new_dxworkflow(title=None, name=None, description=None, project=None, folder="/", properties=None, **kwargs):
+    _platform.call("workflow/new")
+    workflow_id = _platform.add_object("workflow", project, folder or "/", name, properties, title=title,
+                                       description=description, stages=[], editVersion=0)
+    return DXWorkflow(workflow_id, project)
+
+def new_dxrecord(project=None, folder="/", name=None, details=None, properties=None, close=False, **kwargs):
+    _platform.call("record/new")
+    record_id = _platform.add_object("record", project, folder or "/", name, properties, details=details or {})
+    _platform.describe(record_id)["state"] = "closed" if close else "open"
+    return DXRecord(record_id, project)
+
+_handlers = {"project": DXProject, "file": DXFile, "record": DXRecord, "applet": DXApplet,
+             "workflow": DXWorkflow, "job": DXJob, "analysis": DXAnalysis}
+
+def get_handler(dxid, project=None):
+    return _handlers[dxid.split("-", 1)[0]](dxid, project)
+
+###############################################################################
+# files
+###############################################################################
+
+class _DXFileReader(io.BytesIO):
+    def __init__(self, content):
+        io.BytesIO.__init__(self, content)
+
+def open_dxfile(dxid, project=None, mode=None, **kwargs):
+    if is_dxlink(dxid):
+        dxid, project = get_dxlink_ids(dxid)
+    _platform.call("file/describe")
+    _platform.call("file/download")
+    return _DXFileReader(_platform.describe(dxid)["content"])
+
+def download_dxfile(dxid, filename, project=None, **kwargs):
+    with open_dxfile(dxid, project) as infile, open(filename, "wb") as outfile:
+        outfile.write(infile.read())
+
+###############################################################################
+# searches
+###############################################################################
+
+FIND_PAGE_SIZE = 1000
+
+def _find_result(desc, describe):
+    result = {"project": desc["project"], "id": desc["id"]}
+    if describe:
+        result["describe"] = dict((k, v) for k, v in desc.items() if k != "content")
+    return result
+
+def find_data_objects(classname=None, state=None, name=None, name_mode="exact", properties=None, project=None,
+                      folder=None, recurse=True, describe=False, return_handler=False, **kwargs):
+    matches = _platform.find(classname, name, name_mode, properties, project, folder, recurse, state)
+    for i, desc in enumerate(matches):
+        if i % FIND_PAGE_SIZE == 0:
+            _platform.call("system/findDataObjects")
+        if return_handler:
+            yield get_handler(desc["id"], desc["project"])
+        else:
+            yield _find_result(desc, describe)
+    if not matches:
+        _platform.call("system/findDataObjects")
+
+def find_one_data_object(zero_ok=False, more_ok=True, return_handler=False, **kwargs):
+    matches = list(find_data_objects(**kwargs))
+    if not matches:
+        if zero_ok:
+            return None
+        raise DXSearchError("Expected one result, but found none: {}".format(kwargs))
+    if len(matches) > 1 and not more_ok:
+        raise DXSearchError("Expected one result, but found more: {}".format(kwargs))
+    if return_handler:
+        return get_handler(matches[0]["id"], matches[0]["project"])
+    return matches[0]
+
+def find_one_app(**kwargs):
+    _platform.call("system/findApps")
+    if kwargs.get("zero_ok"):
+        return None
+    raise DXSearchError("Expected one app, but found none: {}".format(kwargs))
+
+search = types.ModuleType("dxpy.search")
+search.find_data_objects = find_data_objects
+search.find_one_data_object = find_one_data_object
+search.find_one_app = find_one_app
+
+###############################################################################
+# dxpy.api: the raw routes the scripts call
+###############################################################################
+
+def _page(route, results, query):
+    _platform.call(route)
+    start = int(query.get("starting") or 0)
+    end = start + FIND_PAGE_SIZE
+    return {"results": results[start:end], "next": end if end < len(results) else None}
+
+def system_find_data_objects(query, **kwargs):
+    scope = query.get("scope", {})
+    matches = _platform.find(query.get("class"), query.get("name"), "exact", query.get("properties"),
+                             scope.get("project"), scope.get("folder"), scope.get("recurse", True), query.get("state"))
+    return _page("system/findDataObjects", [_find_result(desc, query.get("describe")) for desc in matches], query)
+
+def system_find_executions(query, **kwargs):
+    ids = query.get("id")
+    matches = [desc for desc in _platform.find(ids=set(ids) if ids is not None else None, project=query.get("project"))
+               if desc["class"] in ("job", "analysis")]
+    return _page("system/findExecutions", [_find_result(desc, query.get("describe")) for desc in matches], query)
+
+def system_describe_data_objects(query, **kwargs):
+    _platform.call("system/describeDataObjects")
+    results = []
+    for obj in query["objects"]:
+        try:
+            results.append({"describe": _find_result(_platform.describe(obj["id"]), True)["describe"]})
+        except ResourceNotFound:
+            results.append({})
+    return {"results": results}
+
+def applet_new(applet_input, **kwargs):
+    _platform.call("applet/new")
+    applet_id = _platform.add_applet(applet_input["project"], applet_input.get("folder", "/"), applet_input,
+                                     applet_input.get("properties"))
+    return {"id": applet_id}
+
+def project_new_folder(project, query, **kwargs):
+    _platform.call("project/newFolder")
+    _platform.add_folder(project, query["folder"])
+    return {"id": project}
+
+api = types.ModuleType("dxpy.api")
+for _func in (system_find_data_objects, system_find_executions, system_describe_data_objects, applet_new,
+              project_new_folder):
+    setattr(api, _func.__name__, _func)
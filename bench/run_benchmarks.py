@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Benchmark the build, test and validation scripts offline, against the
+in-memory platform of mock_dxpy.py, reporting the wall time and the number
+of API calls of each scenario:
+
+    build_cold              build_workflows.py, every applet dx built
+    build_warm              build_workflows.py again, every applet cached
+    build_forced            build_workflows.py --force-rebuild, every applet
+                            dx built over its cached build
+    resources_tarball       build_resources_tarball.py running the builder
+    test_launch N           build_workflows.py's tests on N assembly samples
+    validation_launch N     assembly_validation.py launch on N samples
+    validation_postmortem N assembly_validation.py postmortem of that run
+
+    bench/run_benchmarks.py --latency 0.02 --sizes 10,100,1000 --json bench.json
+    bench/run_benchmarks.py --latency 0.02 --baseline bench.json
+
+Each simulated API call sleeps for --latency seconds, so with a realistic
+latency the times track the round trips the scripts make in sequence. With
+--baseline, exits with status 1 if any scenario makes more API calls than
+in the baseline, or takes more than --tolerance longer. Compare runs with the
+same --latency and --jobs: concurrent builds can race to describe a shared
+applet handler, so their call counts vary a little with both.
+
+The simulated executions finish as soon as they're launched, with outputs
+that pass the tests' and postmortem's checks: each test sample's final
+assembly is made up, and its expected sha256 set to match.
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+sys.path[:0] = [here, repo, os.path.join(repo, "validation")]
+
+import mock_dxpy
+
+MUSCLE_APPLET = "applet-BXQxjv00QyB9QF3vP4BpXg95"
+BI_PROJECT = "project-BXz7QkQ0K7jf8bQ74GzG9gvY"
+
+def test_assembly(sample):
+    """The made-up final assembly of a test sample"""
+    return ">{}\n{}\n".format(sample, ("ACGT" * 20 + "\n") * 10)
+
+def alignment(sample):
+    """The made-up MUSCLE alignment of a validation sample"""
+    seq = "ACGT" * 250
+    return ">{}.bi\n{}\n>{}.dx\n{}\n".format(sample, seq, sample, seq[:-1] + "N")
+
+def output_factory(platform):
+    def factory(execution, spec, stage):
+        name = execution["name"]
+        if execution["class"] == "job" and spec["name"] == "alignment":
+            return mock_dxpy.dxlink(platform.add_file(execution["project"], execution["folder"], "alignment.fasta",
+                                                      alignment(name)))
+        if stage is None or not name.endswith("-Assembly"):
+            return None
+        sample = name.split(" ")[-1][:-len("-Assembly")]
+        if (stage["name"], spec["name"]) == ("trinity", "subsampled_base_count"):
+            return 1000
+        if (stage["name"], spec["name"]) == ("analysis", "alignment_base_count"):
+            return 2000
+        if (stage["name"], spec["name"]) == ("analysis", "final_assembly"):
+            return mock_dxpy.dxlink(platform.add_file(execution["project"], execution["folder"], "final_assembly.fasta",
+                                                      test_assembly(sample)))
+        return None
+    return factory
+
+def synthetic_test_samples(count):
+    samples = {}
+    for i in range(count):
+        sample = "BENCH{:04d}".format(i)
+        assembly = "".join(line + "\n" for line in test_assembly(sample).splitlines() if not line.startswith(">"))
+        samples[sample] = {
+            "species": "Ebola",
+            "reads": "file-BXPPQ2Q0YzB28x9Q9911Ykz5",
+            "reads2": "file-BXPPQ380YzB6xGxJ45K9Yv6Q",
+            "broad_assembly": "file-BXQx6G00QyB6PQVYKQBgzxv4",
+            "expected_assembly_sha256sum": hashlib.sha256(assembly).hexdigest(),
+            "expected_subsampled_base_count": 1000,
+            "expected_alignment_base_count": 2000
+        }
+    return samples
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """Send the scripts' stdout to /dev/null"""
+    if verbose:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per simulated API call (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=8, help="build_workflows.py --jobs (default: %(default)s)")
+    parser.add_argument("--sizes", default="10,100,1000", help="Sample counts to test and validate (default: %(default)s)")
+    parser.add_argument("--routes", action="store_true", help="Also report the API calls of each scenario by route")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare with the results in FILE, from --json")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Slowdown over the baseline tolerated, as a fraction (default: %(default)s)")
+    parser.add_argument("--verbose", action="store_true", help="Show the scripts' output")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    # build_workflows.py takes its git revision from the working directory
+    os.chdir(repo)
+
+    platform = mock_dxpy.install(latency=args.latency)
+    platform.output_factory = output_factory(platform)
+    import build_workflows
+    import build_resources_tarball
+    import assembly_validation
+    platform.patch_dx_build(build_workflows)
+
+    project = platform.add_project("bench")
+    platform.add_project("bench-validation", "project-BX6FjJ00QyB3X12J59PVYZ1V")
+    platform.add_applet(project, "/", {
+        "name": "muscle", "outputSpec": [{"name": "alignment", "class": "file"}]}, object_id=MUSCLE_APPLET)
+    platform.add_project("EBOV validation data", BI_PROJECT)
+    for i in range(max(sizes)):
+        sample = "EBOV{:04d}".format(i)
+        platform.add_file(BI_PROJECT, "/data/01_per_sample", sample + ".raw.bam")
+        platform.add_file(BI_PROJECT, "/data/02_assembly", sample + ".fasta")
+    platform.dx_build(os.path.join(repo, "util/viral-ngs-builder"), project + ":/resources_tarball/")
+
+    results = []
+    def scenario(name, samples, func, *func_args):
+        platform.calls.clear()
+        start = time.time()
+        with quiet(args.verbose):
+            value = func(*func_args)
+        result = {"scenario": name, "samples": samples, "seconds": round(time.time() - start, 3),
+                  "api_calls": platform.api_calls, "routes": dict(platform.calls)}
+        results.append(result)
+        print("\t".join([name, str(samples or "-"), "{:.3f}".format(result["seconds"]), str(result["api_calls"])]))
+        if args.routes:
+            for route, count in platform.calls.most_common():
+                print("\t\t{}\t{}".format(route, count))
+        sys.stdout.flush()
+        return value
+
+    print("\t".join(["scenario", "samples", "seconds", "api_calls"]))
+    build_args = ["--project", project, "--jobs", str(args.jobs)]
+    scenario("build_cold", None, build_workflows.main, build_args + ["--folder", "/bench/cold"])
+    workflows = scenario("build_warm", None, build_workflows.main, build_args + ["--folder", "/bench/warm"])
+    scenario("build_forced", None, build_workflows.main, build_args + ["--folder", "/bench/forced", "--force-rebuild"])
+    scenario("resources_tarball", None, build_resources_tarball.main,
+             ["--project", project, "--reuse-builder", "@sha256:bench"])
+
+    assembly_workflows = dict((species, workflows[species]) for species in build_workflows.assembly_workflow_resources)
+    for size in sizes:
+        build_workflows.test_samples = synthetic_test_samples(size)
+        build_workflows.args.folder = "/bench/tests{}".format(size)
+        scenario("test_launch", size, build_workflows.run_tests, assembly_workflows, workflows["demux-plus"])
+
+    for size in sizes:
+        record_id = scenario("validation_launch", size, assembly_validation.main,
+                             ["launch", workflows["Ebola"].get_id(), "--project", project,
+                              "--folder", "/bench/validation{}".format(size), "--limit", str(size)])
+        scenario("validation_postmortem", size, assembly_validation.main, ["postmortem", record_id, "--project", project])
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = dict(((r["scenario"], r["samples"]), r) for r in json.load(infile))
+        regressions = []
+        for result in results:
+            before = baseline.get((result["scenario"], result["samples"]))
+            if before is None:
+                continue
+            if result["api_calls"] > before["api_calls"]:
+                regressions.append("{} {}: {} API calls, up from {}".format(
+                    result["scenario"], result["samples"] or "-", result["api_calls"], before["api_calls"]))
+            if result["seconds"] > before["seconds"] * (1 + args.tolerance):
+                regressions.append("{} {}: {:.3f}s, up from {:.3f}s".format(
+                    result["scenario"], result["samples"] or "-", result["seconds"], before["seconds"]))
+        for regression in regressions:
+            print("regression: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ import argparse
 import subprocess
 import time
 import os
+import json
+import urllib2
+from execution_tracker import ExecutionTracker
 
 argparser = argparse.ArgumentParser(description="Build the viral-ngs resources tarball on DNAnexus.")
 argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
@@ -12,36 +15,126 @@ argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
 argparser.add_argument("--project", help="DNAnexus project ID", default="project-BXBXK180x0z7x5kxq11p886f")
 argparser.add_argument("--folder", help="Folder within project (default: %(default)s)", default="/resources_tarball")
 argparser.add_argument("--reuse-builder", help="Reuse the existing 'builder' applet instead of recreating it", action="store_true")
-argparser.add_argument("version", help="Desired version of broadinstitute/viral-ngs image on Docker Hub, either :TAG or @DIGEST")
-args = argparser.parse_args()
-
-project = dxpy.DXProject(args.project)
-print "project: {} ({})".format(project.name, args.project)
-project.new_folder(args.folder, parents=True)
-print "folder: {}".format(args.folder)
-
-# TODO: memoization scheme?
-
-if args.reuse_builder is not True:
-    subprocess.check_call(["dx","build","-f","--destination",args.project+":"+args.folder+"/",
-                           os.path.join(os.path.dirname(sys.argv[0]),"util/viral-ngs-builder")])
-
-builder = dxpy.find_one_data_object(classname='applet', name="viral-ngs-builder",
-                                     project=args.project, folder=args.folder,
-                                     zero_ok=False, more_ok=False, return_handler=True)
-
-builder_input = {
-    "viral_ngs_version": args.version
-}
-job = builder.run(builder_input, project=args.project, folder=args.folder, name=("viral-ngs-builder " + args.version))
-print "Waiting for builder job: {}".format(job.get_id())
-
-# wait for job to finish, while making noise to work around Travis 10m inactivity timeout
-noise = subprocess.Popen(["/bin/bash", "-c", "while true; do date; sleep 60; done"])
-try:
-    job.wait_on_done()
-finally:
-    noise.kill()
-
-id, _ = dxpy.get_dxlink_ids(job.describe()["output"]["resources"])
-print id
+argparser.add_argument("--rebuild", help="Run the builder even if a tarball for this version/digest already exists", action="store_true")
+argparser.add_argument("--list", help="List the tarballs already built in the folder, and which applets' dxapp.json use them as defaults", action="store_true")
+argparser.add_argument("version", nargs="?", help="Desired version of broadinstitute/viral-ngs image on Docker Hub, either :TAG or @DIGEST")
+
+here = os.path.dirname(__file__)
+
+# set up by main()
+args = None
+
+def resolve_image_digest(version):
+    """Resolve :TAG or @DIGEST to the image manifest digest on Docker Hub.
+
+    Returns None if the registry can't be reached, in which case tarballs can
+    only be matched by the requested version string.
+    """
+    if version.startswith("@"):
+        return version[1:]
+    tag = version[1:] if version.startswith(":") else "latest"
+    repository = "broadinstitute/viral-ngs"
+    try:
+        token = json.load(urllib2.urlopen("https://auth.docker.io/token?service=registry.docker.io&scope=repository:{}:pull".format(repository)))["token"]
+        request = urllib2.Request("https://registry-1.docker.io/v2/{}/manifests/{}".format(repository, tag),
+                                  headers={"Authorization": "Bearer " + token,
+                                           "Accept": "application/vnd.docker.distribution.manifest.v2+json"})
+        request.get_method = lambda: "HEAD"
+        return urllib2.urlopen(request).info().getheader("Docker-Content-Digest")
+    except (urllib2.URLError, ValueError, KeyError) as e:
+        print "could not resolve image digest for {}: {}".format(version, e)
+        return None
+
+def find_tarballs(properties=None):
+    query = {}
+    if properties is not None:
+        query["properties"] = properties
+    tarballs = dxpy.find_data_objects(classname="file", state="closed", project=args.project, folder=args.folder,
+                                      name="viral-ngs-*.resources.tar.gz", name_mode="glob",
+                                      describe={"properties": True}, **query)
+    return sorted((t["describe"] for t in tarballs), key=lambda desc: desc["created"], reverse=True)
+
+def find_cached_tarball(version, digest):
+    # a tag can move to a new image, so when we know the digest, that's the
+    # only thing we match on
+    if digest is not None:
+        matches = find_tarballs({"image_digest": digest})
+    else:
+        matches = find_tarballs({"viral_ngs_version": version})
+    return matches[0] if matches else None
+
+def dxapp_resources_defaults():
+    """Map file ID => dxapp.json paths in this repo using it as the resources default"""
+    defaults = {}
+    for dirpath, dirnames, filenames in os.walk(here or "."):
+        if "dxapp.json" in filenames:
+            dxapp_path = os.path.join(dirpath, "dxapp.json")
+            for input_spec in json.load(open(dxapp_path))["inputSpec"]:
+                if input_spec["name"] == "resources" and "default" in input_spec:
+                    file_id, _ = dxpy.get_dxlink_ids(input_spec["default"])
+                    defaults.setdefault(file_id, []).append(os.path.relpath(dxapp_path, here or "."))
+    return defaults
+
+def main(argv=None):
+    global args
+    args = argparser.parse_args(argv)
+
+    if not args.list and args.version is None:
+        argparser.error("version is required (unless --list)")
+
+    project = dxpy.DXProject(args.project)
+    print "project: {} ({})".format(project.name, args.project)
+    print "folder: {}".format(args.folder)
+
+    if args.list:
+        defaults = dxapp_resources_defaults()
+        for desc in find_tarballs():
+            print "\t".join([desc["id"], desc["name"], time.strftime("%Y-%m-%d %H:%M", time.localtime(desc["created"]/1000)),
+                             desc["properties"].get("viral_ngs_version", "-"), desc["properties"].get("image_digest", "-"),
+                             ",".join(sorted(defaults.pop(desc["id"], []))) or "-"])
+        for file_id, dxapp_paths in sorted(defaults.iteritems()):
+            print "\t".join([file_id, "(not in {})".format(args.folder), "-", "-", "-", ",".join(sorted(dxapp_paths))])
+        return
+
+    digest = resolve_image_digest(args.version)
+    print "image digest: {}".format(digest)
+
+    if args.rebuild is not True:
+        cached = find_cached_tarball(args.version, digest)
+        if cached is not None:
+            print "Reusing {} built for {}".format(cached["name"], cached["properties"].get("viral_ngs_version"))
+            print cached["id"]
+            return cached["id"]
+
+    project.new_folder(args.folder, parents=True)
+
+    if args.reuse_builder is not True:
+        subprocess.check_call(["dx","build","-f","--destination",args.project+":"+args.folder+"/",
+                               os.path.join(here,"util/viral-ngs-builder")])
+
+    builder = dxpy.find_one_data_object(classname='applet', name="viral-ngs-builder",
+                                         project=args.project, folder=args.folder,
+                                         zero_ok=False, more_ok=False, return_handler=True)
+
+    builder_input = {
+        "viral_ngs_version": args.version
+    }
+    # the builder pulls the image by this digest, not by the tag, which may
+    # have moved to another image since it was resolved
+    if digest is not None:
+        builder_input["image_digest"] = digest
+    job = builder.run(builder_input, project=args.project, folder=args.folder, name=("viral-ngs-builder " + args.version))
+    print "Waiting for builder job: {}".format(job.get_id())
+
+    # wait for job to finish; the tracker's progress lines work around Travis 10m inactivity timeout
+    outputs = {}
+    tracker = ExecutionTracker(project=args.project)
+    tracker.track(job.get_id(), lambda desc: outputs.update(desc["output"]), label="viral-ngs-builder")
+    tracker.wait()
+
+    id, _ = dxpy.get_dxlink_ids(outputs["resources"])
+    print id
+    return id
+
+if __name__ == "__main__":
+    main()
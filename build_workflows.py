@@ -7,6 +7,11 @@ import time
 import os
 import json
 import hashlib
+import functools
+import traceback
+import threading
+from multiprocessing.pool import ThreadPool
+from execution_tracker import ExecutionTracker
 
 argparser = argparse.ArgumentParser(description="Build the viral-ngs assembly workflow on DNAnexus.")
 argparser.add_argument("--project", help="DNAnexus project ID", default="project-BXBXK180x0z7x5kxq11p886f")
@@ -16,68 +21,236 @@ argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
                                  default="file-By20P600jy1JY9q634Yq5PQQ")
 argparser.add_argument("--run-tests", help="run small test assemblies", action="store_true")
 argparser.add_argument("--run-large-tests", help="run test assemblies of varying sizes", action="store_true")
-args = argparser.parse_args()
-
-# detect git revision
-here = os.path.dirname(sys.argv[0])
-git_revision = subprocess.check_output(["git", "describe", "--always", "--dirty", "--tags"]).strip()
-
-if args.folder is None:
-    args.folder = time.strftime("/%Y-%m/%d-%H%M%S-") + git_revision
-
-project = dxpy.DXProject(args.project)
-applets_folder = args.folder + "/applets"
-print "project: {} ({})".format(project.name, args.project)
-print "folder: {}".format(args.folder)
+argparser.add_argument("--jobs", metavar="N", type=int, default=1,
+                                 help="Build up to N applets/workflows concurrently (default: %(default)s)")
+argparser.add_argument("--applet-cache-folder", help="Folder within project holding previously built applets, looked up by source hash (default: %(default)s)",
+                                                default="/applet_cache")
+argparser.add_argument("--force-rebuild", help="dx build every applet even if one with matching source is cached", action="store_true")
+argparser.add_argument("--fused-refinement", help="run both assembly refinement rounds in a single refine stage, instead of refine1 and refine2", action="store_true")
+argparser.add_argument("--lastal-db-folder", metavar="FOLDER", help="have the filter stages use lastal databases of their targets prebuilt in this folder within project, and launch viral-ngs-lastal-db-builder there for targets without one")
+argparser.add_argument("--stage-cache", metavar="FOLDER", help="have the assembly workflows' stages reuse the outputs of earlier runs on the same inputs, memoized in this [PROJECT:]FOLDER")
+argparser.add_argument("--streaming-subsample-factor", metavar="N", type=int, default=0,
+                       help="have the trinity stages subsample the reads as they download to N times the pairs Trinity assembles, so large inputs needn't reach disk whole (e.g. 4; default: off)")
+
+here = os.path.dirname(__file__)
+
+# set up by main()
+args = None
+git_revision = None
+project = None
+applets_folder = None
+applet_resolver = None
 
 ###############################################################################
 # BUILDING APPLETS
 ###############################################################################
 
+def parallel_map(func, items):
+    """Apply func to each item on a pool of up to args.jobs threads.
+
+    Yields (item, result, error) tuples in the order of items, each as soon as
+    it and all the items before it have finished, so that output stays
+    deterministic. An exception raised by func is captured (as a formatted
+    traceback) in the error slot instead of aborting the remaining items.
+    """
+    def attempt(item):
+        try:
+            return (item, func(item), None)
+        except Exception:
+            return (item, None, traceback.format_exc())
+
+    pool = ThreadPool(max(1, min(args.jobs, len(items))))
+    try:
+        for outcome in pool.imap(attempt, items):
+            yield outcome
+    finally:
+        pool.close()
+        pool.join()
+
+def dx_build_command(applet, destination):
+    # --archive: an older build of the applet in destination (i.e. the applet
+    # cache) is moved to /.Applet_archive instead of failing the build, and
+    # the applets linked from it stay usable
+    return ["dx","build","--archive","--destination",destination,os.path.join(here,applet)]
+
+def dx_build(applet, destination):
+    # capture stderr so concurrent builds don't interleave on the console
+    proc = subprocess.Popen(dx_build_command(applet, destination), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("dx build exited with status {}\n{}".format(proc.returncode, stderr.strip()))
+    return json.loads(stdout)["id"]
+
+def applet_source_sha256(applet):
+    """sha256 over an applet directory's dxapp.json, src/ and resources/ trees.
+
+    Covers the relative paths, executable bits and contents of the files git
+    tracks there, or would (untracked but not ignored), following symlinks the
+    same way dx build does when it bundles the resources. Ignored files, such
+    as the .pyc files Python leaves next to the scripts when they're run
+    locally, don't change the hash.
+    """
+    root = os.path.join(here, applet)
+    listing = subprocess.check_output(["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard",
+                                       "--", "dxapp.json", "src", "resources"], cwd=root)
+    # --cached still lists tracked files deleted from the working tree
+    paths = set(path for path in listing.split("\0") if path and os.path.exists(os.path.join(root, path)))
+
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        full_path = os.path.join(root, path)
+        digest.update("{}\0{}\0{}\0".format(path, "x" if os.access(full_path, os.X_OK) else "-",
+                                             os.path.getsize(full_path)))
+        with open(full_path, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), ""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def find_cached_applet(applet_name, source_sha256):
+    return dxpy.find_one_data_object(classname='applet', name=applet_name, properties={"source_sha256": source_sha256},
+                                     project=project.get_id(), folder=args.applet_cache_folder, recurse=False,
+                                     describe=True, zero_ok=True, more_ok=True)
+
+def link_applet(applet_desc, folder, source_sha256, access=None):
+    # Create a new applet object in folder sharing the cached applet's code and
+    # bundled resources; no dx build or resources upload involved. (An object
+    # can only live in one folder per project, so we can't clone it there.)
+    applet_input = dict((k, v) for k, v in applet_desc.iteritems()
+                        if k in ["name", "title", "summary", "description", "developerNotes", "dxapi",
+                                 "inputSpec", "outputSpec", "runSpec", "access", "tags", "types", "hidden",
+                                 "ignoreReuse"])
+    if access:
+        applet_input["access"] = dict(applet_input.get("access") or {}, **access)
+    applet_input["project"] = project.get_id()
+    applet_input["folder"] = folder
+    applet_input["properties"] = {"git_revision": git_revision, "source_sha256": source_sha256}
+    return dxpy.api.applet_new(applet_input)["id"]
+
+# The applets taking a stage_cache input
+stage_cache_applets = ["assembly/viral-ngs-human-depletion", "assembly/viral-ngs-filter", "assembly/viral-ngs-trinity",
+                       "assembly/viral-ngs-assembly-scaffolding", "assembly/viral-ngs-assembly-refinement",
+                       "assembly/viral-ngs-assembly-analysis"]
+
+def stage_cache_access():
+    # Writing stage cache records needs CONTRIBUTE access to the cache's
+    # project, so the stage cache applets only get it in workflows built with
+    # --stage-cache; dxapp.json leaves them the default VIEW access
+    cache_project = args.stage_cache.split(":", 1)[0] if ":" in args.stage_cache else project.get_id()
+    if cache_project != project.get_id():
+        return {"project": "CONTRIBUTE", "allProjects": "CONTRIBUTE"}
+    return {"project": "CONTRIBUTE"}
+
+def build_applet(applet, folder):
+    # Reuse an existing applet built from identical sources, if there is one
+    # in the cache folder; otherwise dx build it there first.
+    applet_name = json.load(open(os.path.join(here, applet, "dxapp.json")))["name"]
+    source_sha256 = applet_source_sha256(applet)
+    cached = None if args.force_rebuild else find_cached_applet(applet_name, source_sha256)
+    cache_hit = cached is not None
+    if not cache_hit:
+        cached_dxid = dx_build(applet, args.project+":"+args.applet_cache_folder+"/")
+        cached_applet = dxpy.DXApplet(cached_dxid, project=project.get_id())
+        cached_applet.set_properties({"git_revision": git_revision, "source_sha256": source_sha256})
+        cached = {"describe": cached_applet.describe()}
+    access = stage_cache_access() if args.stage_cache and applet in stage_cache_applets else None
+    return link_applet(cached["describe"], folder, source_sha256, access), cache_hit
+
 def build_applets():
     applets = ["assembly/viral-ngs-human-depletion", "demux/viral-ngs-human-depletion-multiplex",
+               "demux/viral-ngs-human-depletion-batch",
                "assembly/viral-ngs-filter", "assembly/viral-ngs-trinity", "assembly/viral-ngs-assembly-scaffolding",
                "assembly/viral-ngs-assembly-refinement", "assembly/viral-ngs-assembly-analysis",
                "demux/viral-ngs-demux-wrapper", "demux/viral-ngs-demux", "demux/viral-ngs-classification",
-               "demux/viral-ngs-bwa-count-hits", "demux/viral-ngs-count-hits-multiplex"]
+               "demux/viral-ngs-bwa-count-hits", "demux/viral-ngs-count-hits-multiplex",
+               "util/viral-ngs-lastal-db-builder"]
+
+    # Applets that user interact with directly go in [args.folder]/ main folder
+    exposed_applets = ["util/viral-ngs-fasta-fetcher"]
 
     # Build applets for assembly workflow in [args.folder]/applets/ folder
     project.new_folder(applets_folder, parents=True)
-    for applet in applets:
-        # TODO: reuse an existing applet with matching git_revision
-        print "building {}...".format(applet),
+    project.new_folder(args.applet_cache_folder, parents=True)
+    builds = [(applet, applets_folder) for applet in applets] + [(applet, args.folder) for applet in exposed_applets]
+
+    failed = []
+    cache_hits = []
+    cache_misses = []
+    for (applet, folder), result, error in parallel_map(lambda build: build_applet(*build), builds):
+        if error is None:
+            applet_dxid, cache_hit = result
+            print "building {}... {}{}".format(applet, applet_dxid, " (cached)" if cache_hit else "")
+            (cache_hits if cache_hit else cache_misses).append(applet)
+        else:
+            print "building {}... FAILED\n{}".format(applet, error)
+            failed.append(applet)
         sys.stdout.flush()
-        applet_dxid = json.loads(subprocess.check_output(["dx","build","--destination",args.project+":"+applets_folder+"/",os.path.join(here,applet)]))["id"]
-        print applet_dxid
-        applet = dxpy.DXApplet(applet_dxid, project=project.get_id())
-        applet.set_properties({"git_revision": git_revision})
 
-    # Build applets that user interact with directly in [args.folder]/ main folder
-    exposed_applets = ["util/viral-ngs-fasta-fetcher"]
-    for applet in exposed_applets:
-        print "building {}...".format(applet),
-        sys.stdout.flush()
-        applet_dxid = json.loads(subprocess.check_output(["dx","build","--destination",args.project+":"+args.folder+"/",os.path.join(here,applet)]))["id"]
-        print applet_dxid
-        applet = dxpy.DXApplet(applet_dxid, project=project.get_id())
-        applet.set_properties({"git_revision": git_revision})
+    print "applet cache: {} hit(s), {} miss(es){}".format(len(cache_hits), len(cache_misses),
+                                                       " (--force-rebuild)" if args.force_rebuild else "")
+    for applet in cache_misses:
+        print "  rebuilt {}".format(applet)
 
-build_applets()
+    if failed:
+        sys.exit("Failed to build {} applet(s): {}".format(len(failed), ", ".join(failed)))
 
 # helpers for name resolution
 def find_app(app_handle):
     return dxpy.find_one_app(name=app_handle, zero_ok=False, more_ok=False, return_handler=True)
 
-def find_applet(applet_name, folder=applets_folder):
-    return dxpy.find_one_data_object(classname='applet', name=applet_name,
-                                     project=project.get_id(), folder=folder,
-                                     zero_ok=False, more_ok=False, return_handler=True)
+class AppletResolver(object):
+    """Resolves applet names within one folder from a single bulk listing.
+
+    The folder is listed (with descriptions) on first use; after that, applet
+    handlers and their inputSpec defaults are served from memory. api_calls
+    counts the round trips made, for reporting.
+    """
+    def __init__(self, project_id, folder):
+        self.project_id = project_id
+        self.folder = folder
+        self.api_calls = 0
+        self._describes = None
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def _list_folder(self):
+        with self._lock:
+            if self._describes is None:
+                describes = {}
+                query = {"class": "applet", "describe": True,
+                         "scope": {"project": self.project_id, "folder": self.folder, "recurse": False}}
+                while True:
+                    response = dxpy.api.system_find_data_objects(query)
+                    self.api_calls += 1
+                    for result in response["results"]:
+                        name = result["describe"]["name"]
+                        if name in describes:
+                            raise dxpy.exceptions.DXSearchError("Expected one applet named {} in {}, found several".format(name, self.folder))
+                        describes[name] = result["describe"]
+                    if response["next"] is None:
+                        break
+                    query["starting"] = response["next"]
+                self._describes = describes
+        return self._describes
+
+    def describe(self, applet_name):
+        try:
+            return self._list_folder()[applet_name]
+        except KeyError:
+            raise dxpy.exceptions.DXSearchError("Expected one applet named {} in {}, found none".format(applet_name, self.folder))
+
+    def applet(self, applet_name):
+        applet_id = self.describe(applet_name)["id"]
+        with self._lock:
+            return self._handlers.setdefault(applet_name, dxpy.DXApplet(applet_id, project=self.project_id))
+
+    def input_default(self, applet_name, input_name):
+        return [x for x in self.describe(applet_name)["inputSpec"] if x["name"] == input_name][0]["default"]
+
+def find_applet(applet_name):
+    return applet_resolver.applet(applet_name)
 
 def find_resource_tarball_id():
-    depletion_applet = find_applet("viral-ngs-human-depletion")
-    depletion_applet_inputSpec = depletion_applet.describe()["inputSpec"]
-    resource_tarball_id = [x for x in depletion_applet_inputSpec if x["name"] == "resources"][0]["default"]
-    return resource_tarball_id
+    return applet_resolver.input_default("viral-ngs-human-depletion", "resources")
 
 ###############################################################################
 # VIRAL ASSEMBLY WORKFLOWS: taking raw reads (in paired FASTQ or unmapped BAM)
@@ -106,12 +279,76 @@ assembly_workflow_resources = {
     }
 }
 
+def file_sha256(file_id):
+    digest = hashlib.sha256()
+    with dxpy.open_dxfile(file_id) as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def publish_lastal_dbs():
+    """Launch viral-ngs-lastal-db-builder into --lastal-db-folder for each
+    species' filter targets that have no database there yet. Filter jobs
+    starting before it finishes build their own."""
+    project.new_folder(args.lastal_db_folder, parents=True)
+    for targets_id in sorted(set(r["filter-targets"] for r in assembly_workflow_resources.values() if "filter-targets" in r)):
+        targets_sha256 = file_sha256(targets_id)
+        lastal_db = dxpy.find_one_data_object(classname="file", properties={"targets_sha256": targets_sha256},
+                                              project=project.get_id(), folder=args.lastal_db_folder,
+                                              zero_ok=True, more_ok=True)
+        if lastal_db is not None:
+            print "lastal database of {}: {}".format(targets_id, lastal_db["id"])
+            continue
+        job = find_applet("viral-ngs-lastal-db-builder").run({"targets": dxpy.dxlink(targets_id),
+                                                              "resources": find_resource_tarball_id()},
+                                                             project=project.get_id(), folder=args.lastal_db_folder,
+                                                             name="lastal_db " + targets_id)
+        print "lastal database of {}: building in {}".format(targets_id, job.get_id())
+
+# min_coverage and novoalign_options of the two assembly refinement rounds
+refinement_rounds = [(2, "-r Random -l 30 -g 40 -x 20 -t 502"),
+                     (3, "-r Random -l 40 -g 40 -x 20 -t 100")]
+
+def stage_cache_input(stage_id):
+    """With --stage-cache, the stage_cache input linked to that of the first
+    assembly stage, so that it can be changed for the whole workflow at once"""
+    if not args.stage_cache:
+        return {}
+    return {"stage_cache": dxpy.dxlink({"stage": stage_id, "inputField": "stage_cache"})}
+
+def add_refinement_stages(wf, refine_input, folders, fused_folder):
+    """Add the refinement rounds to wf, starting from refine_input: as stages
+    refine1 and refine2 (in folders), each staging the reads and resources
+    anew, or with --fused-refinement as a single stage refine (in
+    fused_folder) running both rounds on one staging. Returns the IDs of the
+    first and last refinement stages (the same one if fused)."""
+    applet = find_applet("viral-ngs-assembly-refinement")
+    if args.fused_refinement:
+        refine_input = dict(refine_input)
+        refine_input["round_min_coverage"] = [min_coverage for min_coverage, _ in refinement_rounds]
+        refine_input["round_novoalign_options"] = [novoalign_options for _, novoalign_options in refinement_rounds]
+        refine_stage_id = wf.add_stage(applet, stage_input=refine_input, name="refine", folder=fused_folder)
+        return refine_stage_id, refine_stage_id
+
+    refine1_input = dict(refine_input)
+    refine1_input["min_coverage"], refine1_input["novoalign_options"] = refinement_rounds[0]
+    refine1_stage_id = wf.add_stage(applet, stage_input=refine1_input, name="refine1", folder=folders[0])
+
+    refine2_input = {
+        "reads": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "reads"}),
+        "assembly": dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"}),
+        "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
+        "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"}),
+        "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
+        "major_cutoff": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
+    }
+    refine2_input["min_coverage"], refine2_input["novoalign_options"] = refinement_rounds[1]
+    refine2_input.update(stage_cache_input(refine1_stage_id))
+    refine2_stage_id = wf.add_stage(applet, stage_input=refine2_input, name="refine2", folder=folders[1])
+    return refine1_stage_id, refine2_stage_id
+
 def build_assembly_workflows(workflow_list):
-    workflows = {}
-    for w in workflow_list:
-        workflow = build_assembly_workflow(w, assembly_workflow_resources[w])
-        workflows[w] = workflow
-    return workflows
+    return [(w, functools.partial(build_assembly_workflow, w, assembly_workflow_resources[w])) for w in workflow_list]
 
 def build_assembly_workflow(species, resources):
     wf = dxpy.new_dxworkflow(title='viral-ngs-assembly_{0}'.format(species),
@@ -122,20 +359,19 @@ def build_assembly_workflow(species, resources):
                               properties={"git_revision": git_revision})
 
     # Locate the file ID corresponding to the viral-ngs resource tarball
-    depletion_applet = find_applet("viral-ngs-human-depletion")
-    depletion_applet_inputSpec = depletion_applet.describe()["inputSpec"]
-
     resource_tarball_id = find_resource_tarball_id()
 
     # These steps are used in the full assembly workflow
     if not resources.get('abridged', False):
 
         depletion_input = {
-        "bmtagger_dbs": [x for x in depletion_applet_inputSpec if x["name"] == "bmtagger_dbs"][0]["default"],
-        "blast_dbs": [x for x in depletion_applet_inputSpec if x["name"] == "blast_dbs"][0]["default"],
-        "resources": [x for x in depletion_applet_inputSpec if x["name"] == "resources"][0]["default"]
+        "bmtagger_dbs": applet_resolver.input_default("viral-ngs-human-depletion", "bmtagger_dbs"),
+        "blast_dbs": applet_resolver.input_default("viral-ngs-human-depletion", "blast_dbs"),
+        "resources": resource_tarball_id
         }
-        depletion_stage_id = wf.add_stage(depletion_applet, stage_input=depletion_input, name="deplete", folder="intermediates")
+        if args.stage_cache:
+            depletion_input["stage_cache"] = args.stage_cache
+        depletion_stage_id = wf.add_stage(find_applet("viral-ngs-human-depletion"), stage_input=depletion_input, name="deplete", folder="intermediates")
 
         filter_input = {
             "reads": dxpy.dxlink({"stage": depletion_stage_id, "outputField": "cleaned_reads"}),
@@ -143,6 +379,9 @@ def build_assembly_workflow(species, resources):
         }
         if "filter-targets" in resources:
             filter_input["targets"] = dxpy.dxlink(resources["filter-targets"])
+        if args.lastal_db_folder:
+            filter_input["lastal_db_cache"] = project.get_id() + ":" + args.lastal_db_folder
+        filter_input.update(stage_cache_input(depletion_stage_id))
 
         filter_stage_id = wf.add_stage(find_applet("viral-ngs-filter"), stage_input=filter_input, name="filter", folder="intermediates")
 
@@ -153,6 +392,9 @@ def build_assembly_workflow(species, resources):
         }
         if "contaminants" in resources:
             trinity_input["contaminants"] = dxpy.dxlink(resources["contaminants"])
+        if args.streaming_subsample_factor > 0:
+            trinity_input["streaming_subsample_factor"] = args.streaming_subsample_factor
+        trinity_input.update(stage_cache_input(depletion_stage_id))
 
         trinity_stage_id = wf.add_stage(find_applet("viral-ngs-trinity"), stage_input=trinity_input, name="trinity", folder="intermediates")
 
@@ -163,27 +405,19 @@ def build_assembly_workflow(species, resources):
         }
         if "scaffold-reference" in resources:
             scaffold_input["reference_genome"] = dxpy.dxlink(resources["scaffold-reference"])
+        scaffold_input.update(stage_cache_input(depletion_stage_id))
 
         scaffold_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-scaffolding"), stage_input=scaffold_input, name="scaffold", folder="intermediates")
 
-        refine1_input = {
+        refine_input = {
             "assembly": dxpy.dxlink({"stage": scaffold_stage_id, "outputField": "modified_scaffold"}),
             "reads": dxpy.dxlink({"stage": depletion_stage_id, "outputField": "cleaned_reads"}),
-            "min_coverage": 2,
-            "novoalign_options": "-r Random -l 30 -g 40 -x 20 -t 502",
             "novocraft_license": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "novocraft_license"}),
             "gatk_tarball": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "gatk_tarball"}),
             "resources": dxpy.dxlink({"stage": depletion_stage_id, "inputField": "resources"})
         }
-        refine1_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine1_input, name="refine1", folder="intermediates")
-
-        refine2_input = refine1_input
-        refine2_input["assembly"] = dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"})
-        refine2_input["min_coverage"] = 3
-        refine2_input["novoalign_options"] = "-r Random -l 40 -g 40 -x 20 -t 100"
-        refine2_input["major_cutoff"] = dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
-
-        refine2_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine2_input, name="refine2", folder="intermediates")
+        refine_input.update(stage_cache_input(depletion_stage_id))
+        refine1_stage_id, refine2_stage_id = add_refinement_stages(wf, refine_input, ["intermediates", "intermediates"], "intermediates")
 
         analysis_input = {
             "assembly": dxpy.dxlink({"stage": refine2_stage_id, "outputField": "refined_assembly"}),
@@ -193,28 +427,17 @@ def build_assembly_workflow(species, resources):
             "novocraft_license": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "novocraft_license"}),
             "gatk_tarball": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "gatk_tarball"})
         }
+        analysis_input.update(stage_cache_input(depletion_stage_id))
         analysis_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-analysis"), stage_input=analysis_input, name="analysis")
 
     # Build abridged workflow
     else:
-        refine1_input = {
-            "min_coverage": 2,
-            "novoalign_options": "-r Random -l 30 -g 40 -x 20 -t 502",
+        refine_input = {
             "resources": resource_tarball_id
         }
-        refine1_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine1_input, name="refine1", folder="refinement_1")
-
-        refine2_input = {
-            "reads": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "reads"}),
-            "assembly": dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"}),
-            "min_coverage": 3,
-            "novoalign_options": "-r Random -l 40 -g 40 -x 20 -t 100",
-            "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
-            "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"}),
-            "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
-            "major_cutoff": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
-        }
-        refine2_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine2_input, name="refine2", folder="refinement_2")
+        if args.stage_cache:
+            refine_input["stage_cache"] = args.stage_cache
+        refine1_stage_id, refine2_stage_id = add_refinement_stages(wf, refine_input, ["refinement_1", "refinement_2"], "refinement")
 
         analysis_input = {
             "assembly": dxpy.dxlink({"stage": refine2_stage_id, "outputField": "refined_assembly"}),
@@ -224,13 +447,11 @@ def build_assembly_workflow(species, resources):
             "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
             "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"})
         }
+        analysis_input.update(stage_cache_input(refine1_stage_id))
         analysis_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-analysis"), stage_input=analysis_input, name="analysis")
 
     return wf
 
-# workflows = dict of species-name: workflow_id
-assembly_workflows = build_assembly_workflows(assembly_workflow_resources.keys())
-
 ###############################################################################
 # DEMUX-ONLY WORKFLOW: upon completion of a streaming run upload, demultiplex
 # the samples to unmapped BAMs, using the demux-wrapper to launch appropriate
@@ -277,8 +498,6 @@ def build_demux_only_workflow():
 
     return wf
 
-demux_only_workflow = build_demux_only_workflow()
-
 ###############################################################################
 # DEMUX "PLUS" WORKFLOW: upon completion of a streaming run upload, demultiplex
 # the samples to unmapped BAMs, plus run human depletion and metagenomics
@@ -326,6 +545,7 @@ def build_demux_plus_workflow():
     depletion_input = {
         "bams": dxpy.dxlink({"stage": demux_stage_id, "outputField": "bams"}),
         "depletion_applet": dxpy.dxlink(find_applet("viral-ngs-human-depletion")),
+        "batch_applet": dxpy.dxlink(find_applet("viral-ngs-human-depletion-batch")),
         "resources": dxpy.dxlink(resource_tarball_id),
         "per_sample_output": True
     }
@@ -341,80 +561,124 @@ def build_demux_plus_workflow():
 
     return wf
 
-demux_plus_workflow = build_demux_plus_workflow()
+###############################################################################
+# BUILDING WORKFLOWS: the workflows only depend on the applets built above, so
+# they're all independent of each other
+###############################################################################
+
+def build_workflows(builders):
+    workflows = {}
+    failed = []
+    for (name, builder), workflow, error in parallel_map(lambda b: b[1](), builders):
+        if error is None:
+            print "building workflow {}... {}".format(name, workflow.get_id())
+            workflows[name] = workflow
+        else:
+            print "building workflow {}... FAILED\n{}".format(name, error)
+            failed.append(name)
+        sys.stdout.flush()
+
+    if failed:
+        sys.exit("Failed to build {} workflow(s): {}".format(len(failed), ", ".join(failed)))
+    return workflows
 
 ###############################################################################
 # TESTS
 ###############################################################################
 
-if args.run_tests is True or args.run_large_tests is True:
-    muscle_applet = dxpy.DXApplet("applet-BXQxjv00QyB9QF3vP4BpXg95")
+def sha256_without_headers(file_id):
+    """sha256 of a FASTA file with its header lines dropped, streamed from the
+    platform; same as hashing the output of `dx cat file_id | grep -v ">"`"""
+    digest = hashlib.sha256()
+    pending = ""
+    with dxpy.open_dxfile(file_id) as infile:
+        while True:
+            chunk = infile.read(1 << 20)
+            if chunk:
+                lines = (pending + chunk).split("\n")
+                pending = lines.pop()
+            else:
+                # grep terminates an unterminated last line with a newline
+                lines = [pending] if pending else []
+            for line in lines:
+                if ">" not in line:
+                    digest.update(line + "\n")
+            if not chunk:
+                break
+    return digest.hexdigest()
+
+# test data found in "bi-viral-ngs CI:/test_data"
+test_samples = {
+    "SRR1553554": {
+        "species": "Ebola",
+        "reads": "file-BXPPQ2Q0YzB28x9Q9911Ykz5",
+        "reads2": "file-BXPPQ380YzB6xGxJ45K9Yv6Q",
+        "broad_assembly": "file-BXQx6G00QyB6PQVYKQBgzxv4",
+        "expected_assembly_sha256sum": "3a849c1e545bca1ff938fe847f09206c0d5001de6153bf65831eb21513f1c3fa",
+        # Note: contig name line (>....) removed
+        "expected_subsampled_base_count":  729174,
+        "expected_alignment_base_count": 577417
+    }
+}
 
-    # Tests for Assembly Workflow
-
-    # test data found in "bi-viral-ngs CI:/test_data"
-    test_samples = {
-        "SRR1553554": {
-            "species": "Ebola",
-            "reads": "file-BXPPQ2Q0YzB28x9Q9911Ykz5",
-            "reads2": "file-BXPPQ380YzB6xGxJ45K9Yv6Q",
-            "broad_assembly": "file-BXQx6G00QyB6PQVYKQBgzxv4",
-            "expected_assembly_sha256sum": "3a849c1e545bca1ff938fe847f09206c0d5001de6153bf65831eb21513f1c3fa",
-            # Note: contig name line (>....) removed
-            "expected_subsampled_base_count":  729174,
-            "expected_alignment_base_count": 577417
-        }
+# added with --run-large-tests
+# nb these samples takes too long for Travis
+# TODO: Update figures of merit for v1.10.1 udpates, which
+# overhauls subsampled and alignment base counts
+large_test_samples = {
+    "SRR1553468": {
+        "species": "Ebola",
+        "reads": "file-BXYqZj80Fv4YqP151Zy9291y",
+        "reads2": "file-BXYqZkQ0Fv4YZYKx14yJg0b4",
+        "broad_assembly": "file-BXYqYKQ0QyB84xYJP9Kz7zzK",
+        "expected_assembly_sha256sum": "626c6a72ce4380470340d6fd0d94f0a23e240c8bc57d63a7c83046ac7111ace7",
+        # Note: contig name line (>....) removed
+        "expected_subsampled_base_count": 18787806,
+        "expected_alignment_base_count": 247110236
+    },
+    "G1190": {
+        "species": "Lassa",
+        "reads": "file-Bg97bJQ0x0z12q4XyZf5p0Kk",
+        "broad_assembly": 'file-Bg533J00x0zBkYkFGb23k58B',
+        "expected_assembly_sha256sum": "2c41eed662454fe6fd8757cc7c60b872d5021728bbfaeef1fd3d81d2023c0bca",
+        # Note: contig name line (>....) removed
+        "expected_subsampled_base_count":  1841634,
+        "expected_alignment_base_count": 111944259
+    },
+    "SRR1553416": {
+        "species": "Ebola",
+        "reads": "file-BXBP0VQ011y0B0g5bbJFzx51",
+        "reads2": "file-BXBP0Xj011yFYvPjgJJ0GzZB",
+        "broad_assembly": "file-BXFqQvQ0QyB5859Vpx1j7bqq",
+        "expected_assembly_sha256sum": "7e39e584758ba47c828a933cb836ea3a9b21b9afa2555a81d02fc17c8ba00e66",
+        # Note: contig name line (>....) removed
+        "expected_subsampled_base_count": 460338,
+        "expected_alignment_base_count": 485406
     }
+}
 
+def run_tests(assembly_workflows, demux_plus_workflow):
+    muscle_applet = dxpy.DXApplet("applet-BXQxjv00QyB9QF3vP4BpXg95")
+
+    samples = dict(test_samples)
     if args.run_large_tests is True:
-        # nb these samples takes too long for Travis
-        # TODO: Update figures of merit for v1.10.1 udpates, which
-        # overhauls subsampled and alignment base counts
-        test_samples["SRR1553468"] = {
-            "species": "Ebola",
-            "reads": "file-BXYqZj80Fv4YqP151Zy9291y",
-            "reads2": "file-BXYqZkQ0Fv4YZYKx14yJg0b4",
-            "broad_assembly": "file-BXYqYKQ0QyB84xYJP9Kz7zzK",
-            "expected_assembly_sha256sum": "626c6a72ce4380470340d6fd0d94f0a23e240c8bc57d63a7c83046ac7111ace7",
-            # Note: contig name line (>....) removed
-            "expected_subsampled_base_count": 18787806,
-            "expected_alignment_base_count": 247110236
-        }
-        test_samples["G1190"] = {
-            "species": "Lassa",
-            "reads": "file-Bg97bJQ0x0z12q4XyZf5p0Kk",
-            "broad_assembly": 'file-Bg533J00x0zBkYkFGb23k58B',
-            "expected_assembly_sha256sum": "2c41eed662454fe6fd8757cc7c60b872d5021728bbfaeef1fd3d81d2023c0bca",
-            # Note: contig name line (>....) removed
-            "expected_subsampled_base_count":  1841634,
-            "expected_alignment_base_count": 111944259
-        }
-        test_samples["SRR1553416"] = {
-            "species": "Ebola",
-            "reads": "file-BXBP0VQ011y0B0g5bbJFzx51",
-            "reads2": "file-BXBP0Xj011yFYvPjgJJ0GzZB",
-            "broad_assembly": "file-BXFqQvQ0QyB5859Vpx1j7bqq",
-            "expected_assembly_sha256sum": "7e39e584758ba47c828a933cb836ea3a9b21b9afa2555a81d02fc17c8ba00e66",
-            # Note: contig name line (>....) removed
-            "expected_subsampled_base_count": 460338,
-            "expected_alignment_base_count": 485406
-        }
+        samples.update(large_test_samples)
 
     # Launch assembly test workflows
     test_assembly_analyses = []
-    for test_sample in test_samples.keys():
+    for test_sample in samples.keys():
         # create a subfolder for this sample
         test_folder = args.folder + "/" + test_sample
         project.new_folder(test_folder)
         # run the workflow on the test sample
         try:
-            workflow = assembly_workflows[test_samples[test_sample]["species"]]
+            workflow = assembly_workflows[samples[test_sample]["species"]]
         except KeyError:
             # Skip running test if workflow for req species was not built
             continue
 
         test_input = {
-            "deplete.file": dxpy.dxlink(test_samples[test_sample]["reads"]),
+            "deplete.file": dxpy.dxlink(samples[test_sample]["reads"]),
             "deplete.skip_depletion": True,
             "scaffold.gatk_tarball": dxpy.dxlink(args.gatk),
         }
@@ -423,8 +687,8 @@ if args.run_tests is True or args.run_large_tests is True:
         if args.novocraft:
             test_input["scaffold.novocraft_license"] = dxpy.dxlink(args.novocraft)
 
-        if "reads2" in test_samples[test_sample]:
-            test_input["deplete.paired_fastq"] = dxpy.dxlink(test_samples[test_sample]["reads2"])
+        if "reads2" in samples[test_sample]:
+            test_input["deplete.paired_fastq"] = dxpy.dxlink(samples[test_sample]["reads2"])
 
         test_analysis = workflow.run(test_input, project=project.get_id(), folder=test_folder,
                                      name=(git_revision+" "+test_sample+"-Assembly"))
@@ -467,63 +731,107 @@ if args.run_tests is True or args.run_large_tests is True:
                                                       name=(git_revision+" "+run+"-Demux-plus"))
         test_demux_analyses.append((run, demux_plus_analysis))
 
-    # wait for jobs to finish while working around Travis 10m console inactivity timeout
-    print "Waiting for analyses to finish..."
-    noise = subprocess.Popen(["/bin/bash", "-c", "while true; do date; sleep 60; done"])
-    try:
-        for (test_sample,test_analysis) in test_assembly_analyses:
-            test_analysis.wait_on_done()
-            workflow = assembly_workflows[test_samples[test_sample]["species"]]
-
-            # for diagnostics: add on a MUSCLE alignment of the Broad's
-            # assembly of the sample with the workflow products
-            muscle_input = {
-                "fasta": [
-                    test_analysis.get_output_ref(workflow.get_stage("scaffold")["id"]+".intermediate_scaffold"),
-                    test_analysis.get_output_ref(workflow.get_stage("scaffold")["id"]+".modified_scaffold"),
-                    test_analysis.get_output_ref(workflow.get_stage("refine1")["id"]+".refined_assembly"),
-                    test_analysis.get_output_ref(workflow.get_stage("refine2")["id"]+".refined_assembly"),
-                    dxpy.dxlink(test_samples[test_sample]["broad_assembly"])
-                ],
-                "output_format": "html",
-                "output_name": test_sample+"_test_alignment",
-                "advanced_options": "-maxiters 2"
-            }
-            muscle_applet.run(muscle_input, project=project.get_id(), folder=(args.folder+"/"+test_sample), name=(git_revision+" "+test_sample+" MUSCLE"), instance_type="mem1_ssd1_x4")
-
-        for (run, demux_plus_analysis) in test_demux_analyses:
-            # Just make sure demux plus runs without failure now,
-            # TODO: check figure of merit for demux plus pipeline
-            demux_plus_analysis.wait_on_done()
-
-    finally:
-        noise.kill()
+    # stage name => ID in each tested assembly workflow, from one describe
+    # apiece rather than a get_stage describe per stage and sample
+    stage_ids = {}
+    for test_sample, _ in test_assembly_analyses:
+        species = samples[test_sample]["species"]
+        if species not in stage_ids:
+            stage_ids[species] = dict((stage["name"], stage["id"])
+                                      for stage in assembly_workflows[species].describe()["stages"])
+
+    # as each assembly test finishes, launch its MUSCLE alignment and check its
+    # figures of merit, failing on the first mismatch
+    def check_assembly_test(test_sample, test_analysis, analysis_desc):
+        stage_id = stage_ids[samples[test_sample]["species"]]
+
+        if args.fused_refinement:
+            refined_assemblies = [test_analysis.get_output_ref(stage_id["refine"]+".round_assemblies", index=i)
+                                  for i in range(len(refinement_rounds))]
+        else:
+            refined_assemblies = [test_analysis.get_output_ref(stage_id["refine1"]+".refined_assembly"),
+                                  test_analysis.get_output_ref(stage_id["refine2"]+".refined_assembly")]
+
+        # for diagnostics: add on a MUSCLE alignment of the Broad's
+        # assembly of the sample with the workflow products
+        muscle_input = {
+            "fasta": [
+                test_analysis.get_output_ref(stage_id["scaffold"]+".intermediate_scaffold"),
+                test_analysis.get_output_ref(stage_id["scaffold"]+".modified_scaffold")
+            ] + refined_assemblies + [dxpy.dxlink(samples[test_sample]["broad_assembly"])],
+            "output_format": "html",
+            "output_name": test_sample+"_test_alignment",
+            "advanced_options": "-maxiters 2"
+        }
+        muscle_applet.run(muscle_input, project=project.get_id(), folder=(args.folder+"/"+test_sample), name=(git_revision+" "+test_sample+" MUSCLE"), instance_type="mem1_ssd1_x4")
 
-    # check figures of merit for assembly tests
-    for (test_sample,test_analysis) in test_assembly_analyses:
-        workflow = assembly_workflows[test_samples[test_sample]["species"]]
-        subsampled_base_count = test_analysis.describe()["output"][workflow.get_stage("trinity")["id"]+".subsampled_base_count"]
-        expected_subsampled_base_count = test_samples[test_sample]["expected_subsampled_base_count"]
+        # check figures of merit
+        subsampled_base_count = analysis_desc["output"][stage_id["trinity"]+".subsampled_base_count"]
+        expected_subsampled_base_count = samples[test_sample]["expected_subsampled_base_count"]
         print "\t".join([test_sample, "subsampled_base_count", str(expected_subsampled_base_count), str(subsampled_base_count)])
 
-        # Get the final assembly and remove the contig name (>...) lines
-        test_assembly_file_id = test_analysis.describe()["output"][workflow.get_stage("analysis")["id"]+".final_assembly"]
-        dx_cat_cmd = ["dx", "cat", test_assembly_file_id['$dnanexus_link']]
-        grep_cmd = ["grep", "-v", ">"]
-        ps = subprocess.Popen(dx_cat_cmd, stdout=subprocess.PIPE)
-        editted_assembly_file = subprocess.check_output(grep_cmd, stdin=ps.stdout)
-
-        test_assembly_sha256sum = hashlib.sha256(editted_assembly_file).hexdigest()
-        expected_sha256sum = test_samples[test_sample]["expected_assembly_sha256sum"]
+        # Hash the final assembly with the contig name (>...) lines removed
+        test_assembly_file_id, _ = dxpy.get_dxlink_ids(analysis_desc["output"][stage_id["analysis"]+".final_assembly"])
+        test_assembly_sha256sum = sha256_without_headers(test_assembly_file_id)
+        expected_sha256sum = samples[test_sample]["expected_assembly_sha256sum"]
         print "\t".join([test_sample, "sha256sum", expected_sha256sum, test_assembly_sha256sum])
 
-        alignment_base_count = test_analysis.describe()["output"][workflow.get_stage("analysis")["id"]+".alignment_base_count"]
-        expected_alignment_base_count = test_samples[test_sample]["expected_alignment_base_count"]
+        alignment_base_count = analysis_desc["output"][stage_id["analysis"]+".alignment_base_count"]
+        expected_alignment_base_count = samples[test_sample]["expected_alignment_base_count"]
         print "\t".join([test_sample, "alignment_base_count", str(expected_alignment_base_count), str(alignment_base_count)])
+        sys.stdout.flush()
 
         assert expected_sha256sum == test_assembly_sha256sum
         # Subsampled_base_count seems to drift, comment out for now
         # assert expected_subsampled_base_count == subsampled_base_count
         assert expected_alignment_base_count == alignment_base_count
 
+    # wait for all the analyses together; the tracker prints its own progress,
+    # working around Travis 10m console inactivity timeout
+    print "Waiting for analyses to finish..."
+    tracker = ExecutionTracker(project=project.get_id())
+    for (test_sample,test_analysis) in test_assembly_analyses:
+        tracker.track(test_analysis.get_id(), functools.partial(check_assembly_test, test_sample, test_analysis),
+                      label=test_sample+"-Assembly")
+    for (run, demux_plus_analysis) in test_demux_analyses:
+        # Just make sure demux plus runs without failure now,
+        # TODO: check figure of merit for demux plus pipeline
+        tracker.track(demux_plus_analysis.get_id(), label=run+"-Demux-plus")
+    tracker.wait()
+
     print "Success"
+
+def main(argv=None):
+    global args, git_revision, project, applets_folder, applet_resolver
+    args = argparser.parse_args(argv)
+
+    # detect git revision
+    git_revision = subprocess.check_output(["git", "describe", "--always", "--dirty", "--tags"]).strip()
+
+    if args.folder is None:
+        args.folder = time.strftime("/%Y-%m/%d-%H%M%S-") + git_revision
+
+    project = dxpy.DXProject(args.project)
+    applets_folder = args.folder + "/applets"
+    print "project: {} ({})".format(project.name, args.project)
+    print "folder: {}".format(args.folder)
+
+    build_applets()
+    applet_resolver = AppletResolver(project.get_id(), applets_folder)
+
+    if args.lastal_db_folder:
+        publish_lastal_dbs()
+
+    workflows = build_workflows(build_assembly_workflows(sorted(assembly_workflow_resources.keys())) +
+                                [("demux-only", build_demux_only_workflow), ("demux-plus", build_demux_plus_workflow)])
+
+    print "applet name resolution: {} API call(s)".format(applet_resolver.api_calls)
+
+    if args.run_tests is True or args.run_large_tests is True:
+        # assembly_workflows = dict of species-name: workflow
+        assembly_workflows = dict((species, workflows[species]) for species in assembly_workflow_resources.keys())
+        run_tests(assembly_workflows, workflows["demux-plus"])
+    return workflows
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Per-base read depth over the reference sequences of a BAM file, in one pass
+over its binary records.
+
+Prints a JSON summary with the mean and median depth and the breadth of
+coverage (fraction of positions with depth >= 1, 5 and 20 by default) over
+all the references together and for each one, e.g.
+
+    bam_coverage.py mapped.bam --genomecov genomecov.txt --track depth.bedgraph > coverage.json
+    mean_depth=$(jq .mean_depth coverage.json)
+
+Depth counts the reference positions aligned to (M/=/X) by each mapped
+record, like `bedtools genomecov -split`; soft-clipped and inserted bases,
+deletions and skipped regions don't count. --genomecov writes the depth
+histogram of `bedtools genomecov -ibam` without -split (one line per
+reference and depth, then the "genome" lines), where skipped regions (N)
+count as covered too, so its depths can exceed those of the summary.
+--track writes a bedGraph of the mean depth in fixed-size bins, and --stats
+the bam_stats.py summary of the same records.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+import bamio
+from bamio import FUNMAP
+from bam_stats import BamStats
+
+# CIGAR operations covering reference positions, and those just skipping them
+CIGAR_COVER = frozenset([0, 7, 8]) # M = X
+CIGAR_SKIP = frozenset([2, 3]) # D N
+CIGAR_REF_SKIP = 3 # N
+
+class Coverage(object):
+    """Accumulates per-base depth over a list of (name, length) references.
+
+    Aligned blocks are buffered as start/end positions and periodically
+    folded into a difference array per reference, so the per-record work is
+    just decoding the CIGAR. With split=False, skipped regions (N) count as
+    covered and only deletions break blocks, as in `bedtools genomecov`
+    without -split.
+    """
+    def __init__(self, references, split=True, flush_every=1 << 20):
+        self.references = references
+        self.split = split
+        self.flush_every = flush_every
+        self._diff = [None] * len(references)
+        self._starts = [array("l") for _ in references]
+        self._ends = [array("l") for _ in references]
+
+    def add_block(self, ref_id, start, end):
+        starts = self._starts[ref_id]
+        starts.append(start)
+        self._ends[ref_id].append(end)
+        if len(starts) >= self.flush_every:
+            self._flush(ref_id)
+
+    def add_record(self, record):
+        ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = \
+            bamio.RECORD_CORE.unpack_from(record)
+        if flag & FUNMAP or ref_id < 0:
+            return
+        cigar = struct.unpack_from("<{}I".format(n_cigar_op), record, bamio.RECORD_CORE.size + l_read_name)
+        start = end = pos
+        for c in cigar:
+            op, length = c & 0xf, c >> 4
+            if op in CIGAR_COVER:
+                end += length
+            elif op == CIGAR_REF_SKIP and not self.split:
+                end += length
+            elif op in CIGAR_SKIP:
+                if end > start:
+                    self.add_block(ref_id, start, end)
+                start = end = end + length
+        if end > start:
+            self.add_block(ref_id, start, end)
+
+    def _flush(self, ref_id):
+        length = self.references[ref_id][1]
+        if self._diff[ref_id] is None:
+            self._diff[ref_id] = np.zeros(length + 1, dtype=np.int64)
+        if not self._starts[ref_id]:
+            return
+        # blocks hanging off the end of the reference are clipped to it
+        starts = np.minimum(np.frombuffer(self._starts[ref_id], dtype=np.int_), length)
+        ends = np.minimum(np.frombuffer(self._ends[ref_id], dtype=np.int_), length)
+        self._diff[ref_id] += np.bincount(starts, minlength=length + 1)
+        self._diff[ref_id] -= np.bincount(ends, minlength=length + 1)
+        self._starts[ref_id] = array("l")
+        self._ends[ref_id] = array("l")
+
+    def depth(self, ref_id):
+        """Depth at each position of a reference, as a numpy array"""
+        self._flush(ref_id)
+        return np.cumsum(self._diff[ref_id][:-1])
+
+def histogram_median(hist):
+    """Median of the values counted in hist (hist[d] = number of positions with depth d)"""
+    n = int(hist.sum())
+    if n == 0:
+        return 0.0
+    cumulative = np.cumsum(hist)
+    lower = int(np.searchsorted(cumulative, (n - 1) // 2 + 1))
+    upper = int(np.searchsorted(cumulative, n // 2 + 1))
+    return (lower + upper) / 2.0
+
+def summarize(hist, breadth_depths):
+    length = int(hist.sum())
+    total = int(np.dot(np.arange(len(hist)), hist))
+    summary = {
+        "length": length,
+        "aligned_base_count": total,
+        "mean_depth": float(total) / length if length else 0.0,
+        "median_depth": histogram_median(hist)
+    }
+    for d in breadth_depths:
+        covered = int(hist[d:].sum())
+        summary["breadth_{}x".format(d)] = float(covered) / length if length else 0.0
+    return summary
+
+def add_histogram(total, hist):
+    """Add hist into total, growing it as needed; returns total"""
+    if len(hist) > len(total):
+        total.resize(len(hist), refcheck=False)
+    total[:len(hist)] += hist
+    return total
+
+def write_genomecov(outfile, name, hist):
+    length = int(hist.sum())
+    for d in np.flatnonzero(hist):
+        outfile.write("{}\t{}\t{}\t{}\t{:g}\n".format(name, d, hist[d], length, float(hist[d]) / length))
+
+def write_track(outfile, name, depth, bin_size):
+    sums = np.add.reduceat(depth, np.arange(0, len(depth), bin_size)) if len(depth) else []
+    for i, s in enumerate(sums):
+        start = i * bin_size
+        end = min(start + bin_size, len(depth))
+        outfile.write("{}\t{}\t{}\t{:.1f}\n".format(name, start, end, float(s) / (end - start)))
+
+def bam_coverage(infile, threads=1, stats=None, spans=False):
+    """Compute the Coverage of a BAM file, and with spans, also its
+    split=False Coverage (else None); also counts its records into stats, if given a
+    bam_stats.BamStats."""
+    reader = bamio.BamReader(infile, threads)
+    coverage = Coverage(reader.references)
+    span_coverage = Coverage(reader.references, split=False) if spans else None
+    for record in reader:
+        coverage.add_record(record)
+        if span_coverage is not None:
+            span_coverage.add_record(record)
+        if stats is not None:
+            stats.add_record(record)
+    return coverage, span_coverage
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bam", help="Input BAM file ('-' for stdin)")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Threads for BGZF decompression (default: %(default)s)")
+    parser.add_argument("--breadth", metavar="DEPTH", type=int, nargs="+", default=[1, 5, 20],
+                        help="Report the fraction of positions covered at least this deep (default: %(default)s)")
+    parser.add_argument("--genomecov", metavar="FILE", help="Write the `bedtools genomecov -ibam` depth histogram to FILE")
+    parser.add_argument("--track", metavar="FILE", help="Write the mean depth of each bin to FILE, as bedGraph")
+    parser.add_argument("--bin-size", type=int, default=100, help="Bin size for --track (default: %(default)s)")
+    parser.add_argument("--stats", metavar="FILE", help="Also write the bam_stats.py JSON summary to FILE")
+    args = parser.parse_args()
+
+    stats = BamStats() if args.stats else None
+    coverage, span_coverage = bam_coverage(bamio.open_input(args.bam), args.threads, stats, spans=bool(args.genomecov))
+
+    genomecov = open(args.genomecov, "w") if args.genomecov else None
+    track = open(args.track, "w") if args.track else None
+    genome_hist = np.zeros(1, dtype=np.int64)
+    genome_span_hist = np.zeros(1, dtype=np.int64)
+    contigs = []
+    for ref_id, (name, length) in enumerate(coverage.references):
+        depth = coverage.depth(ref_id)
+        hist = np.bincount(depth, minlength=1)
+        genome_hist = add_histogram(genome_hist, hist)
+        contig = summarize(hist, args.breadth)
+        contig["name"] = name
+        contigs.append(contig)
+        if genomecov:
+            span_hist = np.bincount(span_coverage.depth(ref_id), minlength=1)
+            genome_span_hist = add_histogram(genome_span_hist, span_hist)
+            # like bedtools, leave references nothing aligned to out of the histogram
+            if len(span_hist) > 1:
+                write_genomecov(genomecov, name, span_hist)
+        if track:
+            write_track(track, name, depth, args.bin_size)
+    if genomecov:
+        if genome_span_hist.sum():
+            write_genomecov(genomecov, "genome", genome_span_hist)
+        genomecov.close()
+    if track:
+        track.close()
+
+    if stats is not None:
+        with open(args.stats, "w") as outfile:
+            json.dump(stats.summary(), outfile, sort_keys=True)
+            outfile.write("\n")
+
+    summary = summarize(genome_hist, args.breadth)
+    summary["contigs"] = contigs
+    json.dump(summary, sys.stdout, sort_keys=True)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Read count, base count and samtools flagstat-equivalent statistics for a BAM
+file, in one pass over its binary records.
+
+Prints a JSON summary, e.g. for use with jq:
+
+    bam_stats.py reads.bam > reads.stats.json
+    read_count=$(jq .read_count reads.stats.json)
+
+read_count matches `samtools view -c`, base_count matches
+`samtools view | cut -f10 | tr -d '\\n' | wc -c` (which counts the '*' written
+for a record without a stored sequence as one base), and paired_count and
+properly_paired_count are the QC-passed "paired in sequencing" and "properly
+paired" lines of `samtools flagstat`.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import sys
+
+import bamio
+from bamio import FPAIRED, FPROPER_PAIR, FUNMAP, FMUNMAP, FREAD1, FREAD2, \
+    FSECONDARY, FQCFAIL, FDUP, FSUPPLEMENTARY
+
+# samtools flagstat categories, in the order it prints them
+FLAGSTAT_FIELDS = ["total", "secondary", "supplementary", "duplicates", "mapped",
+                   "paired in sequencing", "read1", "read2", "properly paired",
+                   "with itself and mate mapped", "singletons",
+                   "with mate mapped to a different chr", "with mate mapped to a different chr (mapQ>=5)"]
+
+class BamStats(object):
+    """Accumulates counts over BAM records; see add()"""
+    def __init__(self):
+        self.read_count = 0
+        self.base_count = 0
+        # [QC-passed, QC-failed] counts per flagstat category
+        self.flagstat = dict((field, [0, 0]) for field in FLAGSTAT_FIELDS)
+
+    def add(self, ref_id, mapq, flag, l_seq, next_ref_id):
+        """Count one record (the same logic as samtools' bam_stat.c)"""
+        self.read_count += 1
+        self.base_count += l_seq or 1
+        w = 1 if flag & FQCFAIL else 0
+        fs = self.flagstat
+        fs["total"][w] += 1
+        if flag & FSECONDARY:
+            fs["secondary"][w] += 1
+        elif flag & FSUPPLEMENTARY:
+            fs["supplementary"][w] += 1
+        elif flag & FPAIRED:
+            fs["paired in sequencing"][w] += 1
+            if flag & FPROPER_PAIR and not flag & FUNMAP:
+                fs["properly paired"][w] += 1
+            if flag & FREAD1:
+                fs["read1"][w] += 1
+            if flag & FREAD2:
+                fs["read2"][w] += 1
+            if flag & FMUNMAP and not flag & FUNMAP:
+                fs["singletons"][w] += 1
+            if not flag & FUNMAP and not flag & FMUNMAP:
+                fs["with itself and mate mapped"][w] += 1
+                if next_ref_id != ref_id:
+                    fs["with mate mapped to a different chr"][w] += 1
+                    if mapq >= 5:
+                        fs["with mate mapped to a different chr (mapQ>=5)"][w] += 1
+        if not flag & FUNMAP:
+            fs["mapped"][w] += 1
+        if flag & FDUP:
+            fs["duplicates"][w] += 1
+
+    def add_record(self, record):
+        ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = \
+            bamio.RECORD_CORE.unpack_from(record)
+        self.add(ref_id, mapq, flag, l_seq, next_ref_id)
+
+    def summary(self):
+        return {
+            "read_count": self.read_count,
+            "base_count": self.base_count,
+            "paired_count": self.flagstat["paired in sequencing"][0],
+            "properly_paired_count": self.flagstat["properly paired"][0],
+            "flagstat": self.flagstat
+        }
+
+    def flagstat_text(self):
+        """The report in samtools (1.x, before 1.13) flagstat's text format"""
+        def percent(field, of):
+            fs = self.flagstat
+            return " : ".join(["{:.2f}%".format(100.0 * fs[field][w] / fs[of][w]) if fs[of][w] else "N/A"
+                               for w in (0, 1)])
+        lines = []
+        for field in FLAGSTAT_FIELDS:
+            passed, failed = self.flagstat[field]
+            if field == "total":
+                lines.append("{} + {} in total (QC-passed reads + QC-failed reads)".format(passed, failed))
+            elif field == "mapped":
+                lines.append("{} + {} mapped ({})".format(passed, failed, percent(field, "total")))
+            elif field in ("properly paired", "singletons"):
+                lines.append("{} + {} {} ({})".format(passed, failed, field, percent(field, "paired in sequencing")))
+            else:
+                lines.append("{} + {} {}".format(passed, failed, field))
+        return "\n".join(lines) + "\n"
+
+def bam_stats(infile, threads=1):
+    stats = BamStats()
+    for record in bamio.BamReader(infile, threads):
+        stats.add_record(record)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bam", help="Input BAM file ('-' for stdin)")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Threads for BGZF decompression (default: %(default)s)")
+    parser.add_argument("--flagstat", metavar="FILE", help="Also write the samtools flagstat text report to FILE")
+    args = parser.parse_args()
+
+    stats = bam_stats(bamio.open_input(args.bam), args.threads)
+    if args.flagstat:
+        with open(args.flagstat, "w") as outfile:
+            outfile.write(stats.flagstat_text())
+    json.dump(stats.summary(), sys.stdout, sort_keys=True)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Subsample the read pairs of an unaligned BAM in one streaming pass, e.g. as
+it downloads, so that only the subsample ever reaches disk:
+
+    dx cat "$reads" | bam_subsample.py - subsample.bam --pairs 400000 > subsample.stats.json
+
+Records with the same read name in a row (mates, as in an unaligned BAM) are
+kept or dropped together; a reservoir holds the raw records of the pairs
+chosen so far, and the pairs are written in their input order at the end.
+With no more pairs than --pairs, the output holds all of them. The choice is
+seeded (--seed), so the same input gives the same subsample.
+
+Prints a JSON summary of the output's read_count, pair_count and base_count
+(the latter as in bam_stats.py), and the input_read_count and
+input_pair_count it was drawn from.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import random
+import struct
+import sys
+
+import bamio
+
+def read_name(record):
+    return record[bamio.RECORD_CORE.size:bamio.RECORD_CORE.size + struct.unpack_from("<B", record, 8)[0]]
+
+def pairs(records, counts):
+    """Yield each run of records with the same read name (a read pair, or an
+    unpaired read) as one bytes object, each record with its block_size
+    prefix as in the file; counts["input_read_count"] counts the records"""
+    pack_size = struct.Struct("<i").pack
+    group, group_name = [], None
+    for record in records:
+        name = read_name(record)
+        if name != group_name and group:
+            yield b"".join(group)
+            group = []
+        group_name = name
+        group.append(pack_size(len(record)) + record)
+        counts["input_read_count"] += 1
+    if group:
+        yield b"".join(group)
+
+def reservoir_sample(items, k, rng):
+    """Algorithm R: a uniform sample of k of items, in input order; returns
+    it and the number of items"""
+    reservoir = []
+    n = 0
+    for n, item in enumerate(items, 1):
+        if n <= k:
+            reservoir.append((n, item))
+        else:
+            j = rng.randint(0, n - 1)
+            if j < k:
+                reservoir[j] = (n, item)
+    reservoir.sort(key=lambda entry: entry[0])
+    return [item for _, item in reservoir], n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bam", help="Input BAM file ('-' for stdin)")
+    parser.add_argument("out_bam", help="Output BAM file")
+    parser.add_argument("--pairs", type=int, required=True, help="Read pairs (or unpaired reads) to keep")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Threads for BGZF (de)compression (default: %(default)s)")
+    args = parser.parse_args()
+
+    reader = bamio.BamReader(bamio.open_input(args.bam), args.threads)
+    counts = {"input_read_count": 0, "read_count": 0, "base_count": 0}
+    sample, counts["input_pair_count"] = reservoir_sample(pairs(reader, counts), args.pairs, random.Random(args.seed))
+    counts["pair_count"] = len(sample)
+
+    with open(args.out_bam, "wb") as outfile:
+        writer = bamio.BgzfWriter(outfile, args.threads)
+        writer.write(bamio.header_bytes(reader.text, reader.references))
+        for data in sample:
+            writer.write(data)
+            pos = 0
+            while pos < len(data):
+                block_size, = struct.unpack_from("<i", data, pos)
+                counts["read_count"] += 1
+                counts["base_count"] += bamio.RECORD_CORE.unpack_from(data, pos + 4)[7] or 1
+                pos += 4 + block_size
+        writer.close()
+
+    json.dump(counts, sys.stdout, sort_keys=True)
+    print()
+
+if __name__ == "__main__":
+    main()
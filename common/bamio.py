@@ -0,0 +1,232 @@
+"""
+Minimal BAM reading and writing straight from the binary format: BGZF blocks
+are inflated on a pool of threads (zlib releases the GIL) and alignment
+records are handed out as raw bytes, for tools that only need a few fixed
+fields per record; records are written back out the same way.
+"""
+import struct
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+BGZF_HEADER = struct.Struct("<BBBBIBBH")
+BAM_MAGIC = b"BAM\x01"
+
+# uncompressed bytes per BGZF block written, as htslib does (leaving room
+# for incompressible data within the 64 KiB block limit)
+BGZF_BLOCK_DATA = 0xff00
+
+# the empty block that marks the end of a BGZF file
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+RECORD_CORE = struct.Struct("<iiBBHHHiiii")
+
+# SAM flag bits
+FPAIRED, FPROPER_PAIR, FUNMAP, FMUNMAP, FREVERSE, FMREVERSE, FREAD1, FREAD2, \
+    FSECONDARY, FQCFAIL, FDUP, FSUPPLEMENTARY = [1 << i for i in range(12)]
+
+class FormatError(ValueError):
+    pass
+
+def read_bgzf_blocks(infile):
+    """Yield the raw (still deflated) payload of each BGZF block in infile"""
+    while True:
+        header = infile.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size:
+            raise FormatError("truncated BGZF block header")
+        id1, id2, cm, flg, mtime, xfl, os_, xlen = BGZF_HEADER.unpack(header)
+        if (id1, id2, cm, flg) != (31, 139, 8, 4):
+            raise FormatError("not a BGZF file")
+        extra = infile.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            si1, si2, slen = struct.unpack_from("<BBH", extra, i)
+            if (si1, si2) == (66, 67):
+                bsize = struct.unpack_from("<H", extra, i + 4)[0]
+            i += 4 + slen
+        if bsize is None:
+            raise FormatError("BGZF block without BSIZE subfield")
+        rest = infile.read(bsize - xlen - BGZF_HEADER.size + 1)
+        if len(rest) < bsize - xlen - BGZF_HEADER.size + 1:
+            raise FormatError("truncated BGZF block")
+        # drop the CRC32 and ISIZE trailer
+        yield rest[:-8]
+
+def inflate(payload):
+    return zlib.decompress(payload, -15)
+
+def read_bgzf(infile, threads=1, batch=64):
+    """Yield the decompressed contents of infile block by block, in order.
+
+    Blocks are inflated in batches on a pool of threads; the next batch is
+    dispatched before the current one is handed out, so reading, inflating
+    and the consumer's work overlap, with bounded memory.
+    """
+    blocks = read_bgzf_blocks(infile)
+    if threads <= 1:
+        for payload in blocks:
+            yield inflate(payload)
+        return
+
+    def next_batch():
+        payloads = [payload for _, payload in zip(range(batch * threads), blocks)]
+        return pool.map_async(inflate, payloads) if payloads else None
+
+    pool = ThreadPool(threads)
+    try:
+        pending = next_batch()
+        while pending is not None:
+            data = pending.get()
+            pending = next_batch()
+            for block in data:
+                yield block
+    finally:
+        pool.terminate()
+
+class BamReader(object):
+    """Iterate over the alignment records of a BAM file.
+
+    The header is parsed on construction (text, and references as a list of
+    (name, length) tuples); iterating yields each record as a bytes object
+    starting at refID, i.e. without its block_size prefix.
+    """
+    def __init__(self, infile, threads=1):
+        self._blocks = read_bgzf(infile, threads)
+        self._buf = b""
+        self._pos = 0
+        if self._read(4) != BAM_MAGIC:
+            raise FormatError("not a BAM file")
+        l_text, = struct.unpack("<i", self._read(4))
+        self.text = self._read(l_text).rstrip(b"\0")
+        n_ref, = struct.unpack("<i", self._read(4))
+        self.references = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack("<i", self._read(4))
+            name = self._read(l_name).rstrip(b"\0")
+            l_ref, = struct.unpack("<i", self._read(4))
+            self.references.append((name.decode("ascii"), l_ref))
+
+    def _fill(self, n):
+        # make sure at least n unread bytes are buffered; False at EOF
+        while len(self._buf) - self._pos < n:
+            try:
+                block = next(self._blocks)
+            except StopIteration:
+                return False
+            self._buf = self._buf[self._pos:] + block
+            self._pos = 0
+        return True
+
+    def _read(self, n):
+        if not self._fill(n):
+            raise FormatError("truncated BAM file")
+        data = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+    def __iter__(self):
+        unpack_size = struct.Struct("<i").unpack_from
+        while self._fill(4):
+            block_size, = unpack_size(self._buf, self._pos)
+            if not self._fill(4 + block_size):
+                raise FormatError("truncated BAM record")
+            start = self._pos + 4
+            self._pos = start + block_size
+            yield self._buf[start:self._pos]
+
+    def has_records(self):
+        """True if there's at least one record after the header (reads no further)"""
+        return self._fill(4)
+
+def deflate(data):
+    """One complete BGZF block holding data"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6)
+    return header + struct.pack("<BBHH", 66, 67, 2, len(header) + 6 + len(payload) + 8 - 1) + \
+        payload + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfWriter(object):
+    """Write a BGZF file: data is buffered and cut into blocks, and close()
+    adds the EOF marker block.
+
+    With threads > 1, blocks are deflated in batches on a pool of threads;
+    each batch is written out while the next one compresses, so the caller's
+    work, compression and output overlap, with bounded memory.
+    """
+    def __init__(self, outfile, threads=1, batch=64):
+        self.outfile = outfile
+        self._buf = []
+        self._size = 0
+        self._blocks = []
+        self._batch = batch * max(threads, 1)
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._pending = None
+
+    def write(self, data):
+        self._buf.append(data)
+        self._size += len(data)
+        if self._size >= BGZF_BLOCK_DATA:
+            self._cut(BGZF_BLOCK_DATA)
+
+    def _cut(self, limit):
+        data = b"".join(self._buf)
+        while data and len(data) >= limit:
+            self._blocks.append(data[:BGZF_BLOCK_DATA])
+            data = data[BGZF_BLOCK_DATA:]
+        self._buf = [data] if data else []
+        self._size = len(data)
+        if len(self._blocks) >= self._batch:
+            self._dispatch()
+
+    def _dispatch(self):
+        if self._pool is None:
+            for block in self._blocks:
+                self.outfile.write(deflate(block))
+        else:
+            if self._pending is not None:
+                self.outfile.write(b"".join(self._pending.get()))
+            self._pending = self._pool.map_async(deflate, self._blocks)
+        self._blocks = []
+
+    def close(self):
+        self._cut(1)  # the last, partial block
+        self._dispatch()
+        if self._pool is not None:
+            self.outfile.write(b"".join(self._pending.get()))
+            self._pool.close()
+            self._pool.join()
+        self.outfile.write(BGZF_EOF)
+        self.outfile.flush()
+
+def header_bytes(text, references):
+    """The binary BAM header (magic, text and reference list)"""
+    parts = [BAM_MAGIC, struct.pack("<i", len(text)), text, struct.pack("<i", len(references))]
+    for name, length in references:
+        name = name.encode("ascii") + b"\0"
+        parts += [struct.pack("<i", len(name)), name, struct.pack("<i", length)]
+    return b"".join(parts)
+
+class BamWriter(object):
+    """Write a BAM file from a header (as from a BamReader) and raw records
+    (bytes starting at refID, as BamReader yields them)"""
+    def __init__(self, outfile, text, references, threads=1):
+        self._bgzf = BgzfWriter(outfile, threads)
+        self._bgzf.write(header_bytes(text, references))
+        self._pack_size = struct.Struct("<i").pack
+
+    def write(self, record):
+        self._bgzf.write(self._pack_size(len(record)) + record)
+
+    def close(self):
+        self._bgzf.close()
+
+def open_input(path):
+    """Open a BAM path for binary reading, '-' meaning stdin"""
+    if path == "-":
+        return getattr(sys.stdin, "buffer", sys.stdin)
+    return open(path, "rb")
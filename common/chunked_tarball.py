@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+Chunked gzip tarballs, for staging the viral-ngs resources quickly.
+
+`pack` cuts a tar stream into fixed-size pieces, compresses each one as an
+independent gzip member and concatenates them. The result is an ordinary
+.tar.gz as far as `pigz -dc | tar x` is concerned, plus a manifest listing the
+offset, length and sha256 of each compressed chunk:
+
+    tar -c -T files.txt | chunked_tarball.py pack --manifest manifest.json > resources.tar.gz
+
+`stage` extracts such a tarball, fetching chunks with parallel ranged reads
+and inflating them on a pool of threads while tar unpacks them in order. The
+tarball can be a platform file (link JSON or ID, with the manifest stored as
+its details) or a local file stand-in (with --manifest), e.g. for
+benchmarking:
+
+    chunked_tarball.py stage "$resources" -C /
+    chunked_tarball.py stage resources.tar.gz --manifest manifest.json -C /tmp/x
+
+With --cache-dir, fetched chunks are kept under their sha256 and reused by
+later stagings, and a tarball already staged into the same directory (by
+file ID and manifest digest) is skipped altogether. Tarballs without a
+manifest are streamed through `pigz -dc | tar x` as before.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+FORMAT = "chunked_gzip_tar/1"
+
+def gzip_member(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def inflate_member(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def ordered_map(pool, func, items, window):
+    """Like pool.imap, but with no more than window items in flight (or
+    finished but not yet consumed), to bound memory use."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def read_pieces(infile, size):
+    while True:
+        piece = b""
+        while len(piece) < size:
+            data = infile.read(size - len(piece))
+            if not data:
+                break
+            piece += data
+        if not piece:
+            return
+        yield piece
+        if len(piece) < size:
+            return
+
+def pack(infile, outfile, chunk_size, threads=1, level=6):
+    """Write the chunked gzip of infile to outfile; returns the manifest"""
+    chunks = []
+    offset = tar_size = 0
+    def compress(piece):
+        member = gzip_member(piece, level)
+        return len(piece), member, hashlib.sha256(member).hexdigest()
+    pool = ThreadPool(threads)
+    try:
+        for tar_length, member, sha256 in ordered_map(pool, compress, read_pieces(infile, chunk_size), threads + 1):
+            outfile.write(member)
+            chunks.append({"offset": offset, "length": len(member), "tar_length": tar_length, "sha256": sha256})
+            offset += len(member)
+            tar_size += tar_length
+    finally:
+        pool.terminate()
+    return {"format": FORMAT, "chunk_size": chunk_size, "size": offset, "tar_size": tar_size, "chunks": chunks}
+
+def manifest_digest(manifest):
+    return hashlib.sha256(json.dumps(manifest["chunks"], sort_keys=True).encode("ascii")).hexdigest()
+
+class LocalSource(object):
+    """A local file standing in for the platform file"""
+    def __init__(self, path, manifest_path=None):
+        self.path = path
+        self.id = os.path.abspath(path)
+        self.manifest_path = manifest_path
+        self._local = threading.local()
+
+    def manifest(self):
+        if self.manifest_path is None:
+            return None
+        with open(self.manifest_path) as infile:
+            return json.load(infile)
+
+    def read(self, offset, length):
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            handle = self._local.handle = open(self.path, "rb")
+        handle.seek(offset)
+        return handle.read(length)
+
+    def stream_command(self):
+        return "cat " + quote(self.path)
+
+class DXSource(object):
+    """A platform file; each thread reads through its own file handle"""
+    def __init__(self, link):
+        # dxpy is only needed for platform files
+        import dxpy
+        self.dxpy = dxpy
+        if link.startswith("{"):
+            self.id, self.project = dxpy.get_dxlink_ids(json.loads(link))
+        else:
+            self.id, self.project = link, None
+        self._local = threading.local()
+
+    def manifest(self):
+        details = self.dxpy.DXFile(self.id, project=self.project).get_details()
+        return details if isinstance(details, dict) and details.get("format") == FORMAT else None
+
+    def read(self, offset, length):
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            handle = self._local.handle = self.dxpy.DXFile(self.id, project=self.project)
+        handle.seek(offset)
+        return handle.read(length)
+
+    def stream_command(self):
+        return "dx cat " + quote(self.id if self.project is None else self.project + ":" + self.id)
+
+class ChunkCache(object):
+    """Compressed chunks stored under their sha256 in a local directory"""
+    def __init__(self, path):
+        self.path = path
+        for subdir in ["chunks", "staged"]:
+            if not os.path.isdir(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+
+    def get(self, sha256):
+        try:
+            with open(os.path.join(self.path, "chunks", sha256), "rb") as infile:
+                data = infile.read()
+        except IOError:
+            return None
+        return data if hashlib.sha256(data).hexdigest() == sha256 else None
+
+    def put(self, sha256, data):
+        path = os.path.join(self.path, "chunks", sha256)
+        with open(path + ".tmp", "wb") as outfile:
+            outfile.write(data)
+        os.rename(path + ".tmp", path)
+
+    def staged_marker(self, source, manifest, dest):
+        key = hashlib.sha256("\t".join([source.id, manifest_digest(manifest), os.path.abspath(dest)]).encode("utf-8"))
+        return os.path.join(self.path, "staged", key.hexdigest())
+
+def stage(source, dest, threads=8, cache=None, log=sys.stderr):
+    manifest = source.manifest()
+    if manifest is None:
+        log.write("{} has no chunk manifest; streaming it whole\n".format(source.id))
+        subprocess.check_call("set -o pipefail; {} | pigz -dc | tar x -C {}".format(source.stream_command(), quote(dest)),
+                              shell=True, executable="/bin/bash")
+        return
+
+    if cache is not None:
+        marker = cache.staged_marker(source, manifest, dest)
+        if os.path.exists(marker):
+            log.write("{} already staged into {}\n".format(source.id, dest))
+            return
+
+    counts = {"fetched": 0, "cached": 0}
+    lock = threading.Lock()
+    def fetch(chunk):
+        data = cache.get(chunk["sha256"]) if cache is not None else None
+        if data is not None:
+            kind = "cached"
+        else:
+            kind = "fetched"
+            data = source.read(chunk["offset"], chunk["length"])
+            if len(data) != chunk["length"] or hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+                raise IOError("chunk at offset {} of {} failed verification".format(chunk["offset"], source.id))
+            if cache is not None:
+                cache.put(chunk["sha256"], data)
+        with lock:
+            counts[kind] += len(data)
+        return inflate_member(data)
+
+    t0 = time.time()
+    tar = subprocess.Popen(["tar", "x", "-C", dest], stdin=subprocess.PIPE)
+    pool = ThreadPool(threads)
+    try:
+        for data in ordered_map(pool, fetch, manifest["chunks"], threads + 1):
+            tar.stdin.write(data)
+        tar.stdin.close()
+        if tar.wait() != 0:
+            raise subprocess.CalledProcessError(tar.returncode, "tar x")
+    except:
+        tar.kill()
+        raise
+    finally:
+        pool.terminate()
+    if cache is not None:
+        open(marker, "w").close()
+    elapsed = time.time() - t0
+    log.write("staged {} chunks of {} into {} in {:.1f}s: {:.1f} MB fetched, {:.1f} MB from cache, {:.1f} MB extracted ({:.1f} MB/s)\n".format(
+        len(manifest["chunks"]), source.id, dest, elapsed, counts["fetched"] / 1e6, counts["cached"] / 1e6,
+        manifest["tar_size"] / 1e6, manifest["tar_size"] / 1e6 / max(elapsed, 1e-6)))
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text[-1:].upper() in units:
+        return int(text[:-1]) * units[text[-1:].upper()]
+    return int(text)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    parser_pack = subparsers.add_parser("pack", help="Compress a tar stream from stdin into a chunked gzip on stdout")
+    parser_pack.set_defaults(command="pack")
+    parser_pack.add_argument("--manifest", required=True, help="Write the chunk manifest (JSON) to this file")
+    parser_pack.add_argument("--chunk-size", type=parse_size, default="32M",
+                             help="Uncompressed tar bytes per chunk (default: %(default)s)")
+    parser_pack.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                             help="Compression threads (default: %(default)s)")
+    parser_pack.add_argument("--level", type=int, default=6, help="gzip compression level (default: %(default)s)")
+
+    parser_stage = subparsers.add_parser("stage", help="Extract a chunked tarball")
+    parser_stage.set_defaults(command="stage")
+    parser_stage.add_argument("tarball", help="Platform file link JSON or ID, or a local file")
+    parser_stage.add_argument("--manifest", help="Chunk manifest for a local tarball")
+    parser_stage.add_argument("-C", dest="dest", default=".", help="Extract into this directory (default: %(default)s)")
+    parser_stage.add_argument("--threads", type=int, default=8,
+                              help="Chunks to fetch and inflate concurrently (default: %(default)s)")
+    parser_stage.add_argument("--cache-dir", default=os.environ.get("RESOURCES_CACHE_DIR"),
+                              help="Content-addressed chunk cache directory (default: $RESOURCES_CACHE_DIR, if set)")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        stdin = getattr(sys.stdin, "buffer", sys.stdin)
+        stdout = getattr(sys.stdout, "buffer", sys.stdout)
+        manifest = pack(stdin, stdout, args.chunk_size, args.threads, args.level)
+        stdout.flush()
+        with open(args.manifest, "w") as outfile:
+            json.dump(manifest, outfile, sort_keys=True)
+    else:
+        if os.path.exists(args.tarball):
+            source = LocalSource(args.tarball, args.manifest)
+        else:
+            source = DXSource(args.tarball)
+        cache = ChunkCache(args.cache_dir) if args.cache_dir else None
+        stage(source, args.dest, args.threads, cache)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Post-process the outputs of viral-ngs-demux, lane by lane.
+
+`upload` drops empty demuxed BAMs (reading each one only up to its first
+record, several at a time) and uploads the rest of a lane's outputs in
+parallel, with the flowcell/lane properties set as part of the upload. It
+records the uploaded file IDs by output name in a small JSON file:
+
+    demux_outputs.py upload --lane 1 --folder /lane_1 --flowcell H7VL2ADXX --lane-property \\
+        --record uploads/lane_1.json bams=out/bams/lane_1 metrics=out/metrics/lane_1 ...
+
+`gather` merges the records of all the lanes into the job's outputs:
+
+    demux_outputs.py gather uploads/*.json > job_output.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+import dxpy
+import bamio
+
+def is_empty_bam(path):
+    with open(path, "rb") as infile:
+        return not bamio.BamReader(infile).has_records()
+
+def list_files(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, name)))
+
+def upload(args):
+    outputs = []
+    for spec in args.outputs:
+        name, directory = spec.split("=", 1)
+        outputs.append((name, list_files(directory) if os.path.isdir(directory) else []))
+
+    properties = {}
+    if args.flowcell:
+        properties["flowcell"] = args.flowcell
+    if args.lane_property:
+        properties["lane"] = str(args.lane)
+
+    pool = ThreadPool(args.threads)
+    try:
+        # drop empty BAMs, which downstream tools don't handle gracefully
+        bams = dict(outputs).get("bams", [])
+        empty_bams = [bam for bam, empty in zip(bams, pool.map(is_empty_bam, bams)) if empty]
+        for bam in empty_bams:
+            print("===WARNING=== No reads found in demuxed bam file: {}. This file will be removed from output".format(os.path.basename(bam)))
+            bams.remove(bam)
+
+        def upload_file(name_and_path):
+            name, path = name_and_path
+            folder = args.folder
+            if name == "bams" and args.per_sample_output:
+                folder = os.path.join(args.folder, os.path.basename(path)[:-len(".bam")])
+            dxfile = dxpy.upload_local_file(path, folder=folder, parents=True, properties=properties)
+            return dxfile.get_id()
+
+        uploads = [(name, path) for name, paths in outputs for path in paths]
+        record = dict((name, []) for name, _ in outputs)
+        for (name, path), dxid in zip(uploads, pool.map(upload_file, uploads)):
+            record[name].append(dxid)
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Lane {}: uploaded {}".format(args.lane, ", ".join("{} {}".format(len(ids), name) for name, ids in sorted(record.items()))))
+    with open(args.record, "w") as outfile:
+        json.dump(record, outfile, sort_keys=True)
+
+def gather(args):
+    job_output = {}
+    for path in args.records:
+        with open(path) as infile:
+            for name, ids in json.load(infile).items():
+                job_output.setdefault(name, []).extend(dxpy.dxlink(dxid) for dxid in ids)
+    # leave out outputs no lane produced (e.g. the optional unmatched_bams)
+    job_output = dict((name, links) for name, links in job_output.items() if links)
+    json.dump(job_output, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    parser_upload = subparsers.add_parser("upload", help="Check and upload the outputs of one lane")
+    parser_upload.set_defaults(func=upload)
+    parser_upload.add_argument("outputs", nargs="+", metavar="NAME=DIR",
+                               help="Output name and the local directory holding its files")
+    parser_upload.add_argument("--lane", type=int, required=True)
+    parser_upload.add_argument("--folder", default="/", help="Destination folder (default: %(default)s)")
+    parser_upload.add_argument("--flowcell", help="Set this flowcell property on the uploaded files")
+    parser_upload.add_argument("--lane-property", action="store_true", help="Set the lane property on the uploaded files")
+    parser_upload.add_argument("--per-sample-output", action="store_true",
+                               help="Upload each BAM into a subfolder named after its sample")
+    parser_upload.add_argument("--record", required=True, help="Write the uploaded file IDs to this JSON file")
+    parser_upload.add_argument("--threads", type=int, default=8,
+                               help="Files to check and upload concurrently (default: %(default)s)")
+
+    parser_gather = subparsers.add_parser("gather", help="Merge lane records into job_output.json contents")
+    parser_gather.set_defaults(func=gather)
+    parser_gather.add_argument("records", nargs="+", help="JSON records written by upload")
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Helpers for applets that fan out one child job per input file.
+
+Launching from a job with the dx CLI costs a process start and an API round
+trip per describe, per `dx run` and per `dx-jobutil-add-output`, one after
+the other. These helpers describe all the inputs in one bulk call, submit the
+child jobs from a small pool of threads (retrying the ones the API turns away
+for rate limiting, each with a nonce so that a retried run can't launch a job
+twice), and write all the job's outputs in a single update of
+job_output.json:
+
+    describes = dxlaunch.describe_files(bams, ["name", "properties"])
+    job_ids = dxlaunch.run_all([dxlaunch.Launch(applet_id, {"in_bam": bam}, name="count_hits x")
+                                for bam in bams], threads=8)
+    dxlaunch.add_outputs({"count_files": [dxlaunch.jobref(job_id, "count_files") for job_id in job_ids]})
+"""
+from __future__ import print_function
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import dxpy
+
+# system/describeDataObjects takes up to 1000 objects per call
+DESCRIBE_BATCH = 1000
+
+# HTTP statuses of requests the API turned away, usually without acting on
+# them; a 503 can come after a run was accepted, so runs are only retried
+# with a nonce (see Launch)
+RETRY_STATUSES = (429, 503)
+
+def describe_files(links, fields):
+    """Describe the given files (links or IDs) with the given fields, in bulk.
+    Returns the describe hashes in the order of links."""
+    objects = []
+    for link in links:
+        if isinstance(link, dict):
+            file_id, project = dxpy.get_dxlink_ids(link)
+        else:
+            file_id, project = link, None
+        objects.append(dict([("id", file_id)] + ([("project", project)] if project else [])))
+
+    describes = []
+    for i in range(0, len(objects), DESCRIBE_BATCH):
+        response = with_retry(dxpy.api.system_describe_data_objects,
+                              {"objects": objects[i:i+DESCRIBE_BATCH],
+                               "classDescribeOptions": {"file": {"fields": dict((field, True) for field in fields)}}})
+        for obj, result in zip(objects[i:i+DESCRIBE_BATCH], response["results"]):
+            if "describe" not in result:
+                raise dxpy.exceptions.DXError("Could not describe {}".format(obj["id"]))
+            describes.append(result["describe"])
+    return describes
+
+def with_retry(func, *args, **kwargs):
+    """Call func, backing off and retrying while the API rate-limits it"""
+    attempts = kwargs.pop("attempts", 8)
+    delay = 1.0
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except dxpy.exceptions.DXAPIError as e:
+            if getattr(e, "code", None) not in RETRY_STATUSES or attempt == attempts - 1:
+                raise
+            print("{} (HTTP {}); retrying in {:.0f}s".format(e.name, e.code, delay), file=sys.stderr)
+            time.sleep(delay * random.uniform(1.0, 1.5))
+            delay = min(delay * 2, 60.0)
+
+class Launch(object):
+    """A child job to run: an applet ID, its input and dx run options
+    (name, folder, depends_on, instance_type, ...).
+
+    Every attempt to run it sends the same nonce, so the API creates at most
+    one job for it even if an attempt it accepted is retried."""
+    def __init__(self, applet_id, applet_input, **options):
+        self.applet_id = applet_id
+        self.input = applet_input
+        self.options = options
+        self.nonce = uuid.uuid4().hex
+
+    def run(self):
+        options = dict(self.options)
+        options["extra_args"] = dict(options.get("extra_args") or {}, nonce=self.nonce)
+        job = with_retry(dxpy.DXApplet(self.applet_id).run, self.input, **options)
+        return job.get_id()
+
+def run_all(launches, threads=8):
+    """Submit the launches concurrently; returns the job IDs in order"""
+    if not launches:
+        return []
+    pool = ThreadPool(min(threads, len(launches)))
+    try:
+        job_ids = pool.map(lambda launch: launch.run(), launches)
+    finally:
+        pool.close()
+        pool.join()
+    print("Launched {} jobs".format(len(job_ids)), file=sys.stderr)
+    return job_ids
+
+def jobref(job_id, field, index=None):
+    """A reference to a job's output, or to one element of an array output"""
+    if index is None:
+        return dxpy.dxlink(job_id, field=field)
+    return {"$dnanexus_link": {"job": job_id, "field": field, "index": index}}
+
+def add_outputs(outputs, path="job_output.json"):
+    """Add outputs to the job's output file in one write, keeping any output
+    already added to it (e.g. by dx-jobutil-add-output)"""
+    job_output = {}
+    if os.path.exists(path):
+        with open(path) as infile:
+            job_output = json.load(infile)
+    job_output.update(outputs)
+    with open(path + ".tmp", "w") as outfile:
+        json.dump(job_output, outfile, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
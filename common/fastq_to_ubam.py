@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Convert a pair of FASTQ files to an unaligned BAM in one streaming pass, in
+place of Picard FastqToSam:
+
+    fastq_to_ubam.py <(dx cat "$r1" | pigz -dc) <(dx cat "$r2" | pigz -dc) reads.bam \\
+        --sample-name "$sample_name" > reads.stats.json
+
+The mates are read in lockstep and must come in the same order. Read names
+are cut at the first whitespace, less a /1 or /2 suffix, and SRA's
+SRRnnn.m.1 and SRRnnn.m.2 are both named SRRnnn.m. The records are flagged
+as paired and unmapped (with first and second of pair), in one read group
+(ID:A, as FastqToSam's default) for the sample, and written in input order
+(SO:unsorted), BGZF blocks being deflated on a pool of threads.
+
+Prints a JSON summary of the read_count, base_count and paired_count, as
+bam_stats.py would for the output.
+"""
+from __future__ import print_function
+import argparse
+import binascii
+import json
+import multiprocessing
+import re
+import struct
+import sys
+
+import bamio
+from bamio import FPAIRED, FUNMAP, FMUNMAP, FREAD1, FREAD2
+
+SRA_MATE_NAME = re.compile(br"^(SRR[0-9]+\.[0-9]+)\.[12]$")
+
+# the bin of an unplaced record, reg2bin(-1, 0)
+UNPLACED_BIN = 4680
+
+# bases to the hex digits of their 4-bit BAM codes ("=ACMGRSVTWYHKDBN"), so
+# that unhexlify() packs two to a byte; anything else is N
+SEQ_HEX = bytearray(b"f" * 256)
+for _code, _base in enumerate(b"=ACMGRSVTWYHKDBN"):
+    _base = ord(_base) if isinstance(_base, str) else _base
+    for _case in (_base, ord(chr(_base).lower())):
+        SEQ_HEX[_case] = ord("0123456789abcdef"[_code])
+SEQ_HEX = bytes(SEQ_HEX)
+
+# Phred+33 quality characters to Phred scores
+QUAL_SCORES = bytes(bytearray((i - 33) % 256 for i in range(256)))
+
+class FastqError(ValueError):
+    pass
+
+def fastq_records(infile):
+    """Yield (name line, sequence, quality) from a FASTQ file"""
+    while True:
+        header = infile.readline()
+        if not header:
+            return
+        seq, plus, qual = infile.readline().rstrip(b"\r\n"), infile.readline(), infile.readline().rstrip(b"\r\n")
+        if not header.startswith(b"@") or not plus.startswith(b"+") or len(seq) != len(qual):
+            raise FastqError("malformed FASTQ record: {!r}".format(header))
+        yield header, seq, qual
+
+def read_name(header):
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else b""
+    if name.endswith(b"/1") or name.endswith(b"/2"):
+        name = name[:-2]
+    return SRA_MATE_NAME.sub(br"\1", name)
+
+def ubam_record(name, seq, qual, flag, aux):
+    """An unaligned BAM record, without its block_size prefix"""
+    packed = binascii.unhexlify(seq.translate(SEQ_HEX) + (b"0" if len(seq) % 2 else b""))
+    core = bamio.RECORD_CORE.pack(-1, -1, len(name) + 1, 0, UNPLACED_BIN, 0, flag, len(seq), -1, -1, 0)
+    return b"".join([core, name, b"\0", packed, qual.translate(QUAL_SCORES), aux])
+
+def header_text(sample_name, read_group="A"):
+    return "@HD\tVN:1.5\tSO:unsorted\n@RG\tID:{}\tSM:{}\n".format(read_group, sample_name).encode("utf-8")
+
+def fastq_to_ubam(infile1, infile2, writer, read_group="A"):
+    """Write the mates of two FASTQ files as BAM records; returns the counts"""
+    aux = b"RGZ" + read_group.encode("utf-8") + b"\0"
+    read1_flag = FPAIRED | FUNMAP | FMUNMAP | FREAD1
+    read2_flag = FPAIRED | FUNMAP | FMUNMAP | FREAD2
+    read_count = base_count = 0
+    records1, records2 = fastq_records(infile1), fastq_records(infile2)
+    for mate1 in records1:
+        mate2 = next(records2, None)
+        if mate2 is None:
+            raise FastqError("the second FASTQ file has fewer reads than the first")
+        name = read_name(mate1[0])
+        if read_name(mate2[0]) != name:
+            raise FastqError("mates out of step: {!r} and {!r}".format(mate1[0], mate2[0]))
+        writer.write(ubam_record(name, mate1[1], mate1[2], read1_flag, aux))
+        writer.write(ubam_record(name, mate2[1], mate2[2], read2_flag, aux))
+        read_count += 2
+        base_count += (len(mate1[1]) or 1) + (len(mate2[1]) or 1)
+    if next(records2, None) is not None:
+        raise FastqError("the second FASTQ file has more reads than the first")
+    return {"read_count": read_count, "base_count": base_count, "paired_count": read_count}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fastq1", help="FASTQ file of the first mates")
+    parser.add_argument("fastq2", help="FASTQ file of the second mates")
+    parser.add_argument("out_bam", help="Output BAM file")
+    parser.add_argument("--sample-name", required=True, help="Sample name (SM) of the read group")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Threads for BGZF compression (default: %(default)s)")
+    args = parser.parse_args()
+
+    with open(args.fastq1, "rb") as infile1, open(args.fastq2, "rb") as infile2, open(args.out_bam, "wb") as outfile:
+        writer = bamio.BamWriter(outfile, header_text(args.sample_name), [], args.threads)
+        counts = fastq_to_ubam(infile1, infile2, writer)
+        writer.close()
+    json.dump(counts, sys.stdout, sort_keys=True)
+    print()
+
+if __name__ == "__main__":
+    main()
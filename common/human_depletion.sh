@@ -0,0 +1,68 @@
+# Functions shared by the viral-ngs-human-depletion and
+# viral-ngs-human-depletion-batch applets, which source this file from
+# /usr/local/bin
+
+# Stage the databases for BMTagger and BLAST, setting local_bmtagger_dbs and
+# local_blast_dbs
+stage_dbs() {
+    # assumptions: each database is stored in a tarball. If the database name
+    # is X then the tarball is named X.bmtagger_db.tar.gz or X.blastndb.tar.gz.
+    # The tarball contains the database files in the root (NOT in subdirectory
+    # X/). The individual database files have X as their base name, e.g.
+    # X.srprism.amp, X.nin
+    local pids=()
+    mkdir bmtagger_db
+    local_bmtagger_dbs=""
+    for tarball in "${bmtagger_dbs[@]}"; do
+        dbname=$(dx describe "$tarball" --name)
+        dbname=${dbname%.bmtagger_db.tar.gz}
+        mkdir "bmtagger_db/${dbname}"
+        local_bmtagger_dbs="${local_bmtagger_dbs} /user-data/bmtagger_db/${dbname}/${dbname}"
+        dx cat "$tarball" | pigz -dc | tar x -C "bmtagger_db/${dbname}" & pids+=($!)
+    done
+
+    mkdir blast_db
+    local_blast_dbs=""
+    for tarball in "${blast_dbs[@]}"; do
+        dbname=$(dx describe "$tarball" --name)
+        dbname=${dbname%.blastndb.tar.gz}
+        mkdir "blast_db/${dbname}"
+        local_blast_dbs="${local_blast_dbs} /user-data/blast_db/${dbname}/${dbname}"
+        dx cat "$tarball" | pigz -dc | tar x -C "blast_db/${dbname}" & pids+=($!)
+    done
+
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
+    find bmtagger_db -type f
+    find blast_db -type f
+}
+
+# Run deplete_human on a BAM, writing raw.bam, bmtagger_depleted.bam,
+# rmdup.bam and cleaned.bam into the given directory
+deplete_reads() {
+    in_bam=$1
+    out_dir=$2
+
+    # find 90% memory, for java
+    mem_in_mb=`head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}'`
+
+    # run deplete_human
+    viral-ngs taxon_filter.py deplete_human \
+        --JVMmemory ${mem_in_mb}m --threads `nproc` \
+        "/user-data/$in_bam" "/user-data/$out_dir/raw.bam" "/user-data/$out_dir/bmtagger_depleted.bam" \
+        "/user-data/$out_dir/rmdup.bam" "/user-data/$out_dir/cleaned.bam" \
+        --bmtaggerDbs $local_bmtagger_dbs --blastDbs $local_blast_dbs
+}
+
+# Output subfolder for a sample: /SAMPLE, or /lane_N/SAMPLE using the lane
+# metadata recorded in the BAM property at the end of demux, if
+# per_sample_output is set; empty otherwise
+output_subfolder() {
+    if [ "$per_sample_output" == "true" ]; then
+        lane=$(dx describe --json "$1" | jq -r .properties.lane)
+        if [ "$lane" == "null" ]; then
+            echo "/$2"
+        else
+            echo "/lane_$lane/$2"
+        fi
+    fi
+}
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Per-reference hit counts straight from a SAM stream, in the format of
+`samtools idxstats`, without sorting, indexing or writing a BAM:
+
+    bwa mem ref.fa reads.fq | sam_idxstats.py > hit_counts.txt
+
+Each line has the reference name, its length, and the numbers of mapped and
+of unmapped records placed on it (unmapped reads whose mate mapped there);
+a final `*` line counts the records placed on no reference. Like idxstats,
+every record is counted, secondary and supplementary alignments included.
+
+With --mapq-histogram, also writes the MAPQ distribution of the mapped
+records on each reference, as reference, MAPQ and count columns.
+"""
+from __future__ import print_function
+import argparse
+import sys
+
+from bamio import FUNMAP
+
+class HitCounts(object):
+    """Accumulates idxstats counts from SAM lines; see add_line()"""
+    def __init__(self, mapq_histogram=False):
+        self.names = []
+        self.lengths = []
+        self.index = {}
+        self.mapped = []
+        self.unmapped = []
+        self.unplaced = 0
+        self.mapq = [] if mapq_histogram else None
+
+    def add_reference(self, name, length):
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.lengths.append(length)
+        self.mapped.append(0)
+        self.unmapped.append(0)
+        if self.mapq is not None:
+            self.mapq.append({})
+
+    def add_header(self, line):
+        if line.startswith("@SQ\t"):
+            tags = dict(field.split(":", 1) for field in line.rstrip("\r\n").split("\t")[1:])
+            self.add_reference(tags["SN"], int(tags["LN"]))
+
+    def add_line(self, line):
+        if line.startswith("@"):
+            self.add_header(line)
+            return
+        fields = line.split("\t", 5)
+        if fields[2] == "*":
+            self.unplaced += 1
+            return
+        i = self.index[fields[2]]
+        if int(fields[1]) & FUNMAP:
+            self.unmapped[i] += 1
+        else:
+            self.mapped[i] += 1
+            if self.mapq is not None:
+                mapq = int(fields[4])
+                self.mapq[i][mapq] = self.mapq[i].get(mapq, 0) + 1
+
+    def write(self, outfile):
+        for name, length, mapped, unmapped in zip(self.names, self.lengths, self.mapped, self.unmapped):
+            outfile.write("{}\t{}\t{}\t{}\n".format(name, length, mapped, unmapped))
+        outfile.write("*\t0\t0\t{}\n".format(self.unplaced))
+
+    def write_mapq_histogram(self, outfile):
+        outfile.write("reference\tmapq\tcount\n")
+        for name, histogram in zip(self.names, self.mapq):
+            for mapq in sorted(histogram):
+                outfile.write("{}\t{}\t{}\n".format(name, mapq, histogram[mapq]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sam", nargs="?", default="-", help="Input SAM file (default: stdin)")
+    parser.add_argument("--mapq-histogram", metavar="FILE", help="Also write per-reference MAPQ histograms to FILE")
+    args = parser.parse_args()
+
+    counts = HitCounts(mapq_histogram=args.mapq_histogram is not None)
+    infile = sys.stdin if args.sam == "-" else open(args.sam)
+    for line in infile:
+        counts.add_line(line)
+    counts.write(sys.stdout)
+    if args.mapq_histogram:
+        with open(args.mapq_histogram, "w") as outfile:
+            counts.write_mapq_histogram(outfile)
+
+if __name__ == "__main__":
+    main()
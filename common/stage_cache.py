@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+Memoize assembly workflow stages: reuse the outputs of an earlier job of the
+same applet (version) on the same inputs instead of recomputing them.
+
+A job's key is the sha256 of its applet's name and source_sha256 (or ID), and
+of its input with every file replaced by a digest of its content (its size
+and the md5s of its upload parts) and the stage_cache input left out. Scalar
+parameters and the resources tarball are covered that way too.
+
+At the start of a job, `lookup` writes the cached outputs to job_output.json
+and exits 0 on a hit; it exits 1 on a miss, or if any cached output file is
+gone. At the end of a job, `store` records its outputs under its key:
+
+    if stage_cache.py lookup --folder "$stage_cache" --applet viral-ngs-filter job_input.json; then
+        exit 0
+    fi
+    ...
+    stage_cache.py store --folder "$stage_cache" --applet viral-ngs-filter job_input.json job_output.json
+
+The cache is either a folder of records on the platform (--folder
+[PROJECT:]FOLDER) or a local directory (--local DIR). Entries only refer to
+the output files, which stay where the original job put them, also when a
+hit returns them as a later job's outputs. Recording entries and hits needs
+CONTRIBUTE access to the cache's project; without it, `store` and hit counts
+are skipped with a warning, and lookups still work. `evict` forgets
+entries unused for longer than --max-age-days, then the least recently used
+ones until the files they refer to add up to no more than --max-bytes.
+`report` prints each applet's entries, hits, hit rate and bytes.
+
+With --offline, files are keyed by their IDs (files are immutable, so this
+is sound, just blind to re-uploads of the same content) and the applet by
+--applet alone; together with --local, no platform access is needed, e.g.
+for testing.
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+def is_link(value):
+    return isinstance(value, dict) and list(value.keys()) == ["$dnanexus_link"]
+
+def link_id(link):
+    target = link["$dnanexus_link"]
+    return target["id"] if isinstance(target, dict) else target
+
+def file_links(value):
+    """All the links in an input or output hash, arrays and hashes included"""
+    if is_link(value):
+        return [value]
+    if isinstance(value, dict):
+        return [link for key in sorted(value) for link in file_links(value[key])]
+    if isinstance(value, list):
+        return [link for item in value for link in file_links(item)]
+    return []
+
+def replace_links(value, digests):
+    if is_link(value):
+        return {"digest": digests[link_id(value)]}
+    if isinstance(value, dict):
+        return dict((key, replace_links(item, digests)) for key, item in value.items())
+    if isinstance(value, list):
+        return [replace_links(item, digests) for item in value]
+    return value
+
+def content_digest(describe):
+    parts = describe.get("parts") or {}
+    digest = hashlib.sha256(str(describe["size"]).encode("ascii"))
+    for index in sorted(parts, key=int):
+        digest.update("\t{}:{}:{}".format(index, parts[index]["md5"], parts[index]["size"]).encode("ascii"))
+    return digest.hexdigest()
+
+def file_digests(links, offline=False):
+    """file ID => content digest"""
+    ids = [link_id(link) for link in links]
+    if offline or not ids:
+        return dict((file_id, file_id) for file_id in ids)
+    import dxlaunch
+    return dict((file_id, content_digest(describe))
+                for file_id, describe in zip(ids, dxlaunch.describe_files(links, ["size", "parts"])))
+
+def applet_version(offline=False):
+    """The running job's applet's source_sha256 property, or its ID"""
+    if offline or "DX_JOB_ID" not in os.environ:
+        return None
+    import dxpy
+    applet_id = dxpy.describe(os.environ["DX_JOB_ID"], fields={"applet": True})["applet"]
+    properties = dxpy.describe(applet_id, fields={"properties": True}).get("properties") or {}
+    return properties.get("source_sha256", applet_id)
+
+def job_key(applet, job_input, offline=False):
+    job_input = dict((name, value) for name, value in job_input.items() if name != "stage_cache")
+    keyed = {"applet": applet, "version": applet_version(offline),
+             "input": replace_links(job_input, file_digests(file_links(job_input), offline))}
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True).encode("utf-8")).hexdigest()
+
+class Entry(object):
+    def __init__(self, applet, key, outputs, size, created, last_used, hits, handle=None):
+        self.applet = applet
+        self.key = key
+        self.outputs = outputs
+        self.size = size
+        self.created = created
+        self.last_used = last_used
+        self.hits = hits
+        self.handle = handle
+
+class LocalStore(object):
+    """Entries as DIR/APPLET/KEY.json files"""
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, applet, key):
+        return os.path.join(self.path, applet, key + ".json")
+
+    def _write(self, entry):
+        path = self._path(entry.applet, entry.key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "w") as outfile:
+            json.dump({"outputs": entry.outputs, "size": entry.size, "created": entry.created,
+                       "last_used": entry.last_used, "hits": entry.hits}, outfile, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    def _read(self, applet, key):
+        with open(self._path(applet, key)) as infile:
+            data = json.load(infile)
+        return Entry(applet, key, data["outputs"], data["size"], data["created"], data["last_used"], data["hits"])
+
+    def get(self, applet, key):
+        if not os.path.exists(self._path(applet, key)):
+            return None
+        return self._read(applet, key)
+
+    def put(self, entry):
+        self._write(entry)
+        return True
+
+    def record_hit(self, entry):
+        entry.hits += 1
+        entry.last_used = time.time()
+        self._write(entry)
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [self._read(applet, name[:-len(".json")])
+                for applet in sorted(os.listdir(self.path)) if os.path.isdir(os.path.join(self.path, applet))
+                for name in sorted(os.listdir(os.path.join(self.path, applet))) if name.endswith(".json")]
+
+    def remove(self, entries):
+        for entry in entries:
+            os.remove(self._path(entry.applet, entry.key))
+
+    def outputs_exist(self, entry, offline):
+        return offline or files_exist(file_links(entry.outputs))
+
+class DXStore(object):
+    """Entries as closed records named APPLET.KEY in a platform folder, with
+    the outputs in their details and the usage in their properties"""
+    def __init__(self, spec):
+        import dxpy
+        self.dxpy = dxpy
+        if ":" in spec:
+            self.project, self.folder = spec.split(":", 1)
+        else:
+            self.project, self.folder = dxpy.PROJECT_CONTEXT_ID, spec
+        self.folder = self.folder or "/"
+
+    def _entry(self, result):
+        describe = result["describe"]
+        details = describe["details"]
+        properties = describe.get("properties") or {}
+        applet, key = describe["name"].rsplit(".", 1)
+        return Entry(applet, key, details["outputs"], details["size"], details["created"],
+                     float(properties.get("last_used", details["created"])), int(properties.get("hits", 0)),
+                     handle=result["id"])
+
+    def _find(self, **query):
+        return self.dxpy.find_data_objects(classname="record", project=self.project, folder=self.folder,
+                                           recurse=False, state="closed",
+                                           describe={"fields": {"name": True, "details": True, "properties": True}},
+                                           **query)
+
+    def get(self, applet, key):
+        for result in self._find(name="{}.{}".format(applet, key)):
+            return self._entry(result)
+        return None
+
+    def put(self, entry):
+        try:
+            self.dxpy.api.project_new_folder(self.project, {"folder": self.folder, "parents": True})
+            self.dxpy.new_dxrecord(project=self.project, folder=self.folder,
+                                   name="{}.{}".format(entry.applet, entry.key),
+                                   details={"outputs": entry.outputs, "size": entry.size, "created": entry.created},
+                                   properties={"hits": "0", "last_used": str(entry.last_used)}, close=True)
+            return True
+        except self.dxpy.exceptions.PermissionDenied:
+            self._read_only()
+            return False
+
+    def record_hit(self, entry):
+        try:
+            self.dxpy.api.record_set_properties(entry.handle, {"project": self.project, "properties": {
+                "hits": str(entry.hits + 1), "last_used": str(time.time())}})
+        except self.dxpy.exceptions.PermissionDenied:
+            self._read_only()
+
+    def _read_only(self):
+        # the applet only gets CONTRIBUTE access in workflows built with
+        # --stage-cache; without it, lookups still work but nothing is recorded
+        print("stage cache: no write access to {}:{}, not recording; build the workflow with --stage-cache "
+              "to give its stages CONTRIBUTE access".format(self.project, self.folder), file=sys.stderr)
+
+    def entries(self):
+        return [self._entry(result) for result in self._find()]
+
+    def remove(self, entries):
+        if entries:
+            self.dxpy.api.project_remove_objects(self.project, {"objects": [entry.handle for entry in entries]})
+
+    def outputs_exist(self, entry, offline):
+        return files_exist(file_links(entry.outputs))
+
+def files_exist(links):
+    import dxlaunch
+    import dxpy
+    try:
+        return all(describe["state"] == "closed" for describe in dxlaunch.describe_files(links, ["state"]))
+    except dxpy.exceptions.DXError:
+        return False
+
+def project_links(value, project):
+    """Output links pinned to the project the job's outputs end up in"""
+    if is_link(value):
+        return {"$dnanexus_link": {"project": project, "id": link_id(value)}}
+    if isinstance(value, dict):
+        return dict((key, project_links(item, project)) for key, item in value.items())
+    if isinstance(value, list):
+        return [project_links(item, project) for item in value]
+    return value
+
+def open_store(args):
+    return LocalStore(args.local) if args.local else DXStore(args.folder)
+
+def lookup(args):
+    store = open_store(args)
+    with open(args.job_input) as infile:
+        key = job_key(args.applet, json.load(infile), args.offline)
+    entry = store.get(args.applet, key)
+    if entry is None or not store.outputs_exist(entry, args.offline):
+        print("stage cache miss: {} {}".format(args.applet, key), file=sys.stderr)
+        sys.exit(1)
+
+    outputs = entry.outputs
+    if not args.offline and "DX_WORKSPACE_ID" in os.environ:
+        # bring the cached files into the job's workspace, so they can be its outputs
+        import dxpy
+        by_project = {}
+        for link in file_links(outputs):
+            by_project.setdefault(link["$dnanexus_link"]["project"], []).append(link_id(link))
+        for project, ids in by_project.items():
+            dxpy.api.project_clone(project, {"objects": ids, "project": os.environ["DX_WORKSPACE_ID"], "destination": "/"})
+    with open(args.job_output, "w") as outfile:
+        json.dump(outputs, outfile, indent=2, sort_keys=True)
+    print("stage cache hit: {} {} (stored {}, {} earlier hits)".format(
+        args.applet, key, time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.created)), entry.hits), file=sys.stderr)
+    store.record_hit(entry)
+
+def store(args):
+    store = open_store(args)
+    with open(args.job_input) as infile:
+        key = job_key(args.applet, json.load(infile), args.offline)
+    with open(args.job_output) as infile:
+        outputs = json.load(infile)
+
+    links = file_links(outputs)
+    size = 0
+    if not args.offline and links:
+        import dxlaunch
+        size = sum(describe["size"] for describe in dxlaunch.describe_files(links, ["size"]))
+    if "DX_PROJECT_CONTEXT_ID" in os.environ:
+        outputs = project_links(outputs, os.environ["DX_PROJECT_CONTEXT_ID"])
+    now = time.time()
+    if not store.put(Entry(args.applet, key, outputs, size, now, now, 0)):
+        return
+    print("stage cache store: {} {} ({} files, {:.1f} MB)".format(args.applet, key, len(links), size / 1e6), file=sys.stderr)
+
+def evict(args):
+    store = open_store(args)
+    entries = sorted(store.entries(), key=lambda entry: entry.last_used)
+    now = time.time()
+    evicted = []
+    if args.max_age_days is not None:
+        evicted = [entry for entry in entries if now - entry.last_used > args.max_age_days * 86400]
+    kept = [entry for entry in entries if entry not in evicted]
+    if args.max_bytes is not None:
+        total = sum(entry.size for entry in kept)
+        while kept and total > args.max_bytes:
+            total -= kept[0].size
+            evicted.append(kept.pop(0))
+    store.remove(evicted)
+    print("evicted {} entries ({:.1f} MB), kept {} ({:.1f} MB)".format(
+        len(evicted), sum(entry.size for entry in evicted) / 1e6, len(kept), sum(entry.size for entry in kept) / 1e6))
+
+def report(args):
+    # every entry was stored after a miss, so the stores count the misses
+    totals = {}
+    for entry in open_store(args).entries():
+        applet_totals = totals.setdefault(entry.applet, [0, 0, 0])
+        applet_totals[0] += 1
+        applet_totals[1] += entry.hits
+        applet_totals[2] += entry.size
+    print("\t".join(["applet", "entries", "hits", "hit_rate", "mbytes"]))
+    rows = sorted(totals.items())
+    if rows:
+        rows.append(("total", [sum(values[i] for _, values in rows) for i in range(3)]))
+    for applet, (entries, hits, size) in rows:
+        print("\t".join([applet, str(entries), str(hits), "{:.2f}".format(float(hits) / (hits + entries)),
+                         "{:.1f}".format(size / 1e6)]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    def add_store_options(subparser):
+        group = subparser.add_mutually_exclusive_group(required=True)
+        group.add_argument("--folder", help="Cache records in this [PROJECT:]FOLDER on the platform")
+        group.add_argument("--local", metavar="DIR", help="Cache entries in this local directory")
+
+    def add_job_options(subparser):
+        add_store_options(subparser)
+        subparser.add_argument("--applet", required=True, help="Applet name")
+        subparser.add_argument("--offline", action="store_true",
+                               help="Key files by ID and the applet by name only, without platform access")
+        subparser.add_argument("job_input", help="The job's job_input.json")
+
+    parser_lookup = subparsers.add_parser("lookup", help="Write the outputs of a cached job to job_output.json; exit 1 if none")
+    parser_lookup.set_defaults(func=lookup)
+    add_job_options(parser_lookup)
+    parser_lookup.add_argument("--job-output", default="job_output.json", help="Write the outputs here (default: %(default)s)")
+
+    parser_store = subparsers.add_parser("store", help="Cache a job's outputs")
+    parser_store.set_defaults(func=store)
+    add_job_options(parser_store)
+    parser_store.add_argument("job_output", help="The job's job_output.json")
+
+    parser_evict = subparsers.add_parser("evict", help="Forget entries by age and total size")
+    parser_evict.set_defaults(func=evict)
+    add_store_options(parser_evict)
+    parser_evict.add_argument("--max-age-days", type=float, help="Forget entries unused for longer than this")
+    parser_evict.add_argument("--max-bytes", type=int, help="Forget the least recently used entries beyond this total output size")
+
+    parser_report = subparsers.add_parser("report", help="Print entries, hits and hit rate per applet")
+    parser_report.set_defaults(func=report)
+    add_store_options(parser_report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
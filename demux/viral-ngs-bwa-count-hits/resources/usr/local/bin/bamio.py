@@ -0,0 +1 @@
+../../../../../../common/bamio.py
\ No newline at end of file
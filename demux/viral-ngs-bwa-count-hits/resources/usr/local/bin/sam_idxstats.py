@@ -0,0 +1 @@
+../../../../../../common/sam_idxstats.py
\ No newline at end of file
@@ -29,12 +29,20 @@ main() {
         sample_out_fn="$sample_name.$out_fn"
     fi
 
-    # Perform bwa mapping
-    samtools bam2fq "${in_bam_path}" | bwa mem -t `nproc` -p "$genome_file" - | samtools view -u -S - | samtools sort -m 256M -@ `nproc` - output
+    mapq_opts=()
+    if [ "$mapq_histogram" == "true" ]; then
+        mapq_out_dir="out/mapq_histograms"
+        if [ "$per_sample_output" == "true" ]; then
+            mapq_out_dir="$mapq_out_dir/$sample_name"
+        fi
+        mkdir -p "$mapq_out_dir"
+        mapq_opts=("--mapq-histogram" "${mapq_out_dir}/${sample_name}.mapq_histogram.txt")
+    fi
 
-    # Store idxstats output as desired output file
-    samtools index output.bam
-    samtools idxstats output.bam > "${out_dir}/${sample_out_fn}"
+    # Perform bwa mapping, counting the hits per reference (in samtools
+    # idxstats format) straight from the alignment stream
+    samtools bam2fq "${in_bam_path}" | bwa mem -t `nproc` -p "$genome_file" - \
+        | sam_idxstats.py "${mapq_opts[@]}" > "${out_dir}/${sample_out_fn}"
 
     dx-upload-all-outputs
 }
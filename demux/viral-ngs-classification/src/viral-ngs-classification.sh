@@ -11,19 +11,39 @@ set -e -x -o pipefail
 dstat -cmdn 60 &
 
 function main() {
-  dx cat "$resources" | pigz -dc | tar x -C /
-
-  # Fetch and decompress Kraken & Krona databases.
-  extract_db "$kraken_db" "$kraken_db_name" "$kraken_db_prefix"
-  extract_db "$krona_taxonomy_db" "$krona_taxonomy_db_name" "$krona_taxonomy_db_prefix"
-
-  # Process input samples
-  export -f process_bam
+  # Stage the resources and the Kraken & Krona databases, and prefetch the
+  # input BAMs, all at once. Classification starts as soon as the resources
+  # and Kraken database are in place; each worker then waits only for its own
+  # BAM, and for the Krona database before its Krona step.
+  mkdir scratch uploads
   export SHELL=/bin/bash
-  parallel --delay 1 -P 8 -t process_bam "$kraken_db_prefix" "$krona_taxonomy_db_prefix" ::: "${mappings[@]}"
+  export -f prefetch_bam wait_for
+  pids=()
+  chunked_tarball.py stage "$resources" -C / & pids+=($!)
+  extract_db "$kraken_db" "$kraken_db_name" "$kraken_db_prefix" & pids+=($!)
+  extract_db "$krona_taxonomy_db" "$krona_taxonomy_db_name" "$krona_taxonomy_db_prefix" & krona_pid=$!
+  parallel -j 4 prefetch_bam ::: "${mappings[@]}" & prefetch_pid=$!
+  for pid in "${pids[@]}"; do wait $pid || exit $?; done
+
+  # All the workers classify against the same Kraken database. Kraken maps
+  # it into memory, so once it's in the page cache the workers share that
+  # single copy instead of each reading it again.
+  size_workers
+  if [ "$kraken_db_mb" -lt "$mem_in_mb" ]; then
+    cat "./$kraken_db_prefix"/*.kdb "./$kraken_db_prefix"/*.idx > /dev/null
+  fi
 
-  # upload outputs
-  dx-upload-all-outputs --parallel
+  # Process input samples; each one's outputs are uploaded as soon as it's done
+  export -f process_bam
+  export kraken_threads krona_pid prefetch_pid
+  parallel --delay 1 -P "$workers" -t process_bam "$kraken_db_prefix" "$krona_taxonomy_db_prefix" ::: "${mappings[@]}"
+  wait $krona_pid || exit $?
+  wait $prefetch_pid || true
+
+  # Output the uploaded files in the order of the input BAMs
+  for i in $(seq 1 ${#mappings[@]}); do
+    cat "uploads/$i.ids"
+  done | jq -Rn '{outputs: [inputs | {"$dnanexus_link": .}]}' > job_output.json
 }
 
 function extract_db() {
@@ -40,15 +60,69 @@ function extract_db() {
     decompressor="lz4 -d"
   fi
 
-  dx cat "$db_id" | $decompressor | tar -C "./$db_prefix" -xvf -
+  # The member listing tar prints as it extracts tells whether the tarball
+  # has a top-level dir, without walking the extracted tree afterwards.
+  dx cat "$db_id" | $decompressor | tar -C "./$db_prefix" -xvf - > "./${db_prefix}.members"
 
-  if [ $(find "./$db_prefix" -type f | cut -d / -f 2,3 | sort | uniq | wc -l) -eq "1" ]; then
+  top_dir=$(top_level_dir "./${db_prefix}.members")
+  if [ -n "$top_dir" ]; then
     # If tarball has top-level dir, then move contents of that dir up one dir.
-    mv ./${db_prefix}/$(find "./$db_prefix" -type f | cut -d / -f 3 | uniq)/* ./${db_prefix}
-    find "./$db_prefix" -type f
+    mv "./${db_prefix}/${top_dir}"/* "./${db_prefix}"
   fi
 
   du -sh "./$db_prefix"
+  touch "./${db_prefix}.ready"
+}
+
+# Print the directory all the members of a tar listing are in, if there's
+# exactly one
+function top_level_dir() {
+  sed -e 's|^\./||' "$1" | awk -F/ '
+    $1 != "" { dirs[$1]; if (NF > 1 && $2 != "") nested = 1 }
+    END { for (dir in dirs) { n++; top = dir } if (n == 1 && nested) print top }'
+}
+
+# Describe and download an input BAM into scratch/BAM_ID, marking it fetched
+function prefetch_bam() {
+  set -e -o pipefail
+
+  bam_id=$(dx-jobutil-parse-link --no-project "$1")
+  mkdir -p "scratch/${bam_id}"
+  dx describe --json "$bam_id" > "scratch/${bam_id}/describe.json"
+  dx download -f -o "scratch/${bam_id}/$(jq -r .name "scratch/${bam_id}/describe.json")" "$bam_id"
+  touch "scratch/${bam_id}/fetched"
+}
+
+# Wait for a file to appear while the process making it is still running
+function wait_for() {
+  while [ ! -e "$1" ] && kill -0 "$2" 2>/dev/null; do
+    sleep 2
+  done
+  [ -e "$1" ]
+}
+
+# Set workers and kraken_threads from the instance's cores and memory: each
+# worker takes worker_mem_mb (Picard and Kraken's own buffers) on top of the
+# shared database, and at least two cores
+function size_workers() {
+  worker_mem_mb=3000
+  mem_in_mb=$(head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}')
+  kraken_db_mb=$(du -cm "./$kraken_db_prefix"/*.kdb "./$kraken_db_prefix"/*.idx | tail -n1 | cut -f1)
+  cores=$(nproc)
+
+  workers=$(( (mem_in_mb - kraken_db_mb) / worker_mem_mb ))
+  if [ "$workers" -gt $(( cores / 2 )) ]; then
+    workers=$(( cores / 2 ))
+  fi
+  if [ "$workers" -gt "${#mappings[@]}" ]; then
+    workers=${#mappings[@]}
+  fi
+  if [ "$workers" -lt 1 ]; then
+    workers=1
+  fi
+  kraken_threads=$(( cores / workers ))
+
+  echo "Classifying ${#mappings[@]} samples, $workers at a time with $kraken_threads threads each, against a ${kraken_db_mb} MB Kraken database"
 }
 
 function process_bam() {
@@ -57,26 +131,27 @@ function process_bam() {
   kraken_db_prefix="$1"
   krona_taxonomy_db_prefix="$2"
 
-  # stage input BAM
+  # stage input BAM, unless the prefetch has (or fails to)
   bam_id=$(dx-jobutil-parse-link --no-project "$3")
-  bam_name=$(dx describe --name "$3")
-
-  mkdir -p "scratch/${bam_id}/krona"
-  dx download -o "scratch/${bam_id}/${bam_name}" "$bam_id"
+  if ! wait_for "scratch/${bam_id}/fetched" "$prefetch_pid"; then
+    prefetch_bam "$3"
+  fi
+  bam_name=$(jq -r .name "scratch/${bam_id}/describe.json")
 
   # folder structure for multi-lane outputs uses lane metadata recorded
   # in BAM property at the end of demux
-  lane=$(dx describe --json "$bam_id" | jq -r .properties.lane)
+  lane=$(jq -r .properties.lane "scratch/${bam_id}/describe.json")
   if [ "$lane" == "null" ]; then
-      output_root_dir="out/outputs/"
+      output_folder="/"
   else
-      output_root_dir="out/outputs/lane_$lane/"
+      output_folder="/lane_$lane/"
   fi
 
   output_filename_prefix="${bam_name%.bam}"
   output_filename_prefix="${output_filename_prefix%.cleaned}"
-  output_root_dir="${output_root_dir}${output_filename_prefix}"
-  mkdir -p "$output_root_dir"
+  output_folder="${output_folder}${output_filename_prefix}"
+  output_root_dir="scratch/${bam_id}/out"
+  mkdir -p "$output_root_dir" "scratch/${bam_id}/krona"
 
   # Use Kraken to classify taxonomic profile of sample.
   viral-ngs metagenomics.py kraken \
@@ -84,9 +159,11 @@ function process_bam() {
                   "/user-data/${kraken_db_prefix}" \
                   --outReads "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-classified.txt.gz" \
                   --outReport "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-report.txt" \
-                  --numThreads 4
+                  --numThreads "$kraken_threads"
+  rm "scratch/${bam_id}/${bam_name}"
 
   # Use Krona to visualize taxonomic profiling output from Kraken.
+  wait_for "${krona_taxonomy_db_prefix}.ready" "$krona_pid"
   viral-ngs metagenomics.py krona \
                   "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-classified.txt.gz" \
                   "/user-data/${krona_taxonomy_db_prefix}" \
@@ -99,6 +176,10 @@ function process_bam() {
   # Tar all html and attached js files for easy download
   tar cf "${output_root_dir}/${output_filename_prefix}.krona-report.tar" -C "scratch/$bam_id/krona" .
 
+  # Upload this sample's outputs right away, noting their IDs under its
+  # position among the inputs
+  dx upload --brief --parents --destination "${output_folder}/" "${output_root_dir}"/* > "uploads/${PARALLEL_SEQ}.ids"
+
   # cleanup
   rm -rf "scratch/${bam_id}"
 }
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Launch viral-ngs-bwa-count-hits and fastqc on each input BAM of
+viral-ngs-count-hits-multiplex, and add their outputs as the job's outputs.
+
+The BAMs are described in one bulk call (for the lane property, which puts
+both jobs' outputs into the lane_N folder), the jobs are submitted
+concurrently, and the jobrefs are written to job_output.json at once:
+
+    count_hits_multiplex.py job_input.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+
+import dxpy
+import dxlaunch
+
+def sample_name(filename):
+    """The file name less its extension (and .gz), like the bash helpers'
+    <input>_prefix variables"""
+    if filename.endswith(".gz"):
+        filename = filename[:-len(".gz")]
+    return os.path.splitext(filename)[0]
+
+def launches(job_input):
+    per_sample_output = job_input.get("per_sample_output", False)
+
+    count_hits_input = {
+        "per_sample_output": per_sample_output,
+        "ref_fasta_tar": job_input["ref_fasta"],
+        "out_fn": job_input.get("out_fn") or "hit_counts.txt"
+    }
+    fastqc_input = dict((name, job_input[name]) for name in ["format", "kmer_size", "nogroup"])
+    for name in ["contaminants_txt", "adapters_txt", "limits_txt", "extra_options"]:
+        if job_input.get(name):
+            fastqc_input[name] = job_input[name]
+
+    count_hits_applet_id = dxpy.get_dxlink_ids(job_input["count_hits_applet"])[0]
+    fastqc_applet_id = dxpy.get_dxlink_ids(job_input["fastqc_applet"])[0]
+
+    bams = job_input["in_bams"]
+    count_hits, fastqc = [], []
+    for bam, describe in zip(bams, dxlaunch.describe_files(bams, ["name", "properties"])):
+        bam_name = sample_name(describe["name"])
+        lane = describe["properties"].get("lane")
+        lane_folder = "/lane_{}".format(lane) if lane is not None else ""
+
+        fastqc_folder = lane_folder
+        if per_sample_output:
+            fastqc_folder = "{}/{}".format(fastqc_folder, bam_name)
+
+        count_hits.append(dxlaunch.Launch(count_hits_applet_id, dict(count_hits_input, in_bam=bam),
+                                          name="count_hits {}".format(bam_name), folder=lane_folder or None))
+        fastqc.append(dxlaunch.Launch(fastqc_applet_id, dict(fastqc_input, reads=bam),
+                                      name="fastqc {}".format(bam_name), folder=fastqc_folder or None))
+    return count_hits, fastqc
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job_input", help="The job's job_input.json")
+    parser.add_argument("--threads", type=int, default=8, help="Jobs to submit concurrently (default: %(default)s)")
+    parser.add_argument("--job-output", default="job_output.json", help="Add the outputs to this file (default: %(default)s)")
+    args = parser.parse_args()
+
+    with open(args.job_input) as infile:
+        job_input = json.load(infile)
+
+    count_hits, fastqc = launches(job_input)
+    job_ids = dxlaunch.run_all(count_hits + fastqc, args.threads)
+    count_hits_jobs, fastqc_jobs = job_ids[:len(count_hits)], job_ids[len(count_hits):]
+
+    dxlaunch.add_outputs({
+        "count_files": [dxlaunch.jobref(job_id, "count_files") for job_id in count_hits_jobs],
+        "report_html": [dxlaunch.jobref(job_id, "report_html") for job_id in fastqc_jobs],
+        "stats_txt": [dxlaunch.jobref(job_id, "stats_txt") for job_id in fastqc_jobs]
+    }, args.job_output)
+
+if __name__ == "__main__":
+    main()
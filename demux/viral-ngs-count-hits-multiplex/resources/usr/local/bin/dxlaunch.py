@@ -0,0 +1 @@
+../../../../../../common/dxlaunch.py
\ No newline at end of file
@@ -86,11 +86,17 @@ main() {
         opts="-isample_sheet=$sample_sheet_id $opts"
     fi
 
+    lane_opts=""
     for lane in "${lanes[@]}"
     do
-        opts="-ilanes=$lane $opts"
+        lane_opts="-ilanes=$lane $lane_opts"
     done
 
+    if [ "$max_concurrent_lanes" != "" ]
+    then
+        opts="-imax_concurrent_lanes=$max_concurrent_lanes $opts"
+    fi
+
     if [ "$flowcell" != "" ]
     then
         opts="-iflowcell=$flowcell $opts"
@@ -125,6 +131,19 @@ main() {
 
     demux_applet_id=$(dx-jobutil-parse-link "$demux_applet")
 
+    # To fan out, we need to know the lanes up front: given as input, or
+    # counted in RunInfo.xml from the sentinel record
+    fan_out=()
+    if [ "$fan_out_lanes" == 'true' ]; then
+        if [ "${#lanes[@]}" -gt 0 ]; then
+            fan_out=("${lanes[@]}")
+        elif [ "$lane_count" != "" ]; then
+            fan_out=($(seq 1 $lane_count))
+        else
+            echo "Can't tell the lane count without an upload sentinel record; demultiplexing all lanes in one job."
+        fi
+    fi
+
     job_id=""
 
     # Execute demux applet, shuttling all input variables as is
@@ -133,11 +152,31 @@ main() {
     # that caution should be exercised so that $opts does not contain
     # fields which contain meaningful whitespace or colon (specifically,
     # $opts should not contain DNAnexus links)
-    job_id=$(dx run $demux_applet_id \
-    --instance-type="$instance_type" \
-    -iresources="${resources}" \
-    -iper_sample_output="${per_sample_output}" $opts \
-    --yes --brief)
+    if [ "${#fan_out[@]}" -eq 0 ]; then
+        job_id=$(dx run $demux_applet_id \
+        --instance-type="$instance_type" \
+        -iresources="${resources}" \
+        -iper_sample_output="${per_sample_output}" $lane_opts $opts \
+        --yes --brief)
+    else
+        # One demux job per lane, each writing into its lane_N folder, and
+        # a gather job to collect their outputs
+        lane_jobs=()
+        gather_opts=""
+        for lane in "${fan_out[@]}"
+        do
+            lane_job_id=$(dx run $demux_applet_id \
+            --instance-type="$instance_type" \
+            --name "viral-ngs-demux lane $lane" \
+            -iresources="${resources}" \
+            -iper_sample_output="${per_sample_output}" \
+            -ilanes=$lane -ilane_subfolders=true $opts \
+            --yes --brief)
+            lane_jobs+=("$lane_job_id")
+            gather_opts="$gather_opts -ilane_jobs=$lane_job_id"
+        done
+        job_id=$(dx-jobutil-new-job gather $gather_opts --depends-on "${lane_jobs[@]}")
+    fi
 
     dx-jobutil-add-output bams $job_id:bams --class=jobref
     dx-jobutil-add-output unmatched_bams $job_id:unmatched_bams --class=jobref
@@ -145,3 +184,18 @@ main() {
     dx-jobutil-add-output barcodes $job_id:barcodes --class=jobref
 
 }
+
+# Collect the outputs of the per-lane demux jobs
+gather() {
+    for lane_job_id in "${lane_jobs[@]}"
+    do
+        dx describe "$lane_job_id" --json > lane_job.json
+        for output in bams unmatched_bams metrics barcodes
+        do
+            for file_id in $(jq -r --arg output "$output" '(.output[$output] // [])[] | .["$dnanexus_link"]' lane_job.json)
+            do
+                dx-jobutil-add-output "$output" "$file_id" --class=file --array
+            done
+        done
+    done
+}
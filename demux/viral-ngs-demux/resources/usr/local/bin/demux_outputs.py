@@ -0,0 +1 @@
+../../../../../../common/demux_outputs.py
\ No newline at end of file
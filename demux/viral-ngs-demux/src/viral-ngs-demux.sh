@@ -5,7 +5,7 @@ main() {
     set -e -x -o pipefail
 
     # Unpack viral-ngs resources
-    dx cat "$resources" | pigz -dc | tar x -C /
+    chunked_tarball.py stage "$resources" -C /
 
     # Raise error if both of upload_sentinel_record and tarballs are specified
     if [ "$upload_sentinel_record" != "" ] && [ "$run_tarballs" != "" ]; then
@@ -62,8 +62,6 @@ main() {
     fi
 
     # Populate command line options
-    # The --JVMemory arg ensures that $opts is non-empty
-    mem_in_mb="`head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}'`m"
     opts=()
 
     if [ "$sample_sheet" != "" ]
@@ -113,12 +111,12 @@ main() {
     # specified, demux over all lanes
     if [ ${#lanes[@]} -eq 0 ];
     then
-        lanes=$(seq 1 $lane_count)
+        lanes=($(seq 1 $lane_count))
     fi
 
     multi_lane=false
 
-    if [ "${#lanes}" -gt 1 ];
+    if [ "${#lanes[@]}" -gt 1 ] || [ "$lane_subfolders" = 'true' ];
     then
         multi_lane=true
     fi
@@ -132,90 +130,117 @@ main() {
         fi
     done
 
+    # Demux lanes concurrently: as many as there are lanes, cores, and
+    # min_lane_mem_mb chunks of 90% of the RAM, unless capped by
+    # max_concurrent_lanes. Lanes in flight split the memory and cores.
+    min_lane_mem_mb=8000
+    mem_in_mb=$(head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}')
+    cores=$(nproc)
+    concurrency=${#lanes[@]}
+    if [ "$concurrency" -gt "$cores" ]; then
+        concurrency=$cores
+    fi
+    if [ "$concurrency" -gt $(( mem_in_mb / min_lane_mem_mb )) ]; then
+        concurrency=$(( mem_in_mb / min_lane_mem_mb ))
+    fi
+    if [ -n "$max_concurrent_lanes" ] && [ "$concurrency" -gt "$max_concurrent_lanes" ]; then
+        concurrency=$max_concurrent_lanes
+    fi
+    if [ "$concurrency" -lt 1 ]; then
+        concurrency=1
+    fi
+    lane_mem="$(( mem_in_mb / concurrency ))m"
+    lane_threads=$(( cores / concurrency ))
+
+    # Older viral-ngs versions' illumina_demux has no --threads option
+    thread_opts=()
+    if viral-ngs illumina.py illumina_demux --help | grep -q -e "--threads"; then
+        thread_opts=("--threads" "$lane_threads")
+    fi
+
+    echo "Demultiplexing ${#lanes[@]} lane(s), $concurrency at a time with $lane_mem memory and $lane_threads cores each"
+
+    mkdir -p uploads
+    running=0
     for lane in ${lanes[@]}
     do
-        # Prepare output folders
-        bam_out_dir="out/bams"
-        unmatched_out_dir="out/unmatched_bams"
-        metric_out_dir="out/metrics"
-        barcode_out_dir="out/barcodes"
-
-        # Subfolders by lane if multi-lane run
-        if [ "$multi_lane" = true ]; then
-            bam_out_dir="$bam_out_dir/lane_$lane"
-            unmatched_out_dir="$unmatched_out_dir/lane_$lane"
-            metric_out_dir="$metric_out_dir/lane_$lane"
-            barcode_out_dir="$barcode_out_dir/lane_$lane/"
+        if [ "$running" -ge "$concurrency" ]; then
+            wait_for_lane
+            running=$(( running - 1 ))
         fi
+        demux_lane "$lane" &
+        running=$(( running + 1 ))
+    done
+    while [ "$running" -gt 0 ]; do
+        wait_for_lane
+        running=$(( running - 1 ))
+    done
 
-        mkdir -p $bam_out_dir
-        mkdir -p $metric_out_dir
-        mkdir -p $unmatched_out_dir
-        mkdir -p $barcode_out_dir
-
-        if [ ${#opts[@]} -eq 0 ]; then
-            viral-ngs illumina.py illumina_demux \
-            "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
-            --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
-            --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
-            --JVMmemory "$mem_in_mb"
-        else
-            # Execute viral-ngs demux, $opts is guaranteed to be
-            # not empty, so we can safely quote it without introducing
-            # extraneous quotes
-            echo "${opts[@]}"
-            viral-ngs illumina.py illumina_demux \
-            "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
-            --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
-            --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
-            --JVMmemory "$mem_in_mb" "${opts[@]}"
-        fi
+    # Each lane uploaded its outputs as it finished; collect them
+    demux_outputs.py gather uploads/lane_*.json > job_output.json
+}
 
-        # Move unmatched bam file to unmatched_out_dir, if present
-        if [ -f "$bam_out_dir/Unmatched.bam" ]; then
-            mv "$bam_out_dir/Unmatched.bam" "$unmatched_out_dir/"
-        fi
+# Demux one lane into its output folders, then drop empty BAMs and sort
+# the rest into per-sample folders if requested
+demux_lane() {
+    lane=$1
+
+    # Prepare output folders
+    bam_out_dir="out/bams"
+    unmatched_out_dir="out/unmatched_bams"
+    metric_out_dir="out/metrics"
+    barcode_out_dir="out/barcodes"
+
+    # Subfolders by lane if multi-lane run
+    if [ "$multi_lane" = true ]; then
+        bam_out_dir="$bam_out_dir/lane_$lane"
+        unmatched_out_dir="$unmatched_out_dir/lane_$lane"
+        metric_out_dir="$metric_out_dir/lane_$lane"
+        barcode_out_dir="$barcode_out_dir/lane_$lane/"
+    fi
 
-        # Check that demuxed file is not empty (has 0 reads).
-        # Remove bam file if it's empty to prevent potential issues
-        # Dowstream that don't handle empty bam files elegantly
-        for bam_file in `ls $bam_out_dir`
-        do
-            read_count=`("samtools" view -c "$bam_out_dir/$bam_file")`
-
-            if [ $read_count -eq 0 ]; then
-                echo "===WARNING=== No reads found in demuxed bam file: $bam_file. This file will be removed from output"
-                # Remove empty file
-                rm "$bam_out_dir/$bam_file"
-            fi
-        done
+    mkdir -p $bam_out_dir
+    mkdir -p $metric_out_dir
+    mkdir -p $unmatched_out_dir
+    mkdir -p $barcode_out_dir
+
+    # Execute viral-ngs demux; the array expansions are safe to quote
+    # since --JVMmemory makes the command line non-empty anyway
+    viral-ngs illumina.py illumina_demux \
+        "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
+        --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
+        --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
+        --JVMmemory "$lane_mem" "${thread_opts[@]}" "${opts[@]}"
+
+    # Move unmatched bam file to unmatched_out_dir, if present
+    if [ -f "$bam_out_dir/Unmatched.bam" ]; then
+        mv "$bam_out_dir/Unmatched.bam" "$unmatched_out_dir/"
+    fi
 
-        # Per sample output, make output sub-folder for each sample
-        if [ "$per_sample_output" = 'true' ]; then
-            for file in `ls $bam_out_dir`
-            do
-                sample_name="${file%.bam}"
-                mkdir -p "$bam_out_dir/$sample_name"
-                mv "$bam_out_dir/$file" "$bam_out_dir/$sample_name/$file"
-            done
-        fi
-    done
+    # Upload the lane's outputs right away, leaving out empty demuxed BAMs
+    # (which downstream tools don't handle gracefully), with the flowcell
+    # and lane properties set, and into per-sample subfolders if requested
+    upload_opts=()
+    if [ "$multi_lane" = true ]; then
+        upload_opts+=("--folder" "/lane_$lane" "--lane-property")
+    fi
+    if [ -n "$flowcell" ]; then
+        upload_opts+=("--flowcell" "$flowcell")
+    fi
+    if [ "$per_sample_output" = 'true' ]; then
+        upload_opts+=("--per-sample-output")
+    fi
+    demux_outputs.py upload --lane "$lane" --record "uploads/lane_$lane.json" "${upload_opts[@]}" \
+        "bams=$bam_out_dir" "unmatched_bams=$unmatched_out_dir" \
+        "metrics=$metric_out_dir" "barcodes=$barcode_out_dir"
 
-    dx-upload-all-outputs
+    echo "Lane $lane done"
+}
 
-    # add flowcell and lane properties to bams
-    for lane in ${lanes[@]}; do
-        bam_out_dir="/"
-        if [ "$multi_lane" = true ]; then
-            bam_out_dir="/lane_$lane"
-        fi
-        for dxfile in $(dx find data --folder "$bam_out_dir" --class file --brief); do
-            if [ -n "$flowcell" ]; then
-                dx set_properties "$dxfile" "flowcell=$flowcell"
-            fi
-            if [ "$multi_lane" = true ]; then
-                dx set_properties "$dxfile" "lane=$lane"
-            fi
-        done
-    done
+# Wait for the next lane to finish; if it failed, stop the others and fail
+wait_for_lane() {
+    if ! wait -n; then
+        kill $(jobs -p) 2>/dev/null || true
+        dx-jobutil-report-error "illumina_demux failed on one of the lanes; see the log above"
+    fi
 }
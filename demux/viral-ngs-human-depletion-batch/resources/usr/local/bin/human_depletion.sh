@@ -0,0 +1 @@
+../../../../../../common/human_depletion.sh
\ No newline at end of file
@@ -0,0 +1,69 @@
+#!/bin/bash
+
+# stage_dbs, deplete_reads and output_subfolder
+source human_depletion.sh
+
+# Deplete each of bams, outputting the cleaned BAMs as batch_cleaned_reads and
+# the read/base counts of each sample as the batch_*_count arrays, in the
+# order of bams, laid out in folders as separate viral-ngs-human-depletion
+# jobs would have
+main() {
+    set -e -x -o pipefail
+
+    mkdir batch
+    if [ "$skip_depletion" == "true" ]; then
+        for i in "${!bams[@]}"; do
+            dx cat "${bams[$i]}" | bam_stats.py - > "batch/$i.input.stats.json"
+            cp "batch/$i.input.stats.json" "batch/$i.cleaned.stats.json"
+            dx-jobutil-parse-link "${bams[$i]}" > "batch/$i.id"
+        done
+        add_outputs
+        return
+    fi
+
+    # Download the BAMs while the resources and databases are staged
+    pids=()
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
+    (
+        for i in "${!bams[@]}"; do
+            dx download "${bams[$i]}" -o "batch/$i.bam"
+        done
+    ) & pids+=($!)
+    stage_dbs
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
+
+    # Deplete the samples back to back, each with all the cores and memory,
+    # uploading the outputs of one while the next is depleted
+    upload_pids=()
+    for i in "${!bams[@]}"; do
+        sample="${bams_prefix[$i]%.raw}"
+        sample_folder=$(output_subfolder "${bams[$i]}" "$sample")
+        mkdir "batch/$i"
+        bam_stats.py "batch/$i.bam" > "batch/$i.input.stats.json"
+        deplete_reads "batch/$i.bam" "batch/$i"
+        rm "batch/$i.bam"
+        bam_stats.py "batch/$i/cleaned.bam" > "batch/$i.cleaned.stats.json"
+
+        intermediates_out_folder="out/intermediates${sample_folder}"
+        mkdir -p "$intermediates_out_folder"
+        for step in raw bmtagger_depleted rmdup; do
+            mv "batch/$i/$step.bam" "${intermediates_out_folder}/${sample}.$step.bam"
+        done
+        dx upload --brief --parents --destination "${sample_folder}/${sample}.cleaned.bam" \
+            "batch/$i/cleaned.bam" > "batch/$i.id" & upload_pids+=($!)
+    done
+    for pid in "${upload_pids[@]}"; do wait $pid || exit $?; done
+
+    add_outputs
+    dx-upload-all-outputs
+}
+
+add_outputs() {
+    for i in "${!bams[@]}"; do
+        dx-jobutil-add-output batch_cleaned_reads --array --class=file "$(cat "batch/$i.id")"
+        dx-jobutil-add-output batch_predepletion_read_count --array --class=int "$(jq .read_count "batch/$i.input.stats.json")"
+        dx-jobutil-add-output batch_predepletion_base_count --array --class=int "$(jq .base_count "batch/$i.input.stats.json")"
+        dx-jobutil-add-output batch_depleted_read_count --array --class=int "$(jq .read_count "batch/$i.cleaned.stats.json")"
+        dx-jobutil-add-output batch_depleted_base_count --array --class=int "$(jq .base_count "batch/$i.cleaned.stats.json")"
+    done
+}
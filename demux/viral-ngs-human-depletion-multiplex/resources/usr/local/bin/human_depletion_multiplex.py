@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Launch viral-ngs-human-depletion on the input BAMs of
+viral-ngs-human-depletion-multiplex, and add the cleaned reads as the job's
+output, in the order of the input BAMs.
+
+Without a byte budget, each BAM gets a job of its own. With one, the BAMs are
+packed by file size into batches of about that many bytes (first fit,
+largest BAMs first), and each batch is depleted by one
+viral-ngs-human-depletion-batch job that stages the databases only once,
+with the databases of viral-ngs-human-depletion's defaults:
+
+    human_depletion_multiplex.py job_input.json [--batch-bytes 2000000000]
+"""
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+import dxpy
+import dxlaunch
+
+def pack(sizes, capacity):
+    """First-fit decreasing: group the indices of sizes into bins of up to
+    capacity in total (a size over capacity gets a bin of its own). Each bin
+    lists its indices in ascending order."""
+    bins = []
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        for items in bins:
+            if items[0] + sizes[i] <= capacity:
+                items[0] += sizes[i]
+                items[1].append(i)
+                break
+        else:
+            bins.append([sizes[i], [i]])
+    return sorted(sorted(items) for _, items in bins)
+
+def database_defaults(depletion_applet_id):
+    """The bmtagger_dbs and blast_dbs defaults of viral-ngs-human-depletion,
+    for the batch jobs"""
+    input_spec = dxpy.DXApplet(depletion_applet_id).describe()["inputSpec"]
+    return dict((spec["name"], spec["default"]) for spec in input_spec if spec["name"] in ["bmtagger_dbs", "blast_dbs"])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job_input", help="The job's job_input.json")
+    parser.add_argument("--batch-bytes", type=int, help="Pack the BAMs into batches of about this many bytes")
+    parser.add_argument("--threads", type=int, default=8, help="Jobs to submit concurrently (default: %(default)s)")
+    parser.add_argument("--job-output", default="job_output.json", help="Add the outputs to this file (default: %(default)s)")
+    args = parser.parse_args()
+
+    with open(args.job_input) as infile:
+        job_input = json.load(infile)
+
+    depletion_applet_id = dxpy.get_dxlink_ids(job_input["depletion_applet"])[0]
+    common_input = {"resources": job_input["resources"], "per_sample_output": job_input.get("per_sample_output", False)}
+    if job_input.get("skip_depletion"):
+        common_input["skip_depletion"] = True
+
+    bams = job_input["bams"]
+    describes = dxlaunch.describe_files(bams, ["name", "size"])
+    if args.batch_bytes:
+        batches = pack([describe["size"] for describe in describes], args.batch_bytes)
+    else:
+        batches = [[i] for i in range(len(bams))]
+
+    if any(len(batch) > 1 for batch in batches):
+        if "batch_applet" not in job_input:
+            # before launching anything, so no jobs are left running
+            subprocess.call(["dx-jobutil-report-error", "Packing the BAMs into batches of batch_bytes needs the "
+                             "viral-ngs-human-depletion-batch applet as batch_applet", "AppError"])
+            sys.exit(1)
+        batch_applet_id = dxpy.get_dxlink_ids(job_input["batch_applet"])[0]
+        batch_input = dict(common_input, **database_defaults(depletion_applet_id))
+
+    launches = []
+    for batch in batches:
+        if len(batch) == 1:
+            launches.append(dxlaunch.Launch(depletion_applet_id, dict(common_input, file=bams[batch[0]]),
+                                            name="deplete {}".format(describes[batch[0]]["name"])))
+        else:
+            launches.append(dxlaunch.Launch(batch_applet_id, dict(batch_input, bams=[bams[i] for i in batch]),
+                                            name="deplete {} BAMs ({}, ...)".format(len(batch), describes[batch[0]]["name"])))
+    print("Depleting {} BAMs ({:.1f} GB) in {} jobs".format(
+        len(bams), sum(describe["size"] for describe in describes) / 1e9, len(batches)), file=sys.stderr)
+    job_ids = dxlaunch.run_all(launches, args.threads)
+
+    cleaned_reads = [None] * len(bams)
+    for batch, job_id in zip(batches, job_ids):
+        if len(batch) == 1:
+            cleaned_reads[batch[0]] = dxlaunch.jobref(job_id, "cleaned_reads")
+        else:
+            for index, i in enumerate(batch):
+                cleaned_reads[i] = dxlaunch.jobref(job_id, "batch_cleaned_reads", index)
+    dxlaunch.add_outputs({"cleaned_reads": cleaned_reads}, args.job_output)
+
+if __name__ == "__main__":
+    main()
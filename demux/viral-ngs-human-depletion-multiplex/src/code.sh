@@ -3,18 +3,10 @@
 main() {
     set -e -x -o pipefail
 
-    depletion_applet_id=$(dx-jobutil-parse-link "$depletion_applet")
-
-    opts=""
-    if [ "$skip_depletion" = true ]; then
-        opts="-i skip_depletion=true"
-    fi
-
-    for bam in "${bams[@]}"; do
-        bam_name=$(dx describe --name "$bam")
-        job=$(dx run $depletion_applet_id -i "file=$bam" \
-        -i "resources=$resources" -i "per_sample_output=$per_sample_output" \
-        $opts --name "deplete $bam_name" -y --brief)
-        dx-jobutil-add-output --class=array:jobref cleaned_reads $job:cleaned_reads
-    done
+    # Launch viral-ngs-human-depletion on each BAM, or on batches of BAMs
+    # packed by size up to batch_bytes, and add the cleaned reads (in the
+    # order of the BAMs) to job_output.json. Fails if a batch of several BAMs
+    # needs batch_applet and it isn't set.
+    human_depletion_multiplex.py job_input.json --job-output job_output.json \
+        ${batch_bytes:+--batch-bytes "$batch_bytes"}
 }
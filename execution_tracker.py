@@ -0,0 +1,86 @@
+"""
+Wait on many DNAnexus executions at once, reacting to each one as it finishes.
+"""
+import sys
+import time
+import dxpy
+
+FAILED_STATES = ["failed", "partially_failed", "terminating", "terminated"]
+
+def describe_executions(execution_ids, project=None):
+    """Describe jobs/analyses with paginated system/findExecutions queries over
+    their IDs (up to 1000 per query), instead of one describe call each.
+    Returns a dict of ID => describe hash."""
+    describes = {}
+    for i in xrange(0, len(execution_ids), 1000):
+        query = {"id": execution_ids[i:i+1000], "describe": True}
+        if project is not None:
+            query["project"] = project
+        while True:
+            response = dxpy.api.system_find_executions(query)
+            for result in response["results"]:
+                describes[result["id"]] = result["describe"]
+            if response["next"] is None:
+                break
+            query["starting"] = response["next"]
+    return describes
+
+class ExecutionTracker(object):
+    """Tracks a set of jobs and analyses until they're all done.
+
+    All the pending executions are polled together with one bulk query. When
+    an execution is done, its on_done callback runs with its description (and
+    may track further executions); if one fails, or a callback raises, wait()
+    raises immediately. The poll interval backs off from min_interval to
+    max_interval while nothing changes, and a progress line is printed at
+    least every heartbeat seconds (which also keeps CI consoles alive).
+    """
+    def __init__(self, project=None, min_interval=5, max_interval=60, heartbeat=60, out=sys.stdout):
+        self.project = project
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.heartbeat = heartbeat
+        self.out = out
+        self.pending = {}
+        self.done = []
+
+    def track(self, execution_id, on_done=None, label=None):
+        self.pending[execution_id] = (label or execution_id, on_done)
+
+    def log(self, message):
+        self.out.write("[{}] {}\n".format(time.strftime("%H:%M:%S"), message))
+        self.out.flush()
+
+    def poll(self):
+        """Check all pending executions once; returns True if any finished."""
+        describes = describe_executions(self.pending.keys(), self.project)
+        changed = False
+        for execution_id, desc in sorted(describes.iteritems()):
+            label, on_done = self.pending[execution_id]
+            if desc["state"] in FAILED_STATES:
+                raise dxpy.exceptions.DXJobFailureError("{} ({}) is {}: {}".format(
+                    label, execution_id, desc["state"], desc.get("failureMessage", "")))
+            elif desc["state"] == "done":
+                del self.pending[execution_id]
+                self.done.append(execution_id)
+                self.log("{} ({}) done".format(label, execution_id))
+                if on_done is not None:
+                    on_done(desc)
+                changed = True
+        return changed
+
+    def wait(self):
+        interval = self.min_interval
+        last_heartbeat = time.time()
+        while self.pending:
+            if self.poll():
+                interval = self.min_interval
+            else:
+                interval = min(interval * 1.5, self.max_interval)
+            if not self.pending:
+                break
+            if time.time() - last_heartbeat >= self.heartbeat:
+                self.log("{} done, {} pending: {}".format(len(self.done), len(self.pending),
+                                                          ", ".join(sorted(label for label, _ in self.pending.values()))))
+                last_heartbeat = time.time()
+            time.sleep(min(interval, max(1, last_heartbeat + self.heartbeat - time.time())))
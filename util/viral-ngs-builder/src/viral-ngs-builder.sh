@@ -3,21 +3,41 @@
 main() {
     set -e -x -o pipefail
 
-    # pull the viral-ngs docker image
-    dx-docker pull broadinstitute/viral-ngs$viral_ngs_version
+    # the image digest is known up front when pulling by @DIGEST
+    if [ -z "$image_digest" ] && [[ "$viral_ngs_version" == @* ]]; then
+        image_digest="${viral_ngs_version#@}"
+    fi
+
+    # pull the viral-ngs docker image; by digest when we have one, so the
+    # tarball holds the image its image_digest property names even if the tag
+    # has moved since it was resolved
+    image="broadinstitute/viral-ngs$viral_ngs_version"
+    if [ -n "$image_digest" ]; then
+        image="broadinstitute/viral-ngs@$image_digest"
+    fi
+    dx-docker pull "$image"
     ls -lhR /tmp/dx-docker-cache/
     find /tmp/dx-docker-cache -type f > /tmp/resources-manifest.txt
     # generate a script /usr/local/bin/viral-ngs to invoke the viral-ngs docker image
     echo "#!/bin/bash
 set -x
-dx-docker run -v \$(pwd):/user-data broadinstitute/viral-ngs$viral_ngs_version \"\$@\"" > /usr/local/bin/viral-ngs
+dx-docker run -v \$(pwd):/user-data $image \"\$@\"" > /usr/local/bin/viral-ngs
     chmod +x /usr/local/bin/viral-ngs
     echo /usr/local/bin/viral-ngs >> /tmp/resources-manifest.txt
 
-    # upload a tarball with the new files
+    # pack the new files into a chunked tarball: still a plain .tar.gz, but
+    # with a chunk manifest (stored as the file's details) that lets the
+    # applets stage it with parallel ranged reads (chunked_tarball.py stage)
+    tar -c -v -T /tmp/resources-manifest.txt | \
+        chunked_tarball.py pack --manifest /tmp/resources-chunks.json > /tmp/resources.tar.gz
+
+    # upload it, tagged with the version it was built from so that
+    # build_resources_tarball.py can reuse it
     rinsed_version=$(echo "$viral_ngs_version" | tr -d ":@")
-    resources=`tar -c -v -z -T /tmp/resources-manifest.txt | \
-               dx upload --brief -o "viral-ngs-${rinsed_version}.resources.tar.gz" -`
+    resources=$(dx upload --brief /tmp/resources.tar.gz -o "viral-ngs-${rinsed_version}.resources.tar.gz" \
+                  --details "$(cat /tmp/resources-chunks.json)" \
+                  --property "viral_ngs_version=${viral_ngs_version}" \
+                  ${image_digest:+--property "image_digest=${image_digest}"})
 
     dx-jobutil-add-output resources "$resources" --class=file
 }
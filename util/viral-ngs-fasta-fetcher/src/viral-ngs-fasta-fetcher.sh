@@ -4,7 +4,7 @@ main() {
     set -e -x -o pipefail
 
     accessions=$(echo ${accession_numbers[*]})
-    dx cat "$resources" | pigz -dc | tar x -C /
+    chunked_tarball.py stage "$resources" -C /
 
     # Write combined fasta to /genome.fasta
 
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+main() {
+    set -e -x -o pipefail
+
+    pids=()
+    chunked_tarball.py stage "$resources" -C / & pids+=($!)
+    dx download "$targets" -o targets.fasta
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
+    targets_sha256=$(sha256sum targets.fasta | cut -d " " -f 1)
+
+    # the same database viral-ngs-filter would build, with the same prefix
+    viral-ngs taxon_filter.py lastal_build_db /user-data/targets.fasta /user-data --outputFilePrefix targets.db
+    ls -lh targets.db.*
+
+    dxid=$(tar czv targets.db.* | dx upload --brief --destination "${targets_prefix}.lastal_db.tar.gz" \
+        --property "targets_sha256=$targets_sha256" -)
+    dx-jobutil-add-output lastal_db --class=file "$dxid"
+}
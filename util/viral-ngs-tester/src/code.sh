@@ -3,7 +3,7 @@
 main() {
     set -e -x -o pipefail
 
-    dx cat "$resources" | zcat | tar x -C /
+    chunked_tarball.py stage "$resources" -C /
 
     cd viral-ngs
     ./run_all_tests.sh
@@ -5,9 +5,20 @@ import dxpy
 import argparse
 import time
 import subprocess
-import tempfile
 import os
-from Bio import SeqIO
+from multiprocessing.pool import ThreadPool
+import concordance
+from fasta import read_fasta
+
+# execution_tracker.py is in the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from execution_tracker import describe_executions
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: {}".format(value))
+    return number
 
 parser = argparse.ArgumentParser(description="viral-ngs-assembly DNAnexus workflow validation")
 subparsers = parser.add_subparsers()
@@ -90,6 +101,7 @@ def launch(args):
     run_record.set_details(run_details)
     run_record.close()
     print("{} {}".format(run_id, run_record.get_id()))
+    return run_record.get_id()
 
 parser_launch = subparsers.add_parser("launch")
 parser_launch.set_defaults(func=launch)
@@ -113,46 +125,58 @@ def postmortem(args):
     record = dxpy.DXRecord(dxpy.dxlink(args.record, args.project))
     run_details = record.get_details()
 
-    finished = {}
+    finished = []
 
-    # check for analysis completion
-    for sample, sample_details in run_details["samples"].iteritems():
-        analysis = dxpy.DXAnalysis(sample_details["analysis"])
-        analysis_desc = analysis.describe()
+    # check for analysis completion, describing all the analyses and MUSCLE
+    # jobs in bulk
+    samples = sorted(run_details["samples"].keys())
+    execution_ids = [run_details["samples"][sample][k] for sample in samples for k in ["analysis", "muscle"]]
+    describes = describe_executions(execution_ids, args.project)
+
+    for sample in samples:
+        sample_details = run_details["samples"][sample]
+        analysis_desc = describes[sample_details["analysis"]]
         analysis_state = analysis_desc["state"]
 
         if analysis_state == "in_progress":
-            print("\t".join(["analysis_in_progress", sample, analysis.get_id(), analysis_state]))
+            print("\t".join(["analysis_in_progress", sample, analysis_desc["id"], analysis_state]))
         elif analysis_state != "done":
-            print("\t".join(["analysis_failed", sample, analysis.get_id(), analysis_state,
+            print("\t".join(["analysis_failed", sample, analysis_desc["id"], analysis_state,
                              str(get_analysis_output(analysis_desc, ".filtered_base_count")),
                              str(get_analysis_output(analysis_desc, ".subsampled_base_count"))]))
         else:
-            muscle_job = dxpy.DXJob(sample_details["muscle"])
-            muscle_job_state = muscle_job.describe()["state"]
+            muscle_desc = describes[sample_details["muscle"]]
+            muscle_job_state = muscle_desc["state"]
             if muscle_job_state in ["idle", "waiting_on_input", "runnable", "running", "waiting_on_output"]:
-                print("\t".join(["muscle_in_progress", sample, muscle_job.get_id(), muscle_job_state]))
+                print("\t".join(["muscle_in_progress", sample, muscle_desc["id"], muscle_job_state]))
             elif muscle_job_state != "done":
-                print("\t".join(["muscle_failed", sample, muscle_job.get_id(), muscle_job_state]))
+                print("\t".join(["muscle_failed", sample, muscle_desc["id"], muscle_job_state]))
             else:
-                finished[sample] = (analysis,muscle_job)
-
-    # compare the completed assemblies
-    for sample, (analysis, muscle_job) in finished.iteritems():
-        muscle_fasta = dxpy.DXFile(muscle_job.describe()["output"]["alignment"])
-        handle, local_fasta = tempfile.mkstemp(".fasta")
-        os.close(handle)
-        dxpy.download_dxfile(muscle_fasta.get_id(), local_fasta)
-        L, identical, N, gap, other = muscle_consensus_identity(local_fasta)
-        os.unlink(local_fasta)
-
-        analysis_desc = analysis.describe()
-        print("\t".join(["validation_result", sample,
-                         str(get_analysis_output(analysis_desc, ".filtered_base_count")),
-                         str(get_analysis_output(analysis_desc, ".subsampled_base_count")),
-                         str(get_analysis_output(analysis_desc, ".mean_coverage_depth")),
-                         str(L), str(identical), "{:.2f}".format(100.0*identical/L),
-                         str(N), str(gap), str(other), str(analysis_desc["totalPrice"])]))
+                finished.append((sample, analysis_desc, muscle_desc))
+
+    # compare the completed assemblies, streaming and scoring the alignments
+    # concurrently but reporting them in sample order
+    def score_alignment(finished_sample):
+        sample, analysis_desc, muscle_desc = finished_sample
+        muscle_fasta_id, _ = dxpy.get_dxlink_ids(muscle_desc["output"]["alignment"])
+        with dxpy.open_dxfile(muscle_fasta_id, project=args.project) as infile:
+            seqs = [seq for name, seq in read_fasta(infile)]
+        profile = concordance.identity_profile(seqs, args.window) if args.window else []
+        return concordance.concordance(seqs), profile
+
+    pool = ThreadPool(args.threads)
+    try:
+        for (sample, analysis_desc, muscle_desc), ((L, identical, N, gap, other), profile) in zip(finished, pool.imap(score_alignment, finished)):
+            print("\t".join(["validation_result", sample,
+                             str(get_analysis_output(analysis_desc, ".filtered_base_count")),
+                             str(get_analysis_output(analysis_desc, ".subsampled_base_count")),
+                             str(get_analysis_output(analysis_desc, ".mean_coverage_depth")),
+                             str(L), str(identical), "{:.2f}".format(100.0*identical/L),
+                             str(N), str(gap), str(other), str(analysis_desc["totalPrice"])]))
+            print_identity_profile(sample, profile)
+    finally:
+        pool.close()
+        pool.join()
 
     # TODO: compare mapped BAMs?
 
@@ -161,6 +185,25 @@ parser_postmortem.set_defaults(func=postmortem)
 parser_postmortem.add_argument("record", help="ID of the run record created at launch (required)")
 parser_postmortem.add_argument("--project", help="DNAnexus project ID (default: %(default)s)",
                                             default="project-BX6FjJ00QyB3X12J59PVYZ1V")
+parser_postmortem.add_argument("--window", metavar="N", type=int, default=None,
+                                           help="Also report the identity of each N-column window of the alignments")
+parser_postmortem.add_argument("--threads", metavar="N", type=positive_int, default=8,
+                                            help="Download and score up to N alignments concurrently (default: %(default)s)")
+
+def score(args):
+    seqs = read_alignment(args.fasta)
+    L, identical, N, gap, other = concordance.concordance(seqs)
+    print("\t".join(["alignment_result", args.fasta, str(len(seqs)),
+                     str(L), str(identical), "{:.2f}".format(100.0*identical/L),
+                     str(N), str(gap), str(other)]))
+    if args.window:
+        print_identity_profile(args.fasta, concordance.identity_profile(seqs, args.window))
+
+parser_score = subparsers.add_parser("score")
+parser_score.set_defaults(func=score)
+parser_score.add_argument("fasta", help="Local alignment FASTA (two or more aligned sequences)")
+parser_score.add_argument("--window", metavar="N", type=int, default=None,
+                                      help="Also report the identity of each N-column window of the alignment")
 
 def generate_run_id(workflow):
     # detect git revision
@@ -176,36 +219,24 @@ def get_analysis_output(desc, output_name):
                 return v
     return None
 
-def muscle_consensus_identity(fasta):
-    seqs = []
-    with open(fasta, "rU") as infile:
-        for record in SeqIO.parse(infile, "fasta") :
-            seqs.append(record.seq.upper())
-    assert (len(seqs) == 2)
-    assert (len(seqs[0]) == len(seqs[1]))
-    L = len(seqs[0])
-    identical = 0
-    N = 0
-    gap = 0
-    other = 0
-    for i in xrange(L):
-        if seqs[0][i] == seqs[1][i]:
-            identical = identical + 1
-        elif seqs[0][i] == "N" or seqs[1][i] == "N":
-            N = N + 1
-        elif seqs[0][i] == "-" or seqs[1][i] == "-":
-            gap = gap + 1
-        else:
-            other = other + 1
-    return (L,identical,N,gap,other)
+def read_alignment(fasta):
+    with open(fasta, "rb") as infile:
+        return [seq for name, seq in read_fasta(infile)]
+
+def print_identity_profile(name, profile):
+    for start, end, identity in profile:
+        print("\t".join(["identity_profile", name, str(start), str(end), "{:.2f}".format(100.0*identity)]))
 
 def strip_end(text, suffix):
     if not text.endswith(suffix):
         return text
     return text[:len(text)-len(suffix)]
 
+def main(argv=None):
+    args = parser.parse_args(argv)
+    return args.func(args)
+
 if __name__ == "__main__":
-    args = parser.parse_args()
-    args.func(args)
+    main()
 
 
@@ -0,0 +1,51 @@
+"""
+Column-wise concordance of multiple sequence alignments (e.g. MUSCLE output),
+computed over byte arrays with numpy rather than character by character.
+"""
+
+import numpy as np
+
+# column classes, in order of precedence
+IDENTICAL, N, GAP, OTHER = range(4)
+
+def alignment_matrix(seqs):
+    """Stack aligned sequences (str, bytes or bytearray) into an upper-cased
+    uint8 matrix with one row per sequence."""
+    lengths = set(len(seq) for seq in seqs)
+    if len(seqs) < 2 or len(lengths) != 1:
+        raise ValueError("expected at least two aligned sequences of equal length, got lengths {}".format([len(seq) for seq in seqs]))
+    matrix = np.empty((len(seqs), lengths.pop()), dtype=np.uint8)
+    for i, seq in enumerate(seqs):
+        matrix[i] = np.frombuffer(bytearray(seq), dtype=np.uint8)
+    lower = (matrix >= ord("a")) & (matrix <= ord("z"))
+    matrix[lower] -= ord("a") - ord("A")
+    return matrix
+
+def classify_columns(matrix):
+    """Classify each alignment column as IDENTICAL (all rows agree), else N
+    (any row has an N), else GAP (any row has a gap), else OTHER."""
+    classes = np.full(matrix.shape[1], OTHER, dtype=np.uint8)
+    classes[(matrix == ord("-")).any(axis=0)] = GAP
+    classes[(matrix == ord("N")).any(axis=0)] = N
+    classes[(matrix == matrix[0]).all(axis=0)] = IDENTICAL
+    return classes
+
+def concordance(seqs):
+    """Summarize an N-way alignment as (L, identical, N, gap, other) column counts"""
+    classes = classify_columns(alignment_matrix(seqs))
+    counts = np.bincount(classes, minlength=4)
+    return (len(classes), int(counts[IDENTICAL]), int(counts[N]), int(counts[GAP]), int(counts[OTHER]))
+
+def identity_profile(seqs, window, step=None):
+    """Fraction of identical columns in sliding windows along the alignment.
+
+    Returns a list of (start, end, identity) tuples with 0-based, half-open
+    column coordinates; windows running off the end of the alignment are
+    truncated.
+    """
+    classes = classify_columns(alignment_matrix(seqs))
+    identical = np.concatenate(([0], np.cumsum(classes == IDENTICAL)))
+    starts = np.arange(0, len(classes), step or window)
+    ends = np.minimum(starts + window, len(classes))
+    identity = (identical[ends] - identical[starts]) / (ends - starts).astype(float)
+    return [(int(s), int(e), float(i)) for s, e, i in zip(starts, ends, identity)]
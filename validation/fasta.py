@@ -0,0 +1,35 @@
+"""
+Minimal streaming FASTA reader, for alignments read straight from a local
+file or a remote file handle (e.g. dxpy.open_dxfile) without Biopython.
+"""
+
+def read_fasta(infile, chunk_size=1 << 20):
+    """Parse FASTA records from a binary file-like object.
+
+    Reads infile in chunks and yields (name, sequence) tuples, with the name
+    as bytes (the header line without '>') and the sequence as a bytearray
+    with line breaks removed. Handles \\n and \\r\\n line endings.
+    """
+    name = None
+    seq = bytearray()
+    pending = b""
+    while True:
+        chunk = infile.read(chunk_size)
+        lines = (pending + chunk).split(b"\n")
+        # hold back the last (possibly incomplete) line until we've seen its end
+        pending = lines.pop() if chunk else b""
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, seq
+                name = line[1:].strip()
+                seq = bytearray()
+            elif name is not None:
+                seq.extend(line.strip())
+            elif line.strip():
+                raise ValueError("expected a FASTA header line (>...), got: {!r}".format(line[:80]))
+        if not chunk:
+            break
+    if name is not None:
+        yield name, seq